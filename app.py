@@ -1,10 +1,43 @@
+import logging
+import time
+
+from dotenv import load_dotenv
 from flask import Flask
 
 from routes.api.vending_machine_routes import vending_machine_controller
+from routes.app_state import EXTENSION_NAME, AppState, settings_from_env
+from routes.json_provider import FastJSONProvider
+
+
+def create_app(config: dict | None = None) -> Flask:
+    """
+    Create the API app. The database is opened on the first request, or when the app is created
+    with PRELOAD_DATABASE, so importing and creating the app stays cheap.
+
+    Parameters:
+        config (dict | None): Settings overriding the ones read from the environment and the .env file,
+            see routes.app_state.settings_from_env. MACHINE_REPOSITORY serves an already opened repository,
+            MACHINE_SERVICE an already built service, and WARM_UP_HOOKS lists functions called with the service
+            once it is created.
 
-app = Flask(__name__)
-app.register_blueprint(vending_machine_controller)
+    Returns:
+        Flask: The app.
+    """
+    start = time.perf_counter()
+    load_dotenv()
+    app = Flask(__name__)
+    app.json = FastJSONProvider(app)
+    app.config.from_mapping(settings_from_env())
+    app.config.from_mapping(config or {})
+    state = AppState(app.config)
+    app.extensions[EXTENSION_NAME] = state
+    app.register_blueprint(vending_machine_controller)
+    state.metrics.observe_startup("create_app", time.perf_counter() - start)
+    if app.config["PRELOAD_DATABASE"]:
+        state.load()
+    return app
 
 
 if __name__ == "__main__":
-    app.run(debug=True, port=8080)
+    logging.basicConfig(level=logging.INFO)
+    create_app().run(debug=True, port=8080, threaded=True)
@@ -0,0 +1,296 @@
+"""
+Asyncio entry point serving the same API as app.py.
+
+Connections are handled by the event loop of an ASGI server, so thousands of idle or slow clients cost no thread.
+Each request runs the Flask routes on a bounded thread pool where storage I/O may block, and concurrent
+item updates are coalesced into shared storage writes. Never-ending streams, such as the change stream,
+run on a pool of their own, so their clients cannot starve the other requests.
+Serve it with any ASGI server, e.g. ``uvicorn --factory asgi_app:create_asgi_app``,
+or ``python asgi_app.py`` which runs uvicorn.
+"""
+
+import asyncio
+import contextvars
+import io
+import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Iterable, Iterator
+
+from dotenv import load_dotenv
+
+from app import create_app
+from routes.app_state import get_app_state
+
+DEFAULT_WORKERS = 32
+DEFAULT_PORT = 8080
+# Routes whose response never ends, each one holds a thread of the stream pool for as long as its client stays.
+DEFAULT_STREAM_PATHS = ("/api/changes/stream",)
+DEFAULT_MAX_STREAMS = 64
+DEFAULT_MAX_BODY_SIZE = 1024 * 1024
+# Seconds a keep-alive connection may stay idle before its next request.
+DEFAULT_IDLE_TIMEOUT = 5.0
+
+Receive = Callable[[], Awaitable[dict]]
+Send = Callable[[dict], Awaitable[None]]
+
+
+class WSGIToASGI:
+    """
+    ASGI 3 application running a WSGI application on a bounded thread pool.
+    The response is sent chunk by chunk as the WSGI iterable produces it, so streamed routes stay streamed.
+    ``on_startup`` runs on the pool at the lifespan startup, e.g. to open the database before the first request.
+
+    Requests to ``stream_paths`` run on a separate pool of ``max_streams`` threads, since their response
+    blocks a thread until the client leaves. Once every stream thread is taken, they are answered 503.
+    Request bodies over ``max_body_size`` bytes are answered 413 without running the app.
+    """
+
+    def __init__(
+        self: "WSGIToASGI",
+        wsgi_app: Callable,
+        max_workers: int = DEFAULT_WORKERS,
+        on_startup: Callable[[], object] | None = None,
+        stream_paths: Iterable[str] = DEFAULT_STREAM_PATHS,
+        max_streams: int = DEFAULT_MAX_STREAMS,
+        max_body_size: int = DEFAULT_MAX_BODY_SIZE,
+    ) -> None:
+        self.wsgi_app = wsgi_app
+        self.max_body_size = max_body_size
+        self.on_startup = on_startup
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="wsgi"
+        )
+        self.stream_paths = frozenset(stream_paths)
+        self.max_streams = max_streams
+        self.stream_executor = ThreadPoolExecutor(
+            max_workers=max_streams, thread_name_prefix="wsgi-stream"
+        )
+        # Only read and written on the event loop.
+        self._open_streams = 0
+
+    async def __call__(
+        self: "WSGIToASGI", scope: dict, receive: Receive, send: Send
+    ) -> None:
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self._http(scope, receive, send)
+        else:
+            raise ValueError(f"Unsupported ASGI scope type '{scope['type']}'")
+
+    async def _lifespan(self: "WSGIToASGI", receive: Receive, send: Send) -> None:
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                try:
+                    await self.startup()
+                except Exception as e:
+                    await send({"type": "lifespan.startup.failed", "message": str(e)})
+                    return
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                # Streams only end with their client, do not wait for them.
+                self.stream_executor.shutdown(wait=False, cancel_futures=True)
+                self.executor.shutdown(wait=True)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def startup(self: "WSGIToASGI") -> None:
+        """Run on_startup on the thread pool, so the event loop keeps serving meanwhile."""
+        if self.on_startup is not None:
+            await asyncio.get_running_loop().run_in_executor(
+                self.executor, self.on_startup
+            )
+
+    async def _http(
+        self: "WSGIToASGI", scope: dict, receive: Receive, send: Send
+    ) -> None:
+        if scope["path"] not in self.stream_paths:
+            await self._run(scope, receive, send, self.executor)
+            return
+        if self._open_streams >= self.max_streams:
+            await self._send_error(
+                send,
+                503,
+                "Too many open streams, retry later",
+                [(b"retry-after", b"5")],
+            )
+            return
+        self._open_streams += 1
+        try:
+            await self._run(scope, receive, send, self.stream_executor)
+        finally:
+            self._open_streams -= 1
+
+    @staticmethod
+    async def _send_error(
+        send: Send,
+        status: int,
+        message: str,
+        headers: list[tuple[bytes, bytes]] | None = None,
+    ) -> None:
+        body = ('{"message":"%s","success":false}' % message).encode("latin-1")
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status,
+                "headers": [
+                    (b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode("latin-1")),
+                    *(headers or []),
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": body, "more_body": False})
+
+    async def _run(
+        self: "WSGIToASGI",
+        scope: dict,
+        receive: Receive,
+        send: Send,
+        executor: ThreadPoolExecutor,
+    ) -> None:
+        body = bytearray()
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            body += message.get("body", b"")
+            if len(body) > self.max_body_size:
+                await self._send_error(send, 413, "Request body too large")
+                return
+            if not message.get("more_body", False):
+                break
+
+        response_start = {}
+
+        def start_response(
+            status: str, headers: list[tuple[str, str]], exc_info: tuple = None
+        ) -> Callable[[bytes], None]:
+            response_start["status"] = int(status.split(" ", 1)[0])
+            response_start["headers"] = [
+                (name.lower().encode("latin-1"), value.encode("latin-1"))
+                for name, value in headers
+            ]
+            return lambda data: None
+
+        def start() -> tuple[Iterable[bytes], Iterator[bytes], bytes | None]:
+            # start_response may only be called once the first chunk is produced.
+            chunks = self.wsgi_app(self._environ(scope, bytes(body)), start_response)
+            chunk_iterator = iter(chunks)
+            return chunks, chunk_iterator, next(chunk_iterator, None)
+
+        # Every step of a request runs in the same context, like it would on a single WSGI thread.
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+
+        def run_in_context(function: Callable, *args: tuple) -> Awaitable:
+            return loop.run_in_executor(executor, context.run, function, *args)
+
+        chunks, chunk_iterator, chunk = await run_in_context(start)
+        try:
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": response_start["status"],
+                    "headers": response_start["headers"],
+                }
+            )
+            while chunk is not None:
+                if chunk:
+                    await send(
+                        {"type": "http.response.body", "body": chunk, "more_body": True}
+                    )
+                chunk = await run_in_context(next, chunk_iterator, None)
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        finally:
+            if hasattr(chunks, "close"):
+                await run_in_context(chunks.close)
+
+    @staticmethod
+    def _environ(scope: dict, body: bytes) -> dict:
+        server_name, server_port = scope.get("server") or ("localhost", DEFAULT_PORT)
+        environ = {
+            "REQUEST_METHOD": scope["method"],
+            "SCRIPT_NAME": scope.get("root_path", ""),
+            "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+            "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+            "SERVER_NAME": server_name,
+            "SERVER_PORT": str(server_port),
+            "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+            "CONTENT_LENGTH": str(len(body)),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": scope.get("scheme", "http"),
+            "wsgi.input": io.BytesIO(body),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+        }
+        if scope.get("client"):
+            environ["REMOTE_ADDR"], environ["REMOTE_PORT"] = (
+                scope["client"][0],
+                str(scope["client"][1]),
+            )
+        for name, value in scope["headers"]:
+            name = name.decode("latin-1").upper().replace("-", "_")
+            value = value.decode("latin-1")
+            if name == "CONTENT_TYPE":
+                environ["CONTENT_TYPE"] = value
+            elif name != "CONTENT_LENGTH":
+                key = "HTTP_" + name
+                environ[key] = f"{environ[key]},{value}" if key in environ else value
+        return environ
+
+
+def create_asgi_app(config: dict | None = None) -> WSGIToASGI:
+    """
+    Create the API app served from asyncio, the database is opened at the lifespan startup.
+    Write coalescing pays off under the concurrency this entry point is meant for,
+    so COALESCE_WRITES defaults to true here, unless set by the environment or the .env file.
+
+    Parameters:
+        config (dict | None): Settings of the Flask app, see app.create_app.
+
+    Returns:
+        WSGIToASGI: The ASGI app.
+    """
+    load_dotenv()
+    flask_app = create_app(
+        {
+            "COALESCE_WRITES": os.getenv("COALESCE_WRITES", "true").lower() == "true",
+            **(config or {}),
+        }
+    )
+    return WSGIToASGI(
+        flask_app,
+        int(os.getenv("ASGI_WORKERS", DEFAULT_WORKERS)),
+        on_startup=get_app_state(flask_app).load,
+        max_streams=int(os.getenv("ASGI_MAX_STREAMS", DEFAULT_MAX_STREAMS)),
+        max_body_size=int(os.getenv("ASGI_MAX_BODY_SIZE", DEFAULT_MAX_BODY_SIZE)),
+    )
+
+
+def main() -> int:
+    try:
+        import uvicorn
+    except ImportError:
+        print(
+            "Serving the API from asyncio requires an ASGI server: pip install uvicorn",
+            file=sys.stderr,
+        )
+        return 1
+    uvicorn.run(
+        create_asgi_app(),
+        host=os.getenv("ASGI_HOST", "127.0.0.1"),
+        port=int(os.getenv("ASGI_PORT", DEFAULT_PORT)),
+        timeout_keep_alive=float(os.getenv("ASGI_IDLE_TIMEOUT", DEFAULT_IDLE_TIMEOUT)),
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
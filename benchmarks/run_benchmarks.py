@@ -0,0 +1,477 @@
+"""
+Latency benchmarks of the vending machine service and API against seeded fleets.
+
+Run from the project root:
+    python -m benchmarks.run_benchmarks --sizes 1000 10000 100000 --output results.json
+    python -m benchmarks.run_benchmarks --sizes 1000 --compare baseline.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator
+
+from flask import Flask
+
+from app import create_app
+from database import fast_json
+from database.db_manager import get_machine_repository
+from services.vending_machine_service import VendingMachineService
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+DEFAULT_REPEAT = 200
+DEFAULT_TIME_BUDGET = 2.0
+DEFAULT_REGRESSION_THRESHOLD = 0.2
+ITEM_NAMES = [f"sku{index:03d}" for index in range(200)]
+LOCATION_COUNT = 100
+ITEMS_PER_MACHINE = (5, 20)
+MAX_AMOUNT = 50
+
+
+def build_fleet(size: int, seed: int = 0) -> list[dict]:
+    """
+    Build a fleet of vending machines spread over LOCATION_COUNT locations,
+    each holding 5 to 20 items drawn from a catalog of 200 items.
+
+    Parameters:
+        size (int): The number of vending machines.
+        seed (int): Seed of the random generator, the same seed builds the same fleet.
+
+    Returns:
+        List[dict]: The vending machines.
+    """
+    generator = random.Random(seed)
+    return [
+        {
+            "name": f"ven{index}",
+            "location": f"loc{generator.randrange(LOCATION_COUNT)}",
+            "items": {
+                item_name: generator.randrange(MAX_AMOUNT)
+                for item_name in generator.sample(
+                    ITEM_NAMES, generator.randint(*ITEMS_PER_MACHINE)
+                )
+            },
+        }
+        for index in range(size)
+    ]
+
+
+def peak_rss_kb() -> int | None:
+    """Returns the peak resident set size of the process in KiB, None where it is unavailable."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux reports KiB.
+    return peak_rss // 1024 if sys.platform == "darwin" else peak_rss
+
+
+def measure(
+    name: str,
+    operation: Callable[[int], object],
+    repeat: int = DEFAULT_REPEAT,
+    time_budget: float = DEFAULT_TIME_BUDGET,
+) -> dict:
+    """
+    Run an operation up to ``repeat`` times, stopping early once ``time_budget`` seconds are spent.
+
+    Parameters:
+        name (str): The name of the operation in the results.
+        operation (Callable[[int], object]): The operation, called with the index of the run.
+        repeat (int): The maximum number of runs.
+        time_budget (float): The maximum number of seconds spent running the operation.
+
+    Returns:
+        dict: The 'name', number of 'runs', 'p50_ms', 'p99_ms', 'mean_ms' and 'ops_per_sec' of the operation.
+    """
+    durations = []
+    deadline = time.perf_counter() + time_budget
+    for index in range(repeat):
+        start = time.perf_counter()
+        operation(index)
+        durations.append(time.perf_counter() - start)
+        if time.perf_counter() > deadline:
+            break
+    durations.sort()
+    return {
+        "name": name,
+        "runs": len(durations),
+        "p50_ms": durations[len(durations) // 2] * 1000,
+        "p99_ms": durations[min(len(durations) - 1, len(durations) * 99 // 100)] * 1000,
+        "mean_ms": statistics.fmean(durations) * 1000,
+        "ops_per_sec": len(durations) / sum(durations) if sum(durations) else None,
+    }
+
+
+def service_operations(
+    machine_service: VendingMachineService, fleet: list[dict]
+) -> dict[str, Callable[[int], object]]:
+    """Returns the benchmarked service calls by name, each spreading its runs over the seeded fleet."""
+
+    def machine_of(index: int) -> dict:
+        return fleet[index * 7919 % len(fleet)]
+
+    def name_of(index: int) -> str:
+        return machine_of(index)["name"]
+
+    def first_item_of(index: int) -> str:
+        return next(iter(machine_of(index)["items"]))
+
+    def create_and_delete(index: int) -> None:
+        machine_service.create_new_vending_machine(f"bench{index}", "loc0")
+        machine_service.delete_vending_machine_by_name(f"bench{index}")
+
+    return {
+        "get_vending_machine_info": lambda index: (
+            machine_service.get_vending_machine_info(name_of(index))
+        ),
+        "get_all_vending_machine_info": lambda index: (
+            machine_service.get_all_vending_machine_info()
+        ),
+        "get_vending_machine_page": lambda index: (
+            machine_service.get_vending_machine_page(offset=index % 10 * 100)
+        ),
+        "get_all_vending_machine_info_filtered": lambda index: (
+            machine_service.get_all_vending_machine_info(
+                item_name=ITEM_NAMES[index % len(ITEM_NAMES)], below=5
+            )
+        ),
+        "get_vending_machines_by_location": lambda index: (
+            machine_service.get_vending_machines_by_location(
+                f"loc{index % LOCATION_COUNT}"
+            )
+        ),
+        "get_low_stock_items": lambda index: (
+            machine_service.get_low_stock_items(below=5, count=100)
+        ),
+        "get_inventory_aggregates": lambda index: (
+            machine_service.get_inventory_aggregates()
+        ),
+        "add_vending_machine_item": lambda index: (
+            machine_service.add_vending_machine_item(name_of(index), "bench", 1)
+        ),
+        "edit_vending_machine_item_amount": lambda index: (
+            machine_service.edit_vending_machine_item_amount(
+                name_of(index), first_item_of(index), 5
+            )
+        ),
+        "change_vending_machine_location": lambda index: (
+            machine_service.change_vending_machine_location(
+                name_of(index), f"loc{index % LOCATION_COUNT}"
+            )
+        ),
+        "bulk_update_vending_machine_items": lambda index: (
+            machine_service.bulk_update_vending_machine_items(
+                [
+                    {"name": name_of(index + offset), "item": "bench", "delta": 1}
+                    for offset in range(10)
+                ]
+            )
+        ),
+        "create_and_delete_vending_machine": create_and_delete,
+    }
+
+
+def api_operations(app: Flask, fleet: list[dict]) -> dict[str, Callable[[int], object]]:
+    """Returns the benchmarked routes by name, called through the Flask test client."""
+    client = app.test_client()
+
+    def name_of(index: int) -> str:
+        return fleet[index * 7919 % len(fleet)]["name"]
+
+    def post(route: str, data: dict) -> None:
+        response = client.post(route, json=data)
+        assert response.status_code == 200, response.data
+
+    def get(route: str) -> None:
+        response = client.get(route)
+        assert response.status_code == 200, response.data
+
+    return {
+        "POST /api/machine/get-machine": lambda index: (
+            post("/api/machine/get-machine", {"name": name_of(index)})
+        ),
+        "GET /api/machine/get-all-machine": lambda index: (
+            get("/api/machine/get-all-machine")
+        ),
+        "GET /api/machine/get-all-machine?limit=100": lambda index: (
+            get(f"/api/machine/get-all-machine?limit=100&offset={index % 10 * 100}")
+        ),
+        "GET /api/machine/get-all-machine?format=ndjson": lambda index: (
+            get("/api/machine/get-all-machine?format=ndjson")
+        ),
+        "POST /api/location/get-machines": lambda index: (
+            post(
+                "/api/location/get-machines",
+                {"location": f"loc{index % LOCATION_COUNT}"},
+            )
+        ),
+        "GET /api/item/low-stock": lambda index: (
+            get("/api/item/low-stock?below=5&count=100")
+        ),
+        "GET /api/item/aggregates": lambda index: get("/api/item/aggregates"),
+        "POST /api/item/add-item": lambda index: (
+            post("/api/item/add-item", {"name": name_of(index), "items": {"bench": 1}})
+        ),
+        "POST /api/item/bulk-update": lambda index: (
+            post(
+                "/api/item/bulk-update",
+                {
+                    "operations": [
+                        {"name": name_of(index + offset), "item": "bench", "delta": 1}
+                        for offset in range(10)
+                    ]
+                },
+            )
+        ),
+    }
+
+
+def serialization_operations(fleet: list[dict]) -> dict[str, Callable[[int], object]]:
+    """
+    Returns the encoding and decoding of the fleet as a TinyDB file and as the get-all-machine response,
+    by name, with every JSON backend available.
+    """
+    table = {
+        "_default": {str(index): machine for index, machine in enumerate(fleet, 1)}
+    }
+    response = {"message": fleet, "success": True}
+
+    def backend_operations(backend: str) -> dict[str, Callable[[int], object]]:
+        encoded_table = fast_json.dumps(table, backend=backend)
+        return {
+            f"json[{backend}] encode database file": lambda index: (
+                fast_json.dumps(table, backend=backend)
+            ),
+            f"json[{backend}] decode database file": lambda index: (
+                fast_json.loads(encoded_table, backend=backend)
+            ),
+            f"json[{backend}] encode get-all-machine response": lambda index: (
+                fast_json.dumps(response, sort_keys=True, backend=backend)
+            ),
+        }
+
+    operations = {}
+    for backend in fast_json.available_backends():
+        operations.update(backend_operations(backend))
+    return operations
+
+
+@contextmanager
+def serving(machine_service: VendingMachineService) -> Iterator[Flask]:
+    """Yields an app whose routes serve the given service."""
+    yield create_app({"MACHINE_SERVICE": machine_service})
+
+
+def run_size(
+    size: int,
+    backend: str,
+    repeat: int = DEFAULT_REPEAT,
+    time_budget: float = DEFAULT_TIME_BUDGET,
+    include_api: bool = True,
+) -> dict:
+    """
+    Seed a fresh database with ``size`` vending machines and measure every operation against it.
+
+    Parameters:
+        size (int): The number of vending machines.
+        backend (str): The database backend, see get_machine_repository.
+        repeat (int): The maximum number of runs of each operation.
+        time_budget (float): The maximum number of seconds spent on each operation.
+        include_api (bool): Also measure the Flask routes.
+
+    Returns:
+        dict: The 'size', 'seed_seconds', 'startup_seconds', 'peak_rss_kb' and the 'operations' measurements.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        repository = get_machine_repository(directory + "/", backend=backend)
+        fleet = build_fleet(size)
+        start = time.perf_counter()
+        repository.insert_many(fleet)
+        seed_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        machine_service = VendingMachineService(repository)
+        startup_seconds = time.perf_counter() - start
+
+        operations = [
+            measure(name, operation, repeat, time_budget)
+            for name, operation in service_operations(machine_service, fleet).items()
+        ]
+        operations += [
+            measure(name, operation, repeat, time_budget)
+            for name, operation in serialization_operations(fleet).items()
+        ]
+        if include_api:
+            with serving(machine_service) as app:
+                operations += [
+                    measure(name, operation, repeat, time_budget)
+                    for name, operation in api_operations(app, fleet).items()
+                ]
+        repository.close()
+
+    return {
+        "size": size,
+        "seed_seconds": seed_seconds,
+        "startup_seconds": startup_seconds,
+        "peak_rss_kb": peak_rss_kb(),
+        "operations": operations,
+    }
+
+
+def current_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(
+    sizes: list[int],
+    backend: str,
+    repeat: int = DEFAULT_REPEAT,
+    time_budget: float = DEFAULT_TIME_BUDGET,
+    include_api: bool = True,
+) -> dict:
+    """
+    Run the benchmarks for every fleet size.
+
+    Parameters:
+        sizes (list[int]): The fleet sizes, measured in the given order.
+        backend (str): The database backend, see get_machine_repository.
+        repeat (int): The maximum number of runs of each operation.
+        time_budget (float): The maximum number of seconds spent on each operation.
+        include_api (bool): Also measure the Flask routes.
+
+    Returns:
+        dict: The run environment and the 'results' of each size.
+    """
+    return {
+        "commit": current_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "backend": backend,
+        "storage": os.getenv("DB_STORAGE") or "json",
+        "results": [
+            run_size(size, backend, repeat, time_budget, include_api) for size in sizes
+        ],
+    }
+
+
+def compare_results(
+    baseline: dict,
+    current: dict,
+    threshold: float = DEFAULT_REGRESSION_THRESHOLD,
+) -> list[dict]:
+    """
+    Compare the p50 latency of every operation measured in both runs, for the sizes present in both.
+
+    Parameters:
+        baseline (dict): The results of the reference run.
+        current (dict): The results of the new run.
+        threshold (float): The relative p50 increase above which an operation is a regression.
+
+    Returns:
+        List[dict]: The 'size', 'name', 'baseline_p50_ms', 'current_p50_ms', 'ratio' and 'regression'
+        flag of every operation.
+    """
+    baseline_p50 = {
+        (result["size"], operation["name"]): operation["p50_ms"]
+        for result in baseline["results"]
+        for operation in result["operations"]
+    }
+    comparisons = []
+    for result in current["results"]:
+        for operation in result["operations"]:
+            key = (result["size"], operation["name"])
+            if key not in baseline_p50:
+                continue
+            ratio = (
+                operation["p50_ms"] / baseline_p50[key] if baseline_p50[key] else None
+            )
+            comparisons.append(
+                {
+                    "size": result["size"],
+                    "name": operation["name"],
+                    "baseline_p50_ms": baseline_p50[key],
+                    "current_p50_ms": operation["p50_ms"],
+                    "ratio": ratio,
+                    "regression": ratio is not None and ratio > 1 + threshold,
+                }
+            )
+    return comparisons
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument(
+        "--backend",
+        default=os.getenv("DB_BACKEND") or "tinydb",
+        help="tinydb, sqlite, log or sharded",
+    )
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT)
+    parser.add_argument(
+        "--time-budget",
+        type=float,
+        default=DEFAULT_TIME_BUDGET,
+        help="seconds spent at most on each operation",
+    )
+    parser.add_argument("--no-api", action="store_true", help="skip the Flask routes")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument(
+        "--compare", metavar="BASELINE", help="results file to compare the run against"
+    )
+    parser.add_argument("--threshold", type=float, default=DEFAULT_REGRESSION_THRESHOLD)
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(
+        args.sizes, args.backend, args.repeat, args.time_budget, not args.no_api
+    )
+    with open(args.output, "w", encoding="utf-8") as handle:
+        json.dump(results, handle, indent=2)
+
+    for result in results["results"]:
+        print(
+            f"size={result['size']} seed={result['seed_seconds']:.2f}s "
+            f"startup={result['startup_seconds']:.2f}s peak_rss={result['peak_rss_kb']}KiB"
+        )
+        for operation in result["operations"]:
+            print(
+                f"  {operation['name']:<50} p50={operation['p50_ms']:9.3f}ms "
+                f"p99={operation['p99_ms']:9.3f}ms runs={operation['runs']}"
+            )
+
+    if args.compare is None:
+        return 0
+    with open(args.compare, encoding="utf-8") as handle:
+        baseline = json.load(handle)
+    regressions = [
+        comparison
+        for comparison in compare_results(baseline, results, args.threshold)
+        if comparison["regression"]
+    ]
+    for comparison in regressions:
+        print(
+            f"REGRESSION size={comparison['size']} {comparison['name']}: "
+            f"{comparison['baseline_p50_ms']:.3f}ms -> {comparison['current_p50_ms']:.3f}ms"
+        )
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,249 @@
+"""
+Compact binary snapshot of the vending machines, memory-mapped when opened and decoded one machine at a time.
+
+Layout, little-endian:
+    header   magic, sequence, next id, number of records, offset of the string table, offset of the index
+    records  one per machine, a 4 bytes length followed by the machine id, its name, the string id of its
+             location, a flag, the number of items, the string ids of the items and their amounts
+    strings  the locations and item names, each stored once and referenced by id from the records
+    index    the offset of every record, in the order the records were written
+
+Amounts are packed as signed 64 bits integers; a machine holding another value or a larger integer has
+its amounts stored as a JSON list instead, flagged by AMOUNTS_JSON.
+"""
+
+import mmap
+import os
+import struct
+import sys
+from array import array
+from typing import Iterable, Iterator
+
+from database import fast_json
+
+MAGIC = b"VMSNAP1\x00"
+_HEADER = struct.Struct("<8sQQQQQ")
+_LENGTH = struct.Struct("<I")
+_RECORD_START = struct.Struct("<QI")
+_RECORD_ITEMS = struct.Struct("<IBI")
+AMOUNTS_PACKED = 0
+AMOUNTS_JSON = 1
+
+
+def _native(values: array) -> array:
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
+
+def is_snapshot(path: str) -> bool:
+    """Returns whether the file at path starts like a binary snapshot."""
+    with open(path, "rb") as handle:
+        return handle.read(len(MAGIC)) == MAGIC
+
+
+def write_snapshot(
+    path: str,
+    vending_machines: Iterable[tuple[int, dict]],
+    sequence: int = 0,
+    next_id: int | None = None,
+) -> int:
+    """
+    Write a binary snapshot, to a temporary file first, synced and then renamed over path,
+    so readers see either the previous snapshot or the complete new one.
+
+    Parameters:
+        path (str): The snapshot file.
+        vending_machines (Iterable[tuple[int, dict]]): The (id, vending machine) pairs, in the order to keep.
+        sequence (int): The sequence number of the last change the snapshot contains.
+        next_id (int | None): The id of the next vending machine created, after the largest id by default.
+
+    Returns:
+        int: The size of the snapshot in bytes.
+    """
+    string_ids: dict[str, int] = {}
+    offsets = array("Q")
+    largest_id = 0
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as handle:
+        handle.write(_HEADER.pack(MAGIC, 0, 0, 0, 0, 0))
+        for machine_id, vending_machine in vending_machines:
+            largest_id = max(largest_id, machine_id)
+            items = vending_machine["items"]
+            sku_ids = array(
+                "I",
+                [string_ids.setdefault(name, len(string_ids)) for name in items],
+            )
+            try:
+                amounts = _native(array("q", items.values())).tobytes()
+                flag = AMOUNTS_PACKED
+            except (TypeError, OverflowError):
+                amounts = fast_json.dumps(list(items.values()))
+                amounts = _LENGTH.pack(len(amounts)) + amounts
+                flag = AMOUNTS_JSON
+            name = vending_machine["name"].encode("utf-8")
+            location_id = string_ids.setdefault(
+                vending_machine["location"], len(string_ids)
+            )
+            payload = b"".join(
+                [
+                    _RECORD_START.pack(machine_id, len(name)),
+                    name,
+                    _RECORD_ITEMS.pack(location_id, flag, len(sku_ids)),
+                    _native(sku_ids).tobytes(),
+                    amounts,
+                ]
+            )
+            offsets.append(handle.tell())
+            handle.write(_LENGTH.pack(len(payload)) + payload)
+
+        strings_offset = handle.tell()
+        handle.write(_LENGTH.pack(len(string_ids)))
+        for string in string_ids:
+            encoded = string.encode("utf-8")
+            handle.write(_LENGTH.pack(len(encoded)) + encoded)
+        index_offset = handle.tell()
+        handle.write(_native(offsets).tobytes())
+        size = handle.tell()
+
+        handle.seek(0)
+        handle.write(
+            _HEADER.pack(
+                MAGIC,
+                sequence,
+                largest_id + 1 if next_id is None else next_id,
+                len(offsets),
+                strings_offset,
+                index_offset,
+            )
+        )
+        handle.flush()
+        os.fsync(handle.fileno())
+    os.replace(temp_path, path)
+    return size
+
+
+class BinarySnapshot:
+    """
+    Read-only view of a binary snapshot. Opening it maps the file and reads the header and string table,
+    every vending machine is decoded only when read, so opening costs the number of distinct
+    locations and items instead of the size of the fleet.
+    """
+
+    def __init__(self: "BinarySnapshot", path: str) -> None:
+        with open(path, "rb") as handle:
+            self.size = os.fstat(handle.fileno()).st_size
+            if self.size < _HEADER.size:
+                raise ValueError(f"'{path}' is not a vending machine snapshot")
+            self._map = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.sequence, self.next_id, count, strings_offset, index_offset = (
+            _HEADER.unpack_from(self._map)
+        )
+        if magic != MAGIC:
+            self._map.close()
+            raise ValueError(f"'{path}' is not a vending machine snapshot")
+
+        (string_count,) = _LENGTH.unpack_from(self._map, strings_offset)
+        position = strings_offset + _LENGTH.size
+        self._strings: list[str] = []
+        for _ in range(string_count):
+            (length,) = _LENGTH.unpack_from(self._map, position)
+            position += _LENGTH.size
+            self._strings.append(
+                sys.intern(self._map[position : position + length].decode("utf-8"))
+            )
+            position += length
+        offsets = array("Q")
+        offsets.frombytes(self._map[index_offset : index_offset + 8 * count])
+        self._offsets = _native(offsets)
+
+    def __len__(self: "BinarySnapshot") -> int:
+        return len(self._offsets)
+
+    def read_key(self: "BinarySnapshot", index: int) -> tuple[int, str]:
+        """
+        Decode the id and name of a vending machine, without its location and items.
+
+        Parameters:
+            index (int): The position of the record in the snapshot.
+
+        Returns:
+            tuple[int, str]: The id and name of the vending machine.
+        """
+        position = self._offsets[index] + _LENGTH.size
+        machine_id, name_length = _RECORD_START.unpack_from(self._map, position)
+        position += _RECORD_START.size
+        return machine_id, self._map[position : position + name_length].decode("utf-8")
+
+    def read_row(
+        self: "BinarySnapshot", index: int
+    ) -> tuple[int, str, str, list[str], array | list]:
+        """
+        Decode a vending machine without building its document, the item names are the snapshot's own
+        interned strings and the amounts are the packed array when the record holds one.
+
+        Parameters:
+            index (int): The position of the record in the snapshot.
+
+        Returns:
+            tuple[int, str, str, list[str], array | list]: The id, name and location of the vending machine,
+            the names of its items and their amounts, in the same order.
+        """
+        mapped = self._map
+        position = self._offsets[index] + _LENGTH.size
+        machine_id, name_length = _RECORD_START.unpack_from(mapped, position)
+        position += _RECORD_START.size
+        name = mapped[position : position + name_length].decode("utf-8")
+        position += name_length
+        location_id, flag, item_count = _RECORD_ITEMS.unpack_from(mapped, position)
+        position += _RECORD_ITEMS.size
+
+        sku_ids = array("I")
+        sku_ids.frombytes(mapped[position : position + 4 * item_count])
+        _native(sku_ids)
+        position += 4 * item_count
+        if flag == AMOUNTS_PACKED:
+            amounts = array("q")
+            amounts.frombytes(mapped[position : position + 8 * item_count])
+            _native(amounts)
+        else:
+            (length,) = _LENGTH.unpack_from(mapped, position)
+            position += _LENGTH.size
+            amounts = fast_json.loads(mapped[position : position + length])
+        return (
+            machine_id,
+            name,
+            self._strings[location_id],
+            list(map(self._strings.__getitem__, sku_ids)),
+            amounts,
+        )
+
+    def read(self: "BinarySnapshot", index: int) -> tuple[int, dict]:
+        """
+        Decode a vending machine.
+
+        Parameters:
+            index (int): The position of the record in the snapshot.
+
+        Returns:
+            tuple[int, dict]: The id of the vending machine and a new dictionary holding it.
+        """
+        machine_id, name, location, item_names, amounts = self.read_row(index)
+        return machine_id, {
+            "name": name,
+            "location": location,
+            "items": dict(zip(item_names, amounts)),
+        }
+
+    def keys(self: "BinarySnapshot") -> Iterator[tuple[int, str]]:
+        """Yields the id and name of every vending machine, in the snapshot order."""
+        for index in range(len(self._offsets)):
+            yield self.read_key(index)
+
+    def __iter__(self: "BinarySnapshot") -> Iterator[tuple[int, dict]]:
+        """Yields the id and document of every vending machine, in the snapshot order."""
+        for index in range(len(self._offsets)):
+            yield self.read(index)
+
+    def close(self: "BinarySnapshot") -> None:
+        self._map.close()
@@ -1,11 +1,431 @@
+import atexit
+import json
+import os
+import threading
+
 from tinydb import TinyDB
+from tinydb.middlewares import Middleware
+from tinydb.storages import JSONStorage, Storage, touch
+
+from database import fast_json
+from database.log_repository import (
+    DEFAULT_COMPACT_SIZE,
+    DEFAULT_SYNC_INTERVAL,
+    LogMachineRepository,
+)
+from database.machine_repository import (
+    MachineRepository,
+    TinyDBMachineRepository,
+    record_io,
+)
+from database.sharded_repository import PARTITIONS, ShardedMachineRepository
+from database.shared_repository import SharedMachineRepository
+from database.sqlite_repository import SQLiteMachineRepository
+
+DEFAULT_FLUSH_INTERVAL = 1.0
+DEFAULT_WRITE_CACHE_SIZE = 1000
+DEFAULT_COMMIT_INTERVAL = 0.005
+DEFAULT_COMMIT_SIZE = 100
+DEFAULT_SHARD_COUNT = 4
+SHARD_MANIFEST = "shards.json"
+
+
+def _record_read(content_size: int, data: dict | None) -> None:
+    # Every read decodes the whole file, so each document of every table is scanned.
+    record_io(
+        bytes_read=content_size,
+        documents_scanned=sum(len(table) for table in (data or {}).values()),
+    )
+
+
+class AtomicJSONStorage(Storage):
+    """
+    JSON storage that never leaves a partially written file behind.
+    Data is written to a temporary file next to the database and then moved over it,
+    so a crash in the middle of a write keeps the previous content intact.
+    Without formatting arguments, it is encoded with database.fast_json.
+    """
+
+    def __init__(self: "AtomicJSONStorage", path: str, **kwargs: dict) -> None:
+        touch(path, create_dirs=True)
+        self._path = path
+        self.kwargs = kwargs
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def read(self: "AtomicJSONStorage") -> dict | None:
+        with open(self._path, "rb") as handle:
+            content = handle.read()
+            self.bytes_read += len(content)
+        if not content:
+            return None
+        data = fast_json.loads(content)
+        _record_read(len(content), data)
+        return data
+
+    def write(self: "AtomicJSONStorage", data: dict) -> None:
+        temp_path = self._path + ".tmp"
+        if self.kwargs:
+            content = json.dumps(data, **self.kwargs).encode("utf-8")
+        else:
+            content = fast_json.dumps(data)
+        with open(temp_path, "wb") as handle:
+            handle.write(content)
+            handle.flush()
+            os.fsync(handle.fileno())
+            size = os.fstat(handle.fileno()).st_size
+            self.bytes_written += size
+            record_io(bytes_written=size)
+        os.replace(temp_path, self._path)
+
+
+class MeteredJSONStorage(JSONStorage):
+    """
+    TinyDB's JSONStorage counting the bytes it reads from and writes to the database file.
+    It reads and rewrites the whole file on every call, so the file size is the bytes transferred.
+    Without formatting arguments, it is encoded with database.fast_json.
+    """
+
+    def __init__(self: "MeteredJSONStorage", *args: tuple, **kwargs: dict) -> None:
+        kwargs.setdefault("encoding", "utf-8")
+        super().__init__(*args, **kwargs)
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def read(self: "MeteredJSONStorage") -> dict | None:
+        self._handle.seek(0)
+        content = self._handle.read()
+        size = self._handle.tell()
+        self.bytes_read += size
+        if not content:
+            return None
+        data = fast_json.loads(content)
+        _record_read(size, data)
+        return data
+
+    def write(self: "MeteredJSONStorage", data: dict) -> None:
+        if self.kwargs:
+            super().write(data)
+        else:
+            self._handle.seek(0)
+            self._handle.write(fast_json.dumps(data).decode("utf-8"))
+            self._handle.flush()
+            os.fsync(self._handle.fileno())
+            self._handle.truncate()
+        self.bytes_written += self._handle.tell()
+        record_io(bytes_written=self._handle.tell())
+
+
+class WriteBackCachingMiddleware(Middleware):
+    """
+    Read-through, write-back cache in front of a TinyDB storage.
+
+    The whole database is kept in memory after the first read. Writes only touch memory
+    and are flushed to the underlying storage when ``write_cache_size`` dirty writes
+    have accumulated, every ``flush_interval`` seconds, and when the database is closed
+    or the interpreter exits.
+
+    ``lock`` guards the cache and every flush. Callers that mutate the cached data between
+    a read and a write must hold it, so a background flush never serializes a half-applied change.
+
+    ``read`` returns the cached data itself, not a copy, like TinyDB's own CachingMiddleware: TinyDB mutates
+    it in place before writing it back. Documents TinyDB builds from it are shallow copies, their nested
+    values such as the items of a vending machine are the cached ones, so mutating them changes what is flushed.
+    TinyDBMachineRepository copies every document it returns or stores for that reason.
+    """
+
+    def __init__(
+        self: "WriteBackCachingMiddleware",
+        storage_cls: type[Storage],
+        flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+        write_cache_size: int = DEFAULT_WRITE_CACHE_SIZE,
+    ) -> None:
+        super().__init__(storage_cls)
+        self.flush_interval = flush_interval
+        self.write_cache_size = write_cache_size
+        self.cache = None
+        self._dirty_writes = 0
+        self.lock = threading.RLock()
+        self._stop_event = threading.Event()
+        self._flush_thread = None
+
+    def __call__(
+        self: "WriteBackCachingMiddleware", *args: tuple, **kwargs: dict
+    ) -> "WriteBackCachingMiddleware":
+        super().__call__(*args, **kwargs)
+        if self.flush_interval and self.flush_interval > 0:
+            self._flush_thread = threading.Thread(
+                target=self._flush_periodically, daemon=True
+            )
+            self._flush_thread.start()
+        atexit.register(self.flush)
+        return self
+
+    def read(self: "WriteBackCachingMiddleware") -> dict | None:
+        with self.lock:
+            if self.cache is None:
+                self.cache = self.storage.read()
+            return self.cache
+
+    def write(self: "WriteBackCachingMiddleware", data: dict) -> None:
+        with self.lock:
+            self.cache = data
+            self._dirty_writes += 1
+            if self._dirty_writes >= self.write_cache_size:
+                self.flush()
+
+    @property
+    def dirty_writes(self: "WriteBackCachingMiddleware") -> int:
+        return self._dirty_writes
+
+    def flush(self: "WriteBackCachingMiddleware") -> None:
+        """
+        Write the cached data to the underlying storage if there are pending writes.
+        The dirty counter is only reset once the storage write succeeded, so a failed
+        flush is retried on the next trigger.
+
+        Returns:
+            None
+        """
+        with self.lock:
+            if self._dirty_writes == 0 or self.cache is None:
+                return
+            self.storage.write(self.cache)
+            self._dirty_writes = 0
+
+    def _flush_periodically(self: "WriteBackCachingMiddleware") -> None:
+        while not self._stop_event.wait(self.flush_interval):
+            try:
+                self.flush()
+            except OSError:
+                # Keep the pending writes, the next interval or close() will retry.
+                pass
+
+    def close(self: "WriteBackCachingMiddleware") -> None:
+        self._stop_event.set()
+        if self._flush_thread is not None:
+            self._flush_thread.join()
+        self.flush()
+        atexit.unregister(self.flush)
+        self.storage.close()
 
 
-def get_db(path: str) -> TinyDB:
-    db = TinyDB(path + "db.json")
+class GroupCommitMiddleware(WriteBackCachingMiddleware):
+    """
+    Write-back cache acknowledging writes only once they are durable, with group commit.
+
+    A write is applied to the cached data immediately and gets a generation number. Its caller then waits
+    in ``wait_durable`` for a flush covering that generation: the first waiter flushes once ``commit_interval``
+    seconds have passed without one, or right away when ``commit_size`` writes are pending. Writes made
+    meanwhile by other callers are flushed by the same storage write, so concurrent writers share one
+    rewrite of the database file instead of paying one each.
+
+    The caller must not hold ``lock`` while waiting, or no other write could join the batch.
+    """
+
+    def __init__(
+        self: "GroupCommitMiddleware",
+        storage_cls: type[Storage],
+        commit_interval: float = DEFAULT_COMMIT_INTERVAL,
+        commit_size: int = DEFAULT_COMMIT_SIZE,
+    ) -> None:
+        super().__init__(
+            storage_cls, flush_interval=commit_interval, write_cache_size=commit_size
+        )
+        self._write_generation = 0
+        self._durable_generation = 0
+        self._flushed = threading.Condition(self.lock)
+
+    def write(self: "GroupCommitMiddleware", data: dict) -> None:
+        with self.lock:
+            self._write_generation += 1
+            super().write(data)
+
+    @property
+    def write_generation(self: "GroupCommitMiddleware") -> int:
+        """The generation of the latest write, to pass to wait_durable."""
+        return self._write_generation
+
+    def flush(self: "GroupCommitMiddleware") -> None:
+        with self.lock:
+            generation = self._write_generation
+            super().flush()
+            self._durable_generation = generation
+            self._flushed.notify_all()
+
+    def wait_durable(self: "GroupCommitMiddleware", generation: int) -> None:
+        """
+        Wait until the write of the given generation has been flushed to the storage.
+
+        Parameters:
+            generation (int): The write_generation read right after the write.
+
+        Raises:
+            OSError: If this caller ended up flushing the batch and the storage write failed.
+
+        Returns:
+            None
+        """
+        with self._flushed:
+            if self._durable_generation >= generation:
+                return
+            self._flushed.wait(self.flush_interval)
+            if self._durable_generation < generation:
+                self.flush()
+
+
+def _build_storage(storage_name: str | None) -> type[Storage] | Middleware:
+    storage_name = (storage_name or os.getenv("DB_STORAGE") or "json").lower()
+    if storage_name == "json":
+        return MeteredJSONStorage
+    if storage_name == "cached":
+        return WriteBackCachingMiddleware(
+            AtomicJSONStorage,
+            flush_interval=float(
+                os.getenv("DB_FLUSH_INTERVAL", DEFAULT_FLUSH_INTERVAL)
+            ),
+            write_cache_size=int(
+                os.getenv("DB_WRITE_CACHE_SIZE", DEFAULT_WRITE_CACHE_SIZE)
+            ),
+        )
+    if storage_name == "group":
+        return GroupCommitMiddleware(
+            AtomicJSONStorage,
+            commit_interval=float(
+                os.getenv("DB_GROUP_COMMIT_INTERVAL", DEFAULT_COMMIT_INTERVAL)
+            ),
+            commit_size=int(os.getenv("DB_GROUP_COMMIT_SIZE", DEFAULT_COMMIT_SIZE)),
+        )
+    raise ValueError(f"Unknown database storage '{storage_name}'")
+
+
+def get_db(path: str, storage: str | None = None) -> TinyDB:
+    db = TinyDB(path + "db.json", storage=_build_storage(storage))
     return db
 
 
-def get_test_db(path: str) -> TinyDB:
-    test_db = TinyDB(path + "test_db.json")
+def get_test_db(path: str, storage: str | None = None) -> TinyDB:
+    test_db = TinyDB(path + "test_db.json", storage=_build_storage(storage))
     return test_db
+
+
+def get_shard_directory(path: str, test: bool = False) -> str:
+    return path + ("test_db_shards/" if test else "db_shards/")
+
+
+def get_sharded_repository(
+    directory: str,
+    shard_count: int | None = None,
+    partition: str | None = None,
+    storage: str | None = None,
+) -> ShardedMachineRepository:
+    """
+    Open the sharded vending machine repository stored in a directory, one TinyDB file per shard.
+    The shard count and partition are recorded in a manifest when the directory is created and taken
+    from it afterwards, since changing them requires moving the machines, see database/reshard.py.
+
+    Parameters:
+        directory (str): Directory holding the shard files, ending with a separator.
+        shard_count (int | None): The number of shards of a new directory, DB_SHARDS or 4 by default.
+        partition (str | None): 'name' or 'location' for a new directory, DB_SHARD_BY or 'name' by default.
+        storage (str | None): The TinyDB storage of each shard, DB_STORAGE by default.
+
+    Raises:
+        ValueError: If the shard count or partition is invalid.
+
+    Returns:
+        ShardedMachineRepository: The opened repository.
+    """
+    manifest_path = directory + SHARD_MANIFEST
+    if os.path.exists(manifest_path):
+        with open(manifest_path, encoding="utf-8") as handle:
+            manifest = json.load(handle)
+    else:
+        manifest = {
+            "partition": (partition or os.getenv("DB_SHARD_BY") or "name").lower(),
+            "count": int(shard_count or os.getenv("DB_SHARDS", DEFAULT_SHARD_COUNT)),
+        }
+        if manifest["partition"] not in PARTITIONS:
+            raise ValueError(
+                f"Unknown shard partition '{manifest['partition']}', must be 'name' or 'location'"
+            )
+        if manifest["count"] < 1:
+            raise ValueError("The number of shards must be at least 1")
+        os.makedirs(directory, exist_ok=True)
+        with open(manifest_path, "w", encoding="utf-8") as handle:
+            json.dump(manifest, handle)
+    shards = [
+        TinyDBMachineRepository(
+            TinyDB(
+                directory + f"shard-{index:03d}.json",
+                storage=_build_storage(storage),
+            )
+        )
+        for index in range(manifest["count"])
+    ]
+    return ShardedMachineRepository(shards, partition=manifest["partition"])
+
+
+def get_machine_repository(
+    path: str,
+    backend: str | None = None,
+    test: bool = False,
+    shared: bool | None = None,
+) -> MachineRepository:
+    """
+    Open the vending machine repository selected by ``backend`` or the DB_BACKEND setting.
+
+    Parameters:
+        path (str): Directory holding the database files.
+        backend (str | None): 'tinydb' (default), 'sqlite', 'log' or 'sharded'.
+        test (bool): Open the test database instead of the main one.
+        shared (bool | None): Share the database with other processes, e.g. the workers of a pre-fork server,
+            DB_MULTIPROCESS by default. See SharedMachineRepository.
+
+    Raises:
+        ValueError: If the backend is unknown, or cannot be shared between processes.
+
+    Returns:
+        MachineRepository: The opened repository.
+    """
+    backend = (backend or os.getenv("DB_BACKEND") or "tinydb").lower()
+    if shared is None:
+        shared = os.getenv("DB_MULTIPROCESS", "false").lower() == "true"
+    if not shared:
+        return _open_backend(path, backend, test)
+    if backend == "log":
+        raise ValueError(
+            "The 'log' backend keeps the machines in memory, it cannot be shared between processes"
+        )
+    if (
+        backend in ("tinydb", "sharded")
+        and (os.getenv("DB_STORAGE") or "json").lower() != "json"
+    ):
+        raise ValueError(
+            "Only the 'json' storage writes through to the files shared between processes"
+        )
+    return SharedMachineRepository(
+        lambda: _open_backend(path, backend, test),
+        path + ("test_db" if test else "db"),
+    )
+
+
+def _open_backend(path: str, backend: str, test: bool) -> MachineRepository:
+    if backend == "tinydb":
+        db = get_test_db(path) if test else get_db(path)
+        return TinyDBMachineRepository(db)
+    if backend == "sqlite":
+        file_name = "test_db.sqlite3" if test else "db.sqlite3"
+        return SQLiteMachineRepository(path + file_name)
+    if backend == "log":
+        return LogMachineRepository(
+            path + ("test_db" if test else "db"),
+            fsync=os.getenv("DB_LOG_FSYNC", "always"),
+            compact_size=int(os.getenv("DB_LOG_COMPACT_SIZE", DEFAULT_COMPACT_SIZE)),
+            sync_interval=float(
+                os.getenv("DB_LOG_SYNC_INTERVAL", DEFAULT_SYNC_INTERVAL)
+            ),
+        )
+    if backend == "sharded":
+        return get_sharded_repository(get_shard_directory(path, test))
+    raise ValueError(f"Unknown database backend '{backend}'")
@@ -0,0 +1,122 @@
+"""
+JSON encoding shared by the storage and the API, with orjson when it is installed.
+
+JSON_BACKEND selects the encoder: 'auto' (default) uses orjson when installed and the json module
+otherwise, 'orjson' requires it, 'json' always uses the json module. Both produce compact JSON.
+"""
+
+import gc
+import json
+import os
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+BACKENDS = ("json", "orjson")
+# orjson reads integers beyond 64 bits as floats, the vending machines may hold such amounts. They are found
+# as a run of 19 digits once every digit is mapped to '1', which is much faster than a regular expression.
+_DIGITS_TO_ONES = bytes.maketrans(b"0123456789", b"1" * 10)
+_LONG_INTEGER = b"1" * 19
+# Decoding creates containers only, the garbage collector passes it triggers over a large document are wasted.
+PAUSE_GC_SIZE = 1 << 20
+
+
+def available_backends() -> list[str]:
+    """Returns the JSON backends usable in this environment."""
+    return [backend for backend in BACKENDS if backend == "json" or orjson is not None]
+
+
+def select_backend(backend: str | None = None) -> str:
+    """
+    Resolve a JSON backend name.
+
+    Parameters:
+        backend (str | None): 'auto', 'json' or 'orjson', the JSON_BACKEND setting by default.
+
+    Raises:
+        ValueError: If the backend is unknown or not installed.
+
+    Returns:
+        str: 'json' or 'orjson'.
+    """
+    backend = (backend or os.getenv("JSON_BACKEND") or "auto").lower()
+    if backend == "auto":
+        return "orjson" if orjson is not None else "json"
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown JSON backend '{backend}'")
+    if backend not in available_backends():
+        raise ValueError(f"JSON backend '{backend}' is not installed")
+    return backend
+
+
+BACKEND = select_backend()
+
+
+def dumps(
+    obj: object,
+    sort_keys: bool = False,
+    default: object = None,
+    backend: str | None = None,
+) -> bytes:
+    """
+    Encode a value as compact UTF-8 JSON.
+
+    Parameters:
+        obj (object): The value to encode.
+        sort_keys (bool): Write the keys of every object in sorted order.
+        default (object): Function converting the values JSON cannot represent, as for json.dumps.
+        backend (str | None): 'json' or 'orjson', BACKEND by default.
+
+    Raises:
+        TypeError: If a value cannot be encoded.
+
+    Returns:
+        bytes: The encoded value.
+    """
+    if (backend or BACKEND) == "orjson":
+        option = orjson.OPT_PASSTHROUGH_DATETIME
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        try:
+            return orjson.dumps(obj, default=default, option=option)
+        except orjson.JSONEncodeError:
+            # Integers beyond 64 bits, or a value default cannot convert, which json reports the same way.
+            pass
+    return json.dumps(
+        obj,
+        default=default,
+        sort_keys=sort_keys,
+        ensure_ascii=False,
+        separators=(",", ":"),
+    ).encode("utf-8")
+
+
+def loads(data: bytes | str, backend: str | None = None) -> object:
+    """
+    Decode a JSON document.
+
+    Parameters:
+        data (bytes | str): The document.
+        backend (str | None): 'json' or 'orjson', BACKEND by default.
+
+    Raises:
+        ValueError: If the document is not valid JSON.
+
+    Returns:
+        object: The decoded value.
+    """
+    decode = json.loads
+    if (backend or BACKEND) == "orjson":
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        if _LONG_INTEGER not in data.translate(_DIGITS_TO_ONES):
+            decode = orjson.loads
+    if len(data) < PAUSE_GC_SIZE or not gc.isenabled():
+        return decode(data)
+    gc.disable()
+    try:
+        return decode(data)
+    finally:
+        gc.enable()
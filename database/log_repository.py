@@ -0,0 +1,519 @@
+import os
+import threading
+from typing import Callable, Iterable, Iterator
+
+from database import fast_json
+from database.binary_snapshot import BinarySnapshot, is_snapshot, write_snapshot
+from database.machine_repository import MachineRepository, MachineRow, record_io
+
+DEFAULT_COMPACT_SIZE = 4 * 1024 * 1024
+DEFAULT_SYNC_INTERVAL = 1.0
+FSYNC_POLICIES = ("always", "interval", "never")
+
+
+class LogMachineRepository(MachineRepository):
+    """
+    Repository keeping every vending machine in memory and persisting each mutation as one
+    appended log record, so a write costs the size of the change instead of the whole fleet.
+
+    On startup the latest snapshot is memory-mapped and the log records newer than it are replayed.
+    Only the names of the snapshot's vending machines are read then, each machine document is built the
+    first time it is accessed. The vending machine service still reads every record once when it starts,
+    through rows, since its indexes hold the items of every machine. Once the log grows past ``compact_size``
+    bytes a background thread writes a new binary snapshot and drops the old log. Machines never decoded
+    are copied from the previous snapshot and stay undecoded. Every record carries a sequence number and
+    the snapshot remembers the last one it contains, so a crash at any point of a compaction never
+    applies a record twice.
+
+    ``fsync`` controls durability of appended records: 'always' returns from a mutation only once
+    its records are synced, 'interval' syncs every ``sync_interval`` seconds and 'never' leaves it to the OS.
+    With 'always' the sync happens after the lock is released and covers every record appended
+    so far (group commit), so concurrent mutations share one fsync instead of queueing behind one each.
+    """
+
+    def __init__(
+        self: "LogMachineRepository",
+        path: str,
+        fsync: str = "always",
+        compact_size: int = DEFAULT_COMPACT_SIZE,
+        sync_interval: float = DEFAULT_SYNC_INTERVAL,
+    ) -> None:
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy '{fsync}'")
+        self.fsync = fsync
+        self.compact_size = compact_size
+        self.sync_interval = sync_interval
+        self._snapshot_path = path + ".snapshot"
+        self._log_path = path + ".log"
+        self._compacting_log_path = path + ".log.compacting"
+
+        self._lock = threading.RLock()
+        self._compaction_lock = threading.Lock()
+        # Held while syncing the log outside of _lock, always acquired before _lock.
+        self._sync_lock = threading.Lock()
+        # None for the machines of the snapshot not decoded yet, _undecoded holds their position in it.
+        self._machines: dict[int, dict | None] = {}
+        self._undecoded: dict[int, int] = {}
+        self._snapshot: BinarySnapshot | None = None
+        self._ids: dict[str, int] = {}
+        self._next_id = 1
+        self._sequence = 0
+        self._unsynced = False
+        self._compacting = False
+        self._compaction_thread = None
+        self._bytes_read = 0
+        self._bytes_written = 0
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._load()
+        self._synced_sequence = self._sequence
+        if os.path.exists(self._compacting_log_path):
+            # A compaction was interrupted, finish it before the log can be rotated again.
+            snapshot = self._snapshot_state()
+            self._write_snapshot(snapshot)
+            self._use_snapshot(snapshot)
+            os.remove(self._compacting_log_path)
+        self._log = open(self._log_path, "a", encoding="utf-8")
+
+        self._stop_event = threading.Event()
+        self._background_thread = threading.Thread(
+            target=self._run_background, daemon=True
+        )
+        self._background_thread.start()
+
+    def _load(self: "LogMachineRepository") -> None:
+        snapshot_sequence = 0
+        if os.path.exists(self._snapshot_path) and is_snapshot(self._snapshot_path):
+            self._snapshot = BinarySnapshot(self._snapshot_path)
+            self._bytes_read += self._snapshot.size
+            snapshot_sequence = self._snapshot.sequence
+            self._next_id = self._snapshot.next_id
+            for index, (machine_id, name) in enumerate(self._snapshot.keys()):
+                self._machines[machine_id] = None
+                self._undecoded[machine_id] = index
+                self._ids[name] = machine_id
+        elif os.path.exists(self._snapshot_path):
+            # Snapshots used to be JSON documents, the next compaction rewrites them.
+            with open(self._snapshot_path, encoding="utf-8") as handle:
+                snapshot = fast_json.loads(handle.read())
+                self._bytes_read += handle.tell()
+            snapshot_sequence = snapshot["sequence"]
+            self._next_id = snapshot["next_id"]
+            for machine_id, vending_machine in snapshot["machines"]:
+                self._machines[machine_id] = vending_machine
+                self._ids[vending_machine["name"]] = machine_id
+        self._sequence = snapshot_sequence
+
+        for log_path in [self._compacting_log_path, self._log_path]:
+            if not os.path.exists(log_path):
+                continue
+            size = os.path.getsize(log_path)
+            self._bytes_read += size
+            valid_size = 0
+            with open(log_path, "rb") as handle:
+                for line in handle:
+                    try:
+                        if not line.endswith(b"\n"):
+                            raise ValueError("Unterminated log record")
+                        record = fast_json.loads(line)
+                    except ValueError:
+                        # A torn write at the end of the log, the mutation was never acknowledged.
+                        break
+                    valid_size += len(line)
+                    if record["seq"] > snapshot_sequence:
+                        self._apply(record)
+                        self._sequence = record["seq"]
+            if valid_size < size:
+                # Drop the torn record, records appended after it would not be read back otherwise.
+                with open(log_path, "r+b") as handle:
+                    handle.truncate(valid_size)
+                    handle.flush()
+                    os.fsync(handle.fileno())
+
+    def _machine(self: "LogMachineRepository", machine_id: int) -> dict:
+        """Returns the vending machine with the given id, decoding it from the snapshot on first access."""
+        vending_machine = self._machines[machine_id]
+        if vending_machine is None:
+            _, vending_machine = self._snapshot.read(self._undecoded.pop(machine_id))
+            self._machines[machine_id] = vending_machine
+        return vending_machine
+
+    def _apply(self: "LogMachineRepository", record: dict) -> None:
+        operation = record["op"]
+        if operation == "truncate":
+            self._machines.clear()
+            self._undecoded.clear()
+            self._ids.clear()
+            return
+        if operation == "create":
+            machine_id = record["id"]
+            self._machines[machine_id] = {
+                "name": record["name"],
+                "location": record["location"],
+                "items": dict(record["items"]),
+            }
+            self._ids[record["name"]] = machine_id
+            self._next_id = max(self._next_id, machine_id + 1)
+            return
+
+        machine_id = self._ids[record["name"]]
+        if operation == "delete":
+            del self._machines[machine_id]
+            self._undecoded.pop(machine_id, None)
+            del self._ids[record["name"]]
+            return
+        vending_machine = self._machine(machine_id)
+        if self._compacting:
+            # A compaction may be serializing this machine outside the lock, replace it instead.
+            vending_machine = self._copy(vending_machine)
+            self._machines[machine_id] = vending_machine
+        if operation == "rename":
+            del self._ids[record["name"]]
+            self._ids[record["new_name"]] = machine_id
+            vending_machine["name"] = record["new_name"]
+        elif operation == "relocate":
+            vending_machine["location"] = record["location"]
+        elif operation == "item":
+            items = vending_machine["items"]
+            items[record["item"]] = items.get(record["item"], 0) + record["delta"]
+        elif operation == "remove":
+            del vending_machine["items"][record["item"]]
+
+    def _append(self: "LogMachineRepository", records: list[dict]) -> None:
+        """Append records to the log with a single write, then apply them to memory."""
+        if not records:
+            return
+        numbered_records = [
+            {"seq": self._sequence + index, **record}
+            for index, record in enumerate(records, start=1)
+        ]
+        payload = b"".join(
+            fast_json.dumps(record) + b"\n" for record in numbered_records
+        )
+        self._log.write(payload.decode("utf-8"))
+        self._log.flush()
+        self._bytes_written += len(payload)
+        record_io(bytes_written=len(payload))
+        self._unsynced = True
+
+        self._sequence += len(numbered_records)
+        for record in numbered_records:
+            self._apply(record)
+
+    @staticmethod
+    def _diff(old_machine: dict, machine: dict) -> list[dict]:
+        """Build the log records turning old_machine into machine."""
+        name = old_machine["name"]
+        records = []
+        old_items = old_machine["items"]
+        for item_name, amount in machine["items"].items():
+            old_amount = old_items.get(item_name)
+            if old_amount != amount:
+                records.append(
+                    {
+                        "op": "item",
+                        "name": name,
+                        "item": item_name,
+                        "delta": amount - (old_amount or 0),
+                    }
+                )
+        for item_name in old_items:
+            if item_name not in machine["items"]:
+                records.append({"op": "remove", "name": name, "item": item_name})
+        if machine["location"] != old_machine["location"]:
+            records.append(
+                {"op": "relocate", "name": name, "location": machine["location"]}
+            )
+        if machine["name"] != name:
+            records.append({"op": "rename", "name": name, "new_name": machine["name"]})
+        return records
+
+    @staticmethod
+    def _copy(vending_machine: dict) -> dict:
+        return {**vending_machine, "items": dict(vending_machine["items"])}
+
+    def exists(self: "LogMachineRepository", vending_machine_name: str) -> bool:
+        with self._lock:
+            return vending_machine_name in self._ids
+
+    def get(self: "LogMachineRepository", vending_machine_name: str) -> dict | None:
+        with self._lock:
+            machine_id = self._ids.get(vending_machine_name)
+            if machine_id is None:
+                return None
+            return self._copy(self._machine(machine_id))
+
+    def get_many(
+        self: "LogMachineRepository", vending_machine_names: Iterable[str]
+    ) -> list[dict]:
+        with self._lock:
+            return [
+                self._copy(self._machine(self._ids[name]))
+                for name in vending_machine_names
+                if name in self._ids
+            ]
+
+    def all(self: "LogMachineRepository") -> list[dict]:
+        with self._lock:
+            return [
+                self._copy(self._machine(machine_id)) for machine_id in self._machines
+            ]
+
+    def rows(self: "LogMachineRepository") -> list[MachineRow]:
+        # The machines of the snapshot not decoded yet are read from it without decoding their documents.
+        with self._lock:
+            rows = []
+            for machine_id, vending_machine in self._machines.items():
+                if vending_machine is None:
+                    rows.append(
+                        self._snapshot.read_row(self._undecoded[machine_id])[1:]
+                    )
+                else:
+                    items = vending_machine["items"]
+                    rows.append(
+                        (
+                            vending_machine["name"],
+                            vending_machine["location"],
+                            list(items),
+                            list(items.values()),
+                        )
+                    )
+        record_io(documents_scanned=len(rows))
+        return rows
+
+    def iterate(
+        self: "LogMachineRepository",
+        after: int | None = None,
+        location: str | None = None,
+        names: Iterable[str] | None = None,
+    ) -> Iterator[tuple[int, dict]]:
+        with self._lock:
+            if names is None:
+                machine_ids = self._machines
+            else:
+                machine_ids = sorted(
+                    self._ids[name] for name in names if name in self._ids
+                )
+            machine_ids = [
+                machine_id
+                for machine_id in machine_ids
+                if after is None or machine_id > after
+            ]
+            machines = [
+                (machine_id, self._copy(machine))
+                for machine_id, machine in (
+                    (machine_id, self._machine(machine_id))
+                    for machine_id in machine_ids
+                )
+                if location is None or machine["location"] == location
+            ]
+        record_io(documents_scanned=len(machine_ids))
+        return iter(machines)
+
+    def insert(self: "LogMachineRepository", vending_machine: dict) -> dict:
+        with self._lock:
+            machine_id = self._next_id
+            self._append(
+                [
+                    {
+                        "op": "create",
+                        "id": machine_id,
+                        "name": vending_machine["name"],
+                        "location": vending_machine["location"],
+                        "items": vending_machine["items"],
+                    }
+                ]
+            )
+            self._maybe_start_compaction()
+            vending_machine = self._copy(self._machine(machine_id))
+            sequence = self._sequence
+        self._wait_durable(sequence)
+        return vending_machine
+
+    def insert_many(
+        self: "LogMachineRepository", vending_machines: Iterable[dict]
+    ) -> None:
+        with self._lock:
+            self._append(
+                [
+                    {
+                        "op": "create",
+                        "id": self._next_id + index,
+                        "name": vending_machine["name"],
+                        "location": vending_machine["location"],
+                        "items": vending_machine["items"],
+                    }
+                    for index, vending_machine in enumerate(vending_machines)
+                ]
+            )
+            self._maybe_start_compaction()
+            sequence = self._sequence
+        self._wait_durable(sequence)
+
+    def update_many(
+        self: "LogMachineRepository",
+        vending_machine_names: Iterable[str],
+        transform: Callable[[dict], None],
+    ) -> list[dict]:
+        with self._lock:
+            # Transform copies first, so an exception leaves both memory and the log untouched.
+            changes = []
+            for name in vending_machine_names:
+                old_machine = self._machine(self._ids[name])
+                machine = self._copy(old_machine)
+                transform(machine)
+                changes.append((old_machine, machine))
+
+            records = []
+            for old_machine, machine in changes:
+                records.extend(self._diff(old_machine, machine))
+            self._append(records)
+            self._maybe_start_compaction()
+            vending_machines = [self._copy(machine) for _, machine in changes]
+            sequence = self._sequence
+        self._wait_durable(sequence)
+        return vending_machines
+
+    def delete(self: "LogMachineRepository", vending_machine_name: str) -> None:
+        with self._lock:
+            self._append([{"op": "delete", "name": vending_machine_name}])
+            self._maybe_start_compaction()
+            sequence = self._sequence
+        self._wait_durable(sequence)
+
+    def truncate(self: "LogMachineRepository") -> None:
+        with self._lock:
+            self._append([{"op": "truncate"}])
+            self._maybe_start_compaction()
+            sequence = self._sequence
+        self._wait_durable(sequence)
+
+    def _maybe_start_compaction(self: "LogMachineRepository") -> None:
+        if not self._compacting and self._log.tell() >= self.compact_size:
+            self._compacting = True
+            self._compaction_thread = threading.Thread(target=self.compact, daemon=True)
+            self._compaction_thread.start()
+
+    def compact(self: "LogMachineRepository") -> None:
+        """
+        Write a snapshot of the current state and drop the log records it contains.
+        The log is rotated and the machines are referenced under the lock, the snapshot itself is written
+        without blocking writers: meanwhile they replace the machines they change instead of modifying them.
+
+        Returns:
+            None
+        """
+        with self._compaction_lock:
+            try:
+                with self._sync_lock, self._lock:
+                    self._sync()
+                    self._log.close()
+                    os.replace(self._log_path, self._compacting_log_path)
+                    self._log = open(self._log_path, "a", encoding="utf-8")
+                    self._compacting = True
+                    snapshot = self._snapshot_state()
+                self._write_snapshot(snapshot)
+                self._use_snapshot(snapshot)
+                os.remove(self._compacting_log_path)
+            finally:
+                with self._lock:
+                    self._compacting = False
+
+    def _snapshot_state(self: "LogMachineRepository") -> dict:
+        """
+        Reference the current state, without copying or decoding any machine, the caller holds _lock.
+        The machines not decoded yet are None, read from the previous snapshot at their position.
+        """
+        return {
+            "sequence": self._sequence,
+            "next_id": self._next_id,
+            "machines": list(self._machines.items()),
+            "snapshot": self._snapshot,
+            "undecoded": dict(self._undecoded),
+        }
+
+    def _use_snapshot(self: "LogMachineRepository", snapshot: dict) -> None:
+        """Read the machines still not decoded from the snapshot just written, and close the previous one."""
+        positions = {
+            machine_id: index
+            for index, (machine_id, vending_machine) in enumerate(snapshot["machines"])
+            if vending_machine is None
+        }
+        new_snapshot = BinarySnapshot(self._snapshot_path) if positions else None
+        with self._lock:
+            self._close_snapshot()
+            if self._undecoded:
+                self._snapshot = new_snapshot
+                self._undecoded = {
+                    machine_id: positions[machine_id] for machine_id in self._undecoded
+                }
+            elif new_snapshot is not None:
+                new_snapshot.close()
+
+    def _close_snapshot(self: "LogMachineRepository") -> None:
+        if self._snapshot is not None:
+            self._snapshot.close()
+            self._snapshot = None
+
+    def _write_snapshot(self: "LogMachineRepository", snapshot: dict) -> None:
+        snapshot_size = write_snapshot(
+            self._snapshot_path,
+            (
+                (
+                    snapshot["snapshot"].read(snapshot["undecoded"][machine_id])
+                    if vending_machine is None
+                    else (machine_id, vending_machine)
+                )
+                for machine_id, vending_machine in snapshot["machines"]
+            ),
+            sequence=snapshot["sequence"],
+            next_id=snapshot["next_id"],
+        )
+        with self._lock:
+            self._bytes_written += snapshot_size
+        record_io(bytes_written=snapshot_size)
+
+    def _sync(self: "LogMachineRepository") -> None:
+        """Sync every appended record, the caller holds both _sync_lock and _lock."""
+        if self._unsynced:
+            os.fsync(self._log.fileno())
+            self._unsynced = False
+        self._synced_sequence = self._sequence
+
+    def _wait_durable(self: "LogMachineRepository", sequence: int) -> None:
+        """
+        With the 'always' policy, return once the records up to the given sequence are synced.
+        Callers arriving while another one syncs wait for it, and are usually covered by its sync.
+        """
+        if self.fsync != "always":
+            return
+        with self._sync_lock:
+            if self._synced_sequence >= sequence:
+                return
+            with self._lock:
+                target_sequence = self._sequence
+                log_fileno = self._log.fileno()
+            # The log cannot be rotated meanwhile, compaction takes _sync_lock first.
+            os.fsync(log_fileno)
+            self._synced_sequence = target_sequence
+
+    def _run_background(self: "LogMachineRepository") -> None:
+        while not self._stop_event.wait(self.sync_interval):
+            if self.fsync == "interval":
+                with self._sync_lock, self._lock:
+                    self._sync()
+
+    def io_bytes(self: "LogMachineRepository") -> tuple[int, int] | None:
+        return self._bytes_read, self._bytes_written
+
+    def close(self: "LogMachineRepository") -> None:
+        self._stop_event.set()
+        self._background_thread.join()
+        with self._lock:
+            compaction_thread = self._compaction_thread
+        if compaction_thread is not None:
+            compaction_thread.join()
+        with self._sync_lock, self._lock:
+            self._sync()
+            self._log.close()
+            self._close_snapshot()
@@ -0,0 +1,388 @@
+import contextvars
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager, nullcontext
+from typing import Callable, ContextManager, Iterable, Iterator, Sequence
+
+from tinydb import TinyDB
+from tinydb.table import Document
+
+# (sequence, previous name or None if created, vending machine or None if deleted)
+ApplyChange = Callable[[int, str | None, dict | None], None]
+# (sequence every machine is at unless listed, sequence of the machines changed since, latest sequence)
+Reload = Callable[[int, dict[str, int], int], None]
+# (previous name or None if created, vending machine or None if deleted, storage key of the vending machine)
+StoredChange = tuple[str | None, dict | None, int | None]
+# (name, location, item names, amounts of the items in the same order)
+MachineRow = tuple[str, str, Sequence[str], Sequence]
+
+
+class StorageIO:
+    """
+    The storage work of the repository calls measured by measure_io: bytes read and written,
+    and vending machines decoded or examined, None until a backend reports some.
+    """
+
+    __slots__ = ("bytes_read", "bytes_written", "documents_scanned")
+
+    def __init__(self: "StorageIO") -> None:
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.documents_scanned: int | None = None
+
+
+_current_io: contextvars.ContextVar[StorageIO | None] = contextvars.ContextVar(
+    "current_io", default=None
+)
+
+
+@contextmanager
+def measure_io(storage_io: StorageIO | None = None) -> Iterator[StorageIO]:
+    """
+    Collect the storage work reported with record_io in the current thread or task while the context is held,
+    into storage_io when given to resume a measure, e.g. between the items of an iterator.
+    Work done meanwhile by other threads, e.g. concurrent calls or background flushes, is not included.
+    """
+    storage_io = storage_io or StorageIO()
+    token = _current_io.set(storage_io)
+    try:
+        yield storage_io
+    finally:
+        _current_io.reset(token)
+
+
+def record_io(
+    bytes_read: int = 0, bytes_written: int = 0, documents_scanned: int = 0
+) -> None:
+    """Report storage work done by the current thread to the enclosing measure_io, if any."""
+    storage_io = _current_io.get()
+    if storage_io is None:
+        return
+    storage_io.bytes_read += bytes_read
+    storage_io.bytes_written += bytes_written
+    if documents_scanned:
+        storage_io.documents_scanned = (
+            storage_io.documents_scanned or 0
+        ) + documents_scanned
+
+
+class MachineRepository(ABC):
+    """
+    Storage interface used by the vending machine service.
+
+    A vending machine is exchanged as a dictionary with 'name', 'location' and 'items' keys,
+    machines are identified by their unique name.
+    """
+
+    @abstractmethod
+    def exists(self: "MachineRepository", vending_machine_name: str) -> bool:
+        """Returns whether a vending machine with the given name is stored."""
+
+    @abstractmethod
+    def get(self: "MachineRepository", vending_machine_name: str) -> dict | None:
+        """Returns the vending machine with the given name, or None if it is not stored."""
+
+    @abstractmethod
+    def get_many(
+        self: "MachineRepository", vending_machine_names: Iterable[str]
+    ) -> list[dict]:
+        """Returns the stored vending machines with the given names, skipping unknown names."""
+
+    @abstractmethod
+    def all(self: "MachineRepository") -> list[dict]:
+        """Returns every stored vending machine."""
+
+    def rows(self: "MachineRepository") -> list[MachineRow]:
+        """
+        Returns every stored vending machine as a row, e.g. to index the fleet.
+        Backends holding machines in a compact form override it to skip building their documents.
+        """
+        return [
+            (
+                vending_machine["name"],
+                vending_machine["location"],
+                list(vending_machine["items"]),
+                list(vending_machine["items"].values()),
+            )
+            for vending_machine in self.all()
+        ]
+
+    @abstractmethod
+    def iterate(
+        self: "MachineRepository",
+        after: int | None = None,
+        location: str | None = None,
+        names: Iterable[str] | None = None,
+    ) -> Iterator[tuple[int, dict]]:
+        """
+        Yields (key, vending machine) pairs in ascending key order, starting after the given key,
+        optionally only the machines at the given location and only the machines with the given names,
+        which backends look up by name instead of scanning every machine.
+        Keys are stable storage ids suitable as pagination cursors.
+        """
+
+    @abstractmethod
+    def insert(self: "MachineRepository", vending_machine: dict) -> dict:
+        """Stores a new vending machine and returns it."""
+
+    def insert_many(
+        self: "MachineRepository", vending_machines: Iterable[dict]
+    ) -> None:
+        """
+        Stores new vending machines with distinct names.
+        Backends override it to store them all within a single storage write.
+        """
+        for vending_machine in vending_machines:
+            self.insert(vending_machine)
+
+    @abstractmethod
+    def update_many(
+        self: "MachineRepository",
+        vending_machine_names: Iterable[str],
+        transform: Callable[[dict], None],
+    ) -> list[dict]:
+        """
+        Applies a transform to each of the given, distinct, vending machines within a single storage write.
+        The transform mutates the machine in place and may change its name; any exception raised
+        by it aborts the whole update before anything is written.
+        Returns copies of the updated machines, in the given order.
+        """
+
+    @abstractmethod
+    def delete(self: "MachineRepository", vending_machine_name: str) -> None:
+        """Removes the vending machine with the given name."""
+
+    @abstractmethod
+    def truncate(self: "MachineRepository") -> None:
+        """Removes every stored vending machine."""
+
+    def update(
+        self: "MachineRepository",
+        vending_machine_name: str,
+        transform: Callable[[dict], None],
+    ) -> dict:
+        """Applies a transform to a single vending machine and returns the updated copy."""
+        return self.update_many([vending_machine_name], transform)[0]
+
+    def io_bytes(self: "MachineRepository") -> tuple[int, int] | None:
+        """Returns the (bytes read, bytes written) by the storage so far, None when the backend does not count them."""
+        return None
+
+    def refresh(self: "MachineRepository", changes: list[StoredChange]) -> None:
+        """
+        Brings the in-memory state of the repository, such as its indexes, up to date with changes
+        another process wrote to the storage, in the order they were written. Nothing to do by default.
+        """
+
+    def watch(
+        self: "MachineRepository", apply_change: ApplyChange, reload: Reload
+    ) -> str | None:
+        """
+        Registers the functions keeping a copy of the machines up to date with the changes made by other
+        processes sharing the storage, and calls reload once. Returns the epoch of the sequence numbers
+        shared by these processes, None when the storage is owned by this process, the default.
+        """
+        return None
+
+    def sync(self: "MachineRepository") -> None:
+        """Passes the changes made by other processes since the last call to the functions given to watch."""
+
+    def write_lock(self: "MachineRepository") -> ContextManager[None]:
+        """
+        Returns a context manager held around every check-then-write sequence, which excludes the writes
+        of other processes sharing the storage and first passes their changes to the functions given to watch.
+        """
+        return nullcontext()
+
+    def close(self: "MachineRepository") -> None:
+        """Releases the underlying storage."""
+
+
+class TinyDBMachineRepository(MachineRepository):
+    """
+    Repository storing each vending machine as a TinyDB document.
+    An in-memory name to document id index is built once on startup so lookups by name
+    never scan the table.
+
+    TinyDB rewrites the whole table on every write, so every call is serialized on a single
+    lock, shared with the storage when it exposes one, which makes this the only writer.
+    TinyDB documents share their nested values with the table a caching storage holds, so the documents
+    returned and stored are copies: callers mutating them never change what gets written.
+    With a group commit storage, mutations wait for their write to be durable after releasing
+    the lock, so concurrent mutations are flushed together.
+    """
+
+    def __init__(self: "TinyDBMachineRepository", db: TinyDB) -> None:
+        self.db = db
+        self._lock = getattr(db.storage, "lock", None) or threading.RLock()
+        self._name_index: dict[str, int] = {
+            document["name"]: document.doc_id for document in self.db
+        }
+
+    @staticmethod
+    def _copy(vending_machine: dict, doc_id: int | None = None) -> dict:
+        """
+        Copy a vending machine down to its items. The copy is a Document with the given id, or with the id of
+        the vending machine when it is a Document, which TinyDB keeps on insert, and a plain dict otherwise.
+        """
+        copy = {**vending_machine, "items": dict(vending_machine["items"])}
+        if doc_id is None:
+            doc_id = getattr(vending_machine, "doc_id", None)
+        return copy if doc_id is None else Document(copy, doc_id)
+
+    def _write_generation(self: "TinyDBMachineRepository") -> int | None:
+        return getattr(self.db.storage, "write_generation", None)
+
+    def _wait_durable(self: "TinyDBMachineRepository", generation: int | None) -> None:
+        if generation is not None:
+            self.db.storage.wait_durable(generation)
+
+    def exists(self: "TinyDBMachineRepository", vending_machine_name: str) -> bool:
+        with self._lock:
+            return vending_machine_name in self._name_index
+
+    def get(self: "TinyDBMachineRepository", vending_machine_name: str) -> dict | None:
+        with self._lock:
+            doc_id = self._name_index.get(vending_machine_name)
+            if doc_id is None:
+                return None
+            return self._copy(self.db.get(doc_id=doc_id))
+
+    def get_many(
+        self: "TinyDBMachineRepository", vending_machine_names: Iterable[str]
+    ) -> list[dict]:
+        with self._lock:
+            doc_ids = [
+                self._name_index[name]
+                for name in vending_machine_names
+                if name in self._name_index
+            ]
+            return [self._copy(self.db.get(doc_id=doc_id)) for doc_id in doc_ids]
+
+    def all(self: "TinyDBMachineRepository") -> list[dict]:
+        with self._lock:
+            return [self._copy(document) for document in self.db.all()]
+
+    def iterate(
+        self: "TinyDBMachineRepository",
+        after: int | None = None,
+        location: str | None = None,
+        names: Iterable[str] | None = None,
+    ) -> Iterator[tuple[int, dict]]:
+        # TinyDB reads the whole table at once anyway, so take one consistent snapshot.
+        with self._lock:
+            if names is None:
+                documents = self.db.all()
+            else:
+                doc_ids = sorted(
+                    self._name_index[name] for name in names if name in self._name_index
+                )
+                documents = self.db.get(doc_ids=doc_ids) if doc_ids else []
+                documents.sort(key=lambda document: document.doc_id)
+        for document in documents:
+            if after is not None and document.doc_id <= after:
+                continue
+            if location is not None and document["location"] != location:
+                continue
+            yield document.doc_id, self._copy(document)
+
+    def insert(self: "TinyDBMachineRepository", vending_machine: dict) -> dict:
+        with self._lock:
+            doc_id = self.db.insert(self._copy(vending_machine))
+            self._name_index[vending_machine["name"]] = doc_id
+            generation = self._write_generation()
+        self._wait_durable(generation)
+        return self._copy(vending_machine, doc_id)
+
+    def insert_many(
+        self: "TinyDBMachineRepository", vending_machines: Iterable[dict]
+    ) -> None:
+        vending_machines = list(vending_machines)
+        with self._lock:
+            doc_ids = self.db.insert_multiple(
+                self._copy(vending_machine) for vending_machine in vending_machines
+            )
+            for vending_machine, doc_id in zip(vending_machines, doc_ids):
+                self._name_index[vending_machine["name"]] = doc_id
+            generation = self._write_generation()
+        self._wait_durable(generation)
+
+    def update_many(
+        self: "TinyDBMachineRepository",
+        vending_machine_names: Iterable[str],
+        transform: Callable[[dict], None],
+    ) -> list[dict]:
+        with self._lock:
+            vending_machines = self._update_many(vending_machine_names, transform)
+            generation = self._write_generation()
+        self._wait_durable(generation)
+        return vending_machines
+
+    def _update_many(
+        self: "TinyDBMachineRepository",
+        vending_machine_names: Iterable[str],
+        transform: Callable[[dict], None],
+    ) -> list[dict]:
+        doc_ids = [self._name_index[name] for name in vending_machine_names]
+        updated_machines: dict[int, tuple[str, Document]] = {}
+
+        def apply_transform(document: dict) -> None:
+            old_name = document["name"]
+            doc_id = self._name_index[old_name]
+            transform(document)
+            updated_machines[doc_id] = (
+                old_name,
+                Document({**document, "items": dict(document["items"])}, doc_id),
+            )
+
+        self.db.update(apply_transform, doc_ids=doc_ids)
+
+        # Re-key renamed machines only once the write went through.
+        renamed = [
+            (old_name, document)
+            for old_name, document in updated_machines.values()
+            if document["name"] != old_name
+        ]
+        for old_name, _ in renamed:
+            del self._name_index[old_name]
+        for _, document in renamed:
+            self._name_index[document["name"]] = document.doc_id
+        return [updated_machines[doc_id][1] for doc_id in doc_ids]
+
+    def delete(self: "TinyDBMachineRepository", vending_machine_name: str) -> None:
+        with self._lock:
+            self.db.remove(doc_ids=[self._name_index[vending_machine_name]])
+            del self._name_index[vending_machine_name]
+            generation = self._write_generation()
+        self._wait_durable(generation)
+
+    def truncate(self: "TinyDBMachineRepository") -> None:
+        with self._lock:
+            self.db.truncate()
+            self._name_index.clear()
+            generation = self._write_generation()
+        self._wait_durable(generation)
+
+    def refresh(self: "TinyDBMachineRepository", changes: list[StoredChange]) -> None:
+        with self._lock:
+            # TinyDB caches the next document id and query results, both stale once another process wrote.
+            table = self.db.table(self.db.default_table_name)
+            table._next_id = None
+            table.clear_cache()
+            for old_name, vending_machine, key in changes:
+                if old_name is not None:
+                    self._name_index.pop(old_name, None)
+                if vending_machine is not None:
+                    self._name_index[vending_machine["name"]] = key
+
+    def io_bytes(self: "TinyDBMachineRepository") -> tuple[int, int] | None:
+        # Count below any caching middleware, where the database file is actually touched.
+        storage = self.db.storage
+        while not hasattr(storage, "bytes_read") and hasattr(storage, "storage"):
+            storage = storage.storage
+        if not hasattr(storage, "bytes_read"):
+            return None
+        return storage.bytes_read, storage.bytes_written
+
+    def close(self: "TinyDBMachineRepository") -> None:
+        self.db.close()
@@ -0,0 +1,99 @@
+"""
+Move the vending machines into a new set of shards, e.g. to change the number of shards or the partition.
+
+Run from the project root while the API is stopped:
+    python -m database.reshard --shards 8 --by location
+    python -m database.reshard --shards 4 --from-backend tinydb
+"""
+
+import argparse
+import os
+import shutil
+import sys
+
+from tinydb.table import Document
+
+from database.db_manager import (
+    get_machine_repository,
+    get_shard_directory,
+    get_sharded_repository,
+)
+
+
+def reshard(
+    path: str,
+    shard_count: int,
+    partition: str = "name",
+    source_backend: str = "sharded",
+    test: bool = False,
+) -> int:
+    """
+    Copy every vending machine of a repository into new shards and put them in place of the current ones.
+    The new shards are written to a separate directory first and swapped in once complete, so an
+    interrupted run leaves the current shards untouched. Machines keep their keys, so pagination
+    cursors stay valid.
+
+    Parameters:
+        path (str): Directory holding the database files.
+        shard_count (int): The number of new shards.
+        partition (str): 'name' or 'location', what the new shards are partitioned by.
+        source_backend (str): The backend to read the machines from, 'sharded' to reshard the current shards
+            or another backend to migrate its database to shards.
+        test (bool): Reshard the test database instead of the main one.
+
+    Raises:
+        ValueError: If the shard count or partition is invalid.
+
+    Returns:
+        int: The number of vending machines moved.
+    """
+    shard_directory = get_shard_directory(path, test)
+    new_directory = shard_directory.rstrip("/") + ".resharding/"
+    old_directory = shard_directory.rstrip("/") + ".old/"
+    shutil.rmtree(new_directory, ignore_errors=True)
+
+    source = get_machine_repository(path, backend=source_backend, test=test)
+    try:
+        target = get_sharded_repository(new_directory, shard_count, partition)
+        try:
+            vending_machines = [
+                Document(vending_machine, key)
+                for key, vending_machine in source.iterate()
+            ]
+            target.insert_many(vending_machines)
+        finally:
+            target.close()
+    finally:
+        source.close()
+
+    shutil.rmtree(old_directory, ignore_errors=True)
+    if os.path.exists(shard_directory):
+        os.replace(shard_directory, old_directory)
+    os.replace(new_directory, shard_directory)
+    shutil.rmtree(old_directory, ignore_errors=True)
+    return len(vending_machines)
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--shards", type=int, required=True)
+    parser.add_argument("--by", default="name", help="name or location")
+    parser.add_argument("--path", default=os.getenv("DB_PATH") or "./database/")
+    parser.add_argument(
+        "--from-backend",
+        default="sharded",
+        help="backend to read the machines from: sharded, tinydb, sqlite or log",
+    )
+    parser.add_argument("--test", action="store_true", help="reshard the test database")
+    args = parser.parse_args(argv)
+
+    count = reshard(args.path, args.shards, args.by, args.from_backend, args.test)
+    print(
+        f"Moved {count} vending machines into {args.shards} shards by {args.by} "
+        f"in {get_shard_directory(args.path, args.test)}"
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
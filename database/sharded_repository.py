@@ -0,0 +1,291 @@
+import heapq
+import threading
+import zlib
+from operator import itemgetter
+from typing import Callable, Iterable, Iterator
+
+from tinydb.table import Document
+
+from database.machine_repository import (
+    MachineRepository,
+    MachineRow,
+    StoredChange,
+    TinyDBMachineRepository,
+)
+
+PARTITIONS = ("name", "location")
+
+
+class ShardedMachineRepository(MachineRepository):
+    """
+    Repository routing each vending machine to one of several TinyDB shards, by a stable hash of its name
+    or of its location, so a write only rewrites the file of its shard and writes to different shards
+    proceed in parallel. With the location partition, listing a location only reads its shard.
+
+    Keys are allocated by the router and stored as the TinyDB document ids, unique across shards,
+    so iteration merges the shards in the global insertion order and keys stay valid pagination cursors,
+    also once the fleet is resharded. A machine whose name or location moves it to another shard is
+    inserted into that shard under the same key, then removed from its previous shard; a machine left
+    in two shards by a crash in between is repaired when the shards are opened.
+
+    Updates spanning several shards apply the transforms to copies first, so a transform raising still
+    writes nothing, then write each shard. Callers serialize updates of the same vending machine,
+    as the vending machine service does with its machine locks.
+    """
+
+    def __init__(
+        self: "ShardedMachineRepository",
+        shards: list[TinyDBMachineRepository],
+        partition: str = "name",
+    ) -> None:
+        if partition not in PARTITIONS:
+            raise ValueError(
+                f"Unknown shard partition '{partition}', must be 'name' or 'location'"
+            )
+        if not shards:
+            raise ValueError("A sharded repository needs at least one shard")
+        self.shards = shards
+        self.partition = partition
+        self._lock = threading.Lock()
+        self._shard_of: dict[str, int] = {}
+        self._next_key = 1
+        for index, shard in enumerate(shards):
+            for key, vending_machine in shard.iterate():
+                self._next_key = max(self._next_key, key + 1)
+                self._open_machine(index, vending_machine)
+
+    def _open_machine(
+        self: "ShardedMachineRepository", index: int, vending_machine: dict
+    ) -> None:
+        name = vending_machine["name"]
+        other_index = self._shard_of.get(name)
+        if other_index is None:
+            self._shard_of[name] = index
+            return
+        # Left behind by an interrupted move: keep the copy in the shard the machine belongs to.
+        if self.shard_index(vending_machine) == index:
+            keep_index, stale_index = index, other_index
+        else:
+            keep_index, stale_index = other_index, index
+        self.shards[stale_index].delete(name)
+        self._shard_of[name] = keep_index
+
+    def shard_index(self: "ShardedMachineRepository", vending_machine: dict) -> int:
+        """
+        Retrieves the shard a vending machine belongs to, from its name or location.
+
+        Parameters:
+            vending_machine (dict): The vending machine.
+
+        Returns:
+            int: The index of the shard.
+        """
+        return self._hash_index(vending_machine[self.partition])
+
+    def _hash_index(self: "ShardedMachineRepository", value: object) -> int:
+        # crc32 is stable across processes, unlike hash() of a string.
+        return zlib.crc32(str(value).encode("utf-8")) % len(self.shards)
+
+    def _allocate_keys(self: "ShardedMachineRepository", count: int) -> int:
+        with self._lock:
+            first_key = self._next_key
+            self._next_key += count
+            return first_key
+
+    def _keyed(
+        self: "ShardedMachineRepository", vending_machine: dict, key: int
+    ) -> Document:
+        return Document(
+            {**vending_machine, "items": dict(vending_machine["items"])}, key
+        )
+
+    def exists(self: "ShardedMachineRepository", vending_machine_name: str) -> bool:
+        with self._lock:
+            return vending_machine_name in self._shard_of
+
+    def get(self: "ShardedMachineRepository", vending_machine_name: str) -> dict | None:
+        with self._lock:
+            index = self._shard_of.get(vending_machine_name)
+        if index is None:
+            return None
+        return self.shards[index].get(vending_machine_name)
+
+    def get_many(
+        self: "ShardedMachineRepository", vending_machine_names: Iterable[str]
+    ) -> list[dict]:
+        names_by_shard: dict[int, list[str]] = {}
+        with self._lock:
+            names = [name for name in vending_machine_names if name in self._shard_of]
+            for name in names:
+                names_by_shard.setdefault(self._shard_of[name], []).append(name)
+        vending_machines = {}
+        for index, shard_names in names_by_shard.items():
+            for vending_machine in self.shards[index].get_many(shard_names):
+                vending_machines[vending_machine["name"]] = vending_machine
+        return [vending_machines[name] for name in names if name in vending_machines]
+
+    def all(self: "ShardedMachineRepository") -> list[dict]:
+        return [vending_machine for _, vending_machine in self.iterate()]
+
+    def rows(self: "ShardedMachineRepository") -> list[MachineRow]:
+        return [row for shard in self.shards for row in shard.rows()]
+
+    def iterate(
+        self: "ShardedMachineRepository",
+        after: int | None = None,
+        location: str | None = None,
+        names: Iterable[str] | None = None,
+    ) -> Iterator[tuple[int, dict]]:
+        if names is not None:
+            names = list(names)
+        if location is not None and self.partition == "location":
+            shards = [self.shards[self._hash_index(location)]]
+        else:
+            shards = self.shards
+        # Machines moved in from another shard are stored out of key order.
+        return heapq.merge(
+            *(
+                sorted(shard.iterate(after, location, names), key=itemgetter(0))
+                for shard in shards
+            ),
+            key=itemgetter(0),
+        )
+
+    def insert(self: "ShardedMachineRepository", vending_machine: dict) -> dict:
+        key = getattr(vending_machine, "doc_id", None) or self._allocate_keys(1)
+        index = self.shard_index(vending_machine)
+        vending_machine = self.shards[index].insert(self._keyed(vending_machine, key))
+        with self._lock:
+            self._shard_of[vending_machine["name"]] = index
+            self._next_key = max(self._next_key, key + 1)
+        return vending_machine
+
+    def insert_many(
+        self: "ShardedMachineRepository", vending_machines: Iterable[dict]
+    ) -> None:
+        """
+        Stores new vending machines with distinct names, with one write per shard.
+        Documents carrying a doc_id, e.g. read from another repository, keep it as their key.
+        """
+        vending_machines = list(vending_machines)
+        first_key = self._allocate_keys(len(vending_machines))
+        documents_by_shard: dict[int, list[Document]] = {}
+        for offset, vending_machine in enumerate(vending_machines):
+            key = getattr(vending_machine, "doc_id", None) or first_key + offset
+            documents_by_shard.setdefault(self.shard_index(vending_machine), []).append(
+                self._keyed(vending_machine, key)
+            )
+        for index, documents in documents_by_shard.items():
+            self.shards[index].insert_many(documents)
+            with self._lock:
+                for document in documents:
+                    self._shard_of[document["name"]] = index
+                    self._next_key = max(self._next_key, document.doc_id + 1)
+
+    def update_many(
+        self: "ShardedMachineRepository",
+        vending_machine_names: Iterable[str],
+        transform: Callable[[dict], None],
+    ) -> list[dict]:
+        vending_machine_names = list(vending_machine_names)
+        with self._lock:
+            indexes = [self._shard_of[name] for name in vending_machine_names]
+
+        if len(set(indexes)) == 1:
+            vending_machines = self.shards[indexes[0]].update_many(
+                vending_machine_names, transform
+            )
+        else:
+            vending_machines = self._update_across_shards(
+                vending_machine_names, indexes, transform
+            )
+
+        for old_name, index, vending_machine in zip(
+            vending_machine_names, indexes, vending_machines
+        ):
+            new_index = self.shard_index(vending_machine)
+            if new_index != index:
+                self.shards[new_index].insert(vending_machine)
+                self.shards[index].delete(vending_machine["name"])
+            with self._lock:
+                del self._shard_of[old_name]
+                self._shard_of[vending_machine["name"]] = new_index
+        return vending_machines
+
+    def _update_across_shards(
+        self: "ShardedMachineRepository",
+        vending_machine_names: list[str],
+        indexes: list[int],
+        transform: Callable[[dict], None],
+    ) -> list[dict]:
+        updated_machines = {}
+        for name, index in zip(vending_machine_names, indexes):
+            stored_machine = self.shards[index].get(name)
+            vending_machine = self._keyed(stored_machine, stored_machine.doc_id)
+            transform(vending_machine)
+            updated_machines[name] = vending_machine
+
+        def replace(document: dict) -> None:
+            vending_machine = updated_machines[document["name"]]
+            document.clear()
+            document.update(vending_machine)
+
+        names_by_shard: dict[int, list[str]] = {}
+        for name, index in zip(vending_machine_names, indexes):
+            names_by_shard.setdefault(index, []).append(name)
+        written_machines = {}
+        for index, shard_names in names_by_shard.items():
+            for name, vending_machine in zip(
+                shard_names, self.shards[index].update_many(shard_names, replace)
+            ):
+                written_machines[name] = vending_machine
+        return [written_machines[name] for name in vending_machine_names]
+
+    def delete(self: "ShardedMachineRepository", vending_machine_name: str) -> None:
+        with self._lock:
+            index = self._shard_of[vending_machine_name]
+        self.shards[index].delete(vending_machine_name)
+        with self._lock:
+            del self._shard_of[vending_machine_name]
+
+    def truncate(self: "ShardedMachineRepository") -> None:
+        for shard in self.shards:
+            shard.truncate()
+        with self._lock:
+            self._shard_of.clear()
+
+    def refresh(self: "ShardedMachineRepository", changes: list[StoredChange]) -> None:
+        changes_by_shard: dict[int, list[StoredChange]] = {}
+        with self._lock:
+            for old_name, vending_machine, key in changes:
+                old_index = (
+                    self._shard_of.pop(old_name, None) if old_name is not None else None
+                )
+                new_index = (
+                    self.shard_index(vending_machine)
+                    if vending_machine is not None
+                    else None
+                )
+                if old_index is not None and old_index != new_index:
+                    changes_by_shard.setdefault(old_index, []).append(
+                        (old_name, None, None)
+                    )
+                    old_name = None
+                if new_index is not None:
+                    changes_by_shard.setdefault(new_index, []).append(
+                        (old_name, vending_machine, key)
+                    )
+                    self._shard_of[vending_machine["name"]] = new_index
+                    self._next_key = max(self._next_key, key + 1)
+        for index, shard_changes in changes_by_shard.items():
+            self.shards[index].refresh(shard_changes)
+
+    def io_bytes(self: "ShardedMachineRepository") -> tuple[int, int] | None:
+        counts = [shard.io_bytes() for shard in self.shards]
+        if any(count is None for count in counts):
+            return None
+        return sum(count[0] for count in counts), sum(count[1] for count in counts)
+
+    def close(self: "ShardedMachineRepository") -> None:
+        for shard in self.shards:
+            shard.close()
@@ -0,0 +1,456 @@
+import os
+import threading
+import uuid
+from contextlib import contextmanager
+from typing import Callable, Iterable, Iterator
+
+from database import fast_json
+from database.machine_repository import (
+    ApplyChange,
+    MachineRepository,
+    MachineRow,
+    Reload,
+    StoredChange,
+)
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows
+    fcntl = None
+
+DEFAULT_MAX_JOURNAL_BYTES = 1 << 20
+
+
+class SharedMachineRepository(MachineRepository):
+    """
+    Repository decorator letting several processes, e.g. the workers of a pre-fork server, share one storage.
+
+    Every call holds an advisory lock on ``<path>.lock``, shared for reads and exclusive for writes, so a
+    process never reads a file another one is rewriting. Each write is also appended to the journal
+    ``<path>.changes`` with a sequence number global to all the processes and the storage key of the machine.
+    A process reading new journal entries applies them to the in-memory indexes of the wrapped repository
+    with MachineRepository.refresh, and hands them to the functions registered with watch, which keep
+    the vending machine service's records, indexes and caches up to date. The sequence numbers serve as
+    machine versions, so every process computes the same ETag for the same data.
+
+    The journal starts over once its entries exceed ``max_journal_bytes``. The header of the new journal
+    carries a rotation generation and the versions recorded so far. Every process keeps its journal open, so
+    one still within the previous journal finishes it from its offset and switches over without reloading.
+    Processes that missed a whole journal, or read a purge, reopen the wrapped repository and reload the
+    machines from the storage.
+    The wrapped repository must not keep writes in memory: use the 'json' TinyDB storage or SQLite,
+    not the log backend.
+    """
+
+    def __init__(
+        self: "SharedMachineRepository",
+        open_repository: Callable[[], MachineRepository],
+        path: str,
+        max_journal_bytes: int = DEFAULT_MAX_JOURNAL_BYTES,
+    ) -> None:
+        if fcntl is None:
+            raise ValueError(
+                "Sharing the database between processes requires POSIX file locks"
+            )
+        self._open_repository = open_repository
+        self._lock_path = path + ".lock"
+        self._journal_path = path + ".changes"
+        os.makedirs(os.path.dirname(self._lock_path) or ".", exist_ok=True)
+        self.max_journal_bytes = max_journal_bytes
+        self.repository: MachineRepository | None = None
+        self.epoch: str | None = None
+        self._pid: int | None = None
+        self._lock_file = None
+        self._thread_lock = threading.RLock()
+        self._lock_depth = 0
+        self._exclusive = False
+        # Position in the journal: the open journal, which keeps its inode from being reused, its inode
+        # and rotation generation, the offset its entries start at, the bytes read and the last sequence.
+        self._journal_file = None
+        self._journal_inode: int | None = None
+        self._generation = 0
+        self._entries_offset = 0
+        self._offset = 0
+        self._sequence = 0
+        # Sequence of the last purge, or of the first journal, and of the last change of each machine since.
+        self._base_sequence = 0
+        self._versions: dict[str, int] = {}
+        self._pending: list[tuple[int, str | None, dict | None]] = []
+        self._needs_reload = False
+        # Changes of other processes not applied to the wrapped repository yet, None when it must be reopened.
+        self._stored_changes: list[StoredChange] | None = []
+        self._apply_change: ApplyChange | None = None
+        self._reload: Reload | None = None
+        with self._locked(exclusive=True):
+            pass
+
+    def _ensure_process(self: "SharedMachineRepository") -> None:
+        # A forked worker shares the lock file description with its parent, so the lock would not
+        # exclude them; it opens its own, and its own connection to the storage.
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._lock_file = open(self._lock_path, "a")
+        self.repository = self._open_repository()
+
+    @contextmanager
+    def _locked(self: "SharedMachineRepository", exclusive: bool) -> Iterator[None]:
+        """
+        Hold the lock of the storage and catch up with the journal.
+        Nested calls reuse the lock already held, which must be exclusive if an exclusive lock is requested.
+
+        Parameters:
+            exclusive (bool): Exclude the other processes, for writes, instead of only their writes.
+
+        Returns:
+            Iterator[None]: Context manager holding the lock.
+        """
+        with self._thread_lock:
+            if self._lock_depth == 0:
+                self._ensure_process()
+                fcntl.flock(
+                    self._lock_file.fileno(),
+                    fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH,
+                )
+                self._exclusive = exclusive
+                try:
+                    self._read_journal()
+                except BaseException:
+                    fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+                    raise
+            elif exclusive and not self._exclusive:
+                raise RuntimeError("A shared lock of the storage cannot be upgraded")
+            self._lock_depth += 1
+            try:
+                yield
+            finally:
+                self._lock_depth -= 1
+                if self._lock_depth == 0:
+                    fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _read_journal(self: "SharedMachineRepository") -> None:
+        first_read = self._journal_inode is None
+        try:
+            status = os.stat(self._journal_path)
+        except FileNotFoundError:
+            status = None
+
+        if status is not None:
+            if status.st_ino != self._journal_inode:
+                self._switch_journal(status.st_ino, first_read)
+            if status.st_size > self._offset:
+                self._read_entries()
+        if self._exclusive and (
+            status is None
+            or self._offset - self._entries_offset > self.max_journal_bytes
+        ):
+            # Only a writer, caught up with the journal, starts a new one.
+            self._start_journal()
+            if status is None:
+                self._needs_reload = True
+        stored_changes, self._stored_changes = self._stored_changes, []
+        if first_read:
+            # The wrapped repository was just opened from the current storage.
+            return
+        if stored_changes is None:
+            self.repository.close()
+            self.repository = self._open_repository()
+        elif stored_changes:
+            self.repository.refresh(stored_changes)
+
+    def _switch_journal(
+        self: "SharedMachineRepository", inode: int, first_read: bool
+    ) -> None:
+        """
+        Move to a new journal, after finishing the previous one if this process was still reading it.
+
+        Parameters:
+            inode (int): Inode of the new journal.
+            first_read (bool): The wrapped repository was just opened, nothing was read yet.
+
+        Returns:
+            None
+        """
+        journal_file = open(self._journal_path, "rb")
+        header = fast_json.loads(journal_file.readline())
+        entries_offset = journal_file.tell()
+        generation = header.get("generation", 0)
+        if (
+            not first_read
+            and header["sequence"] != self._sequence
+            and generation == self._generation + 1
+        ):
+            # The previous journal is still open, read the entries written after its offset.
+            self._read_entries()
+        if self._journal_file is not None:
+            self._journal_file.close()
+        self._journal_file = journal_file
+        self.epoch = header["epoch"]
+        self._journal_inode = inode
+        self._generation = generation
+        self._entries_offset = self._offset = entries_offset
+        if not first_read and header["sequence"] == self._sequence:
+            # Caught up with the previous journal: keep applying the entries one by one.
+            return
+        if not first_read:
+            self._stored_changes = None
+        self._sequence = header["sequence"]
+        self._base_sequence = header.get("base", header["sequence"])
+        self._versions = dict(header.get("versions", {}))
+        self._pending.clear()
+        self._needs_reload = True
+
+    def _read_entries(self: "SharedMachineRepository") -> None:
+        # pread leaves the file position alone, a forked worker shares it with its parent.
+        descriptor = self._journal_file.fileno()
+        content = os.pread(
+            descriptor, os.fstat(descriptor).st_size - self._offset, self._offset
+        )
+        # A line without its newline was cut by a crash while appending, the next writer drops it.
+        content = content[: content.rfind(b"\n") + 1]
+        self._offset += len(content)
+        for line in content.splitlines():
+            entry = fast_json.loads(line)
+            if entry.get("truncate"):
+                self._record_truncate(entry["sequence"])
+                self._stored_changes = None
+                continue
+            self._record(entry["sequence"], entry["old"], entry["new"])
+            if not self._needs_reload:
+                self._pending.append((entry["sequence"], entry["old"], entry["new"]))
+            if self._stored_changes is not None:
+                if "key" not in entry:
+                    # Written before keys were journaled.
+                    self._stored_changes = None
+                else:
+                    self._stored_changes.append(
+                        (entry["old"], entry["new"], entry.get("key"))
+                    )
+
+    def _record(
+        self: "SharedMachineRepository",
+        sequence: int,
+        old_name: str | None,
+        new_vending_machine: dict | None,
+    ) -> None:
+        self._sequence = sequence
+        if old_name is not None:
+            self._versions.pop(old_name, None)
+        if new_vending_machine is not None:
+            self._versions[new_vending_machine["name"]] = sequence
+
+    def _record_truncate(self: "SharedMachineRepository", sequence: int) -> None:
+        self._sequence = self._base_sequence = sequence
+        self._versions.clear()
+        self._pending.clear()
+        self._needs_reload = True
+
+    def _start_journal(self: "SharedMachineRepository") -> None:
+        self.epoch = self.epoch or uuid.uuid4().hex[:8]
+        if self._journal_file is not None:
+            # Readers behind this writer finish the previous journal through their open file.
+            self._generation += 1
+        else:
+            self._base_sequence = self._sequence
+            self._versions.clear()
+        header = fast_json.dumps(
+            {
+                "epoch": self.epoch,
+                "sequence": self._sequence,
+                "generation": self._generation,
+                "base": self._base_sequence,
+                "versions": self._versions,
+            }
+        )
+        temp_path = self._journal_path + ".tmp"
+        journal_file = open(temp_path, "w+b")
+        journal_file.write(header + b"\n")
+        journal_file.flush()
+        os.replace(temp_path, self._journal_path)
+        if self._journal_file is not None:
+            self._journal_file.close()
+        self._journal_file = journal_file
+        self._journal_inode = os.fstat(journal_file.fileno()).st_ino
+        self._entries_offset = self._offset = journal_file.tell()
+
+    def _append(self: "SharedMachineRepository", changes: list[StoredChange]) -> None:
+        """
+        Record the changes written by this process in the journal, the caller holds the exclusive lock.
+
+        Parameters:
+            changes (list[StoredChange]): The previous name of each changed vending machine, None if it was
+            created, the vending machine after the change, None if it was deleted, and its storage key.
+
+        Returns:
+            None
+        """
+        lines = []
+        for old_name, new_vending_machine, key in changes:
+            self._record(self._sequence + 1, old_name, new_vending_machine)
+            lines.append(
+                fast_json.dumps(
+                    {
+                        "sequence": self._sequence,
+                        "old": old_name,
+                        "new": new_vending_machine,
+                        "key": key,
+                    }
+                )
+            )
+        self._write_lines(lines)
+
+    def _write_lines(self: "SharedMachineRepository", lines: list[bytes]) -> None:
+        with open(self._journal_path, "r+b") as handle:
+            handle.truncate(self._offset)
+            handle.seek(self._offset)
+            handle.write(b"".join(line + b"\n" for line in lines))
+            self._offset = handle.tell()
+
+    @staticmethod
+    def _key_of(vending_machine: dict) -> int | None:
+        # Backends returning plain dicts, such as SQLite, keep no in-memory index needing the key.
+        return getattr(vending_machine, "doc_id", None)
+
+    def watch(
+        self: "SharedMachineRepository", apply_change: ApplyChange, reload: Reload
+    ) -> str | None:
+        with self._locked(exclusive=False):
+            self._apply_change = apply_change
+            self._reload = reload
+            self._needs_reload = True
+            self._dispatch()
+            return self.epoch
+
+    def _dispatch(self: "SharedMachineRepository") -> None:
+        if self._reload is None:
+            self._pending.clear()
+            self._needs_reload = False
+            return
+        if self._needs_reload:
+            self._pending.clear()
+            self._needs_reload = False
+            self._reload(self._base_sequence, dict(self._versions), self._sequence)
+            return
+        pending, self._pending = self._pending, []
+        for sequence, old_name, new_vending_machine in pending:
+            self._apply_change(sequence, old_name, new_vending_machine)
+
+    def sync(self: "SharedMachineRepository") -> None:
+        with self._locked(exclusive=False):
+            self._dispatch()
+
+    @contextmanager
+    def write_lock(self: "SharedMachineRepository") -> Iterator[None]:
+        with self._locked(exclusive=True):
+            self._dispatch()
+            yield
+
+    def _read(self: "SharedMachineRepository", call: Callable[[], object]) -> object:
+        with self._locked(exclusive=False):
+            return call()
+
+    def exists(self: "SharedMachineRepository", vending_machine_name: str) -> bool:
+        return self._read(lambda: self.repository.exists(vending_machine_name))
+
+    def get(self: "SharedMachineRepository", vending_machine_name: str) -> dict | None:
+        return self._read(lambda: self.repository.get(vending_machine_name))
+
+    def get_many(
+        self: "SharedMachineRepository", vending_machine_names: Iterable[str]
+    ) -> list[dict]:
+        return self._read(lambda: self.repository.get_many(vending_machine_names))
+
+    def all(self: "SharedMachineRepository") -> list[dict]:
+        return self._read(lambda: self.repository.all())
+
+    def rows(self: "SharedMachineRepository") -> list[MachineRow]:
+        return self._read(lambda: self.repository.rows())
+
+    def iterate(
+        self: "SharedMachineRepository",
+        after: int | None = None,
+        location: str | None = None,
+        names: Iterable[str] | None = None,
+    ) -> Iterator[tuple[int, dict]]:
+        # Read at once, another process may rewrite the storage as soon as the lock is released.
+        return iter(
+            self._read(lambda: list(self.repository.iterate(after, location, names)))
+        )
+
+    def insert(self: "SharedMachineRepository", vending_machine: dict) -> dict:
+        with self._locked(exclusive=True):
+            vending_machine = self.repository.insert(vending_machine)
+            self._append([(None, vending_machine, self._key_of(vending_machine))])
+            return vending_machine
+
+    def insert_many(
+        self: "SharedMachineRepository", vending_machines: Iterable[dict]
+    ) -> None:
+        vending_machines = list(vending_machines)
+        with self._locked(exclusive=True):
+            self.repository.insert_many(vending_machines)
+            # insert_many does not return the stored machines, read back their keys.
+            keys = dict(
+                (vending_machine["name"], key)
+                for key, vending_machine in self.repository.iterate(
+                    names=[
+                        vending_machine["name"] for vending_machine in vending_machines
+                    ]
+                )
+            )
+            self._append(
+                [
+                    (None, vending_machine, keys[vending_machine["name"]])
+                    for vending_machine in vending_machines
+                ]
+            )
+
+    def update_many(
+        self: "SharedMachineRepository",
+        vending_machine_names: Iterable[str],
+        transform: Callable[[dict], None],
+    ) -> list[dict]:
+        vending_machine_names = list(vending_machine_names)
+        with self._locked(exclusive=True):
+            vending_machines = self.repository.update_many(
+                vending_machine_names, transform
+            )
+            self._append(
+                [
+                    (old_name, vending_machine, self._key_of(vending_machine))
+                    for old_name, vending_machine in zip(
+                        vending_machine_names, vending_machines
+                    )
+                ]
+            )
+            return vending_machines
+
+    def delete(self: "SharedMachineRepository", vending_machine_name: str) -> None:
+        with self._locked(exclusive=True):
+            self.repository.delete(vending_machine_name)
+            self._append([(vending_machine_name, None, None)])
+
+    def truncate(self: "SharedMachineRepository") -> None:
+        with self._locked(exclusive=True):
+            self.repository.truncate()
+            self._sequence = self._base_sequence = self._sequence + 1
+            self._versions.clear()
+            self._write_lines(
+                [fast_json.dumps({"sequence": self._sequence, "truncate": True})]
+            )
+
+    def io_bytes(self: "SharedMachineRepository") -> tuple[int, int] | None:
+        return self.repository.io_bytes()
+
+    def close(self: "SharedMachineRepository") -> None:
+        with self._thread_lock:
+            self.repository.close()
+            if self._lock_file is not None:
+                self._lock_file.close()
+                self._lock_file = None
+            if self._journal_file is not None:
+                # Reopening reads the storage and the journal as a new process would.
+                self._journal_file.close()
+                self._journal_file = None
+                self._journal_inode = None
+            self._pid = None
@@ -0,0 +1,106 @@
+"""
+Convert the vending machines between a database and a binary snapshot file, see database.binary_snapshot.
+
+Run from the project root while the API is stopped:
+    python -m database.snapshot_tool export machines.snapshot                  # db.json to a snapshot
+    python -m database.snapshot_tool import machines.snapshot --backend sqlite # a snapshot to db.sqlite3
+"""
+
+import argparse
+import os
+import sys
+
+from tinydb.table import Document
+
+from database.binary_snapshot import BinarySnapshot, write_snapshot
+from database.db_manager import get_machine_repository
+
+
+def export_snapshot(
+    path: str, snapshot_path: str, backend: str | None = None, test: bool = False
+) -> int:
+    """
+    Write every vending machine of a database to a binary snapshot. Machines keep their keys.
+
+    Parameters:
+        path (str): Directory holding the database files.
+        snapshot_path (str): The snapshot file to write.
+        backend (str | None): The backend to read the machines from, DB_BACKEND by default.
+        test (bool): Export the test database instead of the main one.
+
+    Returns:
+        int: The number of vending machines exported.
+    """
+    repository = get_machine_repository(path, backend=backend, test=test)
+    try:
+        vending_machines = list(repository.iterate())
+    finally:
+        repository.close()
+    write_snapshot(snapshot_path, vending_machines)
+    return len(vending_machines)
+
+
+def import_snapshot(
+    path: str, snapshot_path: str, backend: str | None = None, test: bool = False
+) -> int:
+    """
+    Insert every vending machine of a binary snapshot into an empty database. Machines keep their keys
+    where the backend stores them, so pagination cursors stay valid.
+
+    Parameters:
+        path (str): Directory holding the database files.
+        snapshot_path (str): The snapshot file to read.
+        backend (str | None): The backend to write the machines to, DB_BACKEND by default.
+        test (bool): Import into the test database instead of the main one.
+
+    Raises:
+        ValueError: If the file is not a snapshot or the database already holds vending machines.
+
+    Returns:
+        int: The number of vending machines imported.
+    """
+    snapshot = BinarySnapshot(snapshot_path)
+    try:
+        vending_machines = [
+            Document(vending_machine, key) for key, vending_machine in snapshot
+        ]
+    finally:
+        snapshot.close()
+    repository = get_machine_repository(path, backend=backend, test=test)
+    try:
+        if next(repository.iterate(), None) is not None:
+            raise ValueError(
+                "The database already holds vending machines, purge it before importing"
+            )
+        repository.insert_many(vending_machines)
+    finally:
+        repository.close()
+    return len(vending_machines)
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("command", choices=["export", "import"])
+    parser.add_argument("snapshot", help="the binary snapshot file")
+    parser.add_argument("--path", default=os.getenv("DB_PATH") or "./database/")
+    parser.add_argument(
+        "--backend", help="tinydb, sqlite, log or sharded, DB_BACKEND by default"
+    )
+    parser.add_argument("--test", action="store_true", help="use the test database")
+    args = parser.parse_args(argv)
+
+    if args.command == "export":
+        count = export_snapshot(args.path, args.snapshot, args.backend, args.test)
+        print(f"Exported {count} vending machines to {args.snapshot}")
+    else:
+        try:
+            count = import_snapshot(args.path, args.snapshot, args.backend, args.test)
+        except ValueError as error:
+            print(error, file=sys.stderr)
+            return 1
+        print(f"Imported {count} vending machines from {args.snapshot}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
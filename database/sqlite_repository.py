@@ -0,0 +1,282 @@
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Callable, Iterable, Iterator
+
+from database import fast_json
+from database.machine_repository import MachineRepository
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS machines (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    location TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS machines_location ON machines (location);
+CREATE TABLE IF NOT EXISTS items (
+    id INTEGER PRIMARY KEY,
+    machine_id INTEGER NOT NULL REFERENCES machines (id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    amount INTEGER NOT NULL,
+    UNIQUE (machine_id, name)
+);
+"""
+
+SELECT_MACHINE = "SELECT id, name, location FROM machines WHERE name = ?"
+SELECT_ALL_MACHINES = "SELECT id, name, location FROM machines ORDER BY id"
+SELECT_MACHINE_ITEMS = "SELECT name, amount FROM items WHERE machine_id = ? ORDER BY id"
+SELECT_ALL_ITEMS = "SELECT machine_id, name, amount FROM items ORDER BY machine_id, id"
+SELECT_MACHINE_CHUNK = (
+    "SELECT id, name, location FROM machines WHERE id > ? ORDER BY id LIMIT ?"
+)
+SELECT_LOCATION_MACHINE_CHUNK = (
+    "SELECT id, name, location FROM machines "
+    "WHERE location = ? AND id > ? ORDER BY id LIMIT ?"
+)
+SELECT_NAMED_MACHINE_CHUNK = (
+    "SELECT id, name, location FROM machines "
+    "WHERE name IN (SELECT value FROM json_each(?)) AND (? IS NULL OR location = ?) "
+    "AND id > ? ORDER BY id LIMIT ?"
+)
+SELECT_ITEM_CHUNK = (
+    "SELECT machine_id, name, amount FROM items "
+    "WHERE machine_id BETWEEN ? AND ? ORDER BY machine_id, id"
+)
+# The ids are passed as one JSON array, so the statement stays constant whatever their number.
+SELECT_MACHINE_ITEMS_CHUNK = (
+    "SELECT machine_id, name, amount FROM items "
+    "WHERE machine_id IN (SELECT value FROM json_each(?)) ORDER BY machine_id, id"
+)
+ITERATE_CHUNK_SIZE = 500
+INSERT_MACHINE = "INSERT INTO machines (name, location) VALUES (?, ?)"
+UPDATE_MACHINE = "UPDATE machines SET name = ?, location = ? WHERE id = ?"
+DELETE_MACHINE = "DELETE FROM machines WHERE name = ?"
+UPSERT_ITEM = (
+    "INSERT INTO items (machine_id, name, amount) VALUES (?, ?, ?) "
+    "ON CONFLICT (machine_id, name) DO UPDATE SET amount = excluded.amount"
+)
+DELETE_ITEM = "DELETE FROM items WHERE machine_id = ? AND name = ?"
+
+
+def _json_array(values: Iterable) -> str:
+    # Passed as text: SQLite 3.45 and later read a BLOB argument of json_each as binary JSONB.
+    return fast_json.dumps(list(values)).decode("utf-8")
+
+
+class SQLiteMachineRepository(MachineRepository):
+    """
+    Repository storing vending machines in SQLite, with one row per machine and one row per item.
+    Item changes only touch the rows of the items that actually changed.
+    The database runs in WAL mode and every statement is a parameterized constant,
+    so it is prepared once and reused from the connection's statement cache.
+    """
+
+    def __init__(self: "SQLiteMachineRepository", path: str) -> None:
+        self._connection = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None
+        )
+        self._lock = threading.RLock()
+        self._connection.execute("PRAGMA journal_mode = WAL")
+        self._connection.execute("PRAGMA synchronous = NORMAL")
+        self._connection.execute("PRAGMA foreign_keys = ON")
+        self._connection.executescript(SCHEMA)
+
+    @contextmanager
+    def _transaction(self: "SQLiteMachineRepository") -> Iterator[sqlite3.Connection]:
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._connection
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._connection.execute("COMMIT")
+
+    def _load(
+        self: "SQLiteMachineRepository", vending_machine_name: str
+    ) -> tuple[int, dict] | None:
+        row = self._connection.execute(
+            SELECT_MACHINE, (vending_machine_name,)
+        ).fetchone()
+        if row is None:
+            return None
+        machine_id, name, location = row
+        items = dict(self._connection.execute(SELECT_MACHINE_ITEMS, (machine_id,)))
+        return machine_id, {"name": name, "location": location, "items": items}
+
+    def exists(self: "SQLiteMachineRepository", vending_machine_name: str) -> bool:
+        with self._lock:
+            row = self._connection.execute(
+                SELECT_MACHINE, (vending_machine_name,)
+            ).fetchone()
+        return row is not None
+
+    def get(self: "SQLiteMachineRepository", vending_machine_name: str) -> dict | None:
+        with self._lock:
+            loaded = self._load(vending_machine_name)
+        return loaded[1] if loaded is not None else None
+
+    def get_many(
+        self: "SQLiteMachineRepository", vending_machine_names: Iterable[str]
+    ) -> list[dict]:
+        with self._lock:
+            loaded = [self._load(name) for name in vending_machine_names]
+        return [machine for _, machine in filter(None, loaded)]
+
+    def all(self: "SQLiteMachineRepository") -> list[dict]:
+        with self._lock:
+            machines = {
+                machine_id: {"name": name, "location": location, "items": {}}
+                for machine_id, name, location in self._connection.execute(
+                    SELECT_ALL_MACHINES
+                )
+            }
+            for machine_id, name, amount in self._connection.execute(SELECT_ALL_ITEMS):
+                machines[machine_id]["items"][name] = amount
+        return list(machines.values())
+
+    def iterate(
+        self: "SQLiteMachineRepository",
+        after: int | None = None,
+        location: str | None = None,
+        names: Iterable[str] | None = None,
+    ) -> Iterator[tuple[int, dict]]:
+        # Keyset pagination in chunks, the lock is released between chunks.
+        # The location filter is served by the machines_location index and the names by the
+        # unique index on name, whose entries also carry the row id used as key.
+        last_id = after if after is not None else 0
+        encoded_names = None if names is None else _json_array(names)
+        while True:
+            with self._lock:
+                if encoded_names is not None:
+                    rows = self._connection.execute(
+                        SELECT_NAMED_MACHINE_CHUNK,
+                        (
+                            encoded_names,
+                            location,
+                            location,
+                            last_id,
+                            ITERATE_CHUNK_SIZE,
+                        ),
+                    )
+                elif location is None:
+                    rows = self._connection.execute(
+                        SELECT_MACHINE_CHUNK, (last_id, ITERATE_CHUNK_SIZE)
+                    )
+                else:
+                    rows = self._connection.execute(
+                        SELECT_LOCATION_MACHINE_CHUNK,
+                        (location, last_id, ITERATE_CHUNK_SIZE),
+                    )
+                machines = {
+                    machine_id: {
+                        "name": name,
+                        "location": machine_location,
+                        "items": {},
+                    }
+                    for machine_id, name, machine_location in rows
+                }
+                if not machines:
+                    return
+                last_id = max(machines)
+                if location is None and names is None:
+                    # The chunk holds every machine of its id range.
+                    item_rows = self._connection.execute(
+                        SELECT_ITEM_CHUNK, (min(machines), last_id)
+                    )
+                else:
+                    # Only the items of the matching machines, not of every machine in between.
+                    item_rows = self._connection.execute(
+                        SELECT_MACHINE_ITEMS_CHUNK, (_json_array(machines),)
+                    )
+                for machine_id, name, amount in item_rows:
+                    machines[machine_id]["items"][name] = amount
+            yield from machines.items()
+
+    def _insert(
+        self: "SQLiteMachineRepository",
+        connection: sqlite3.Connection,
+        vending_machine: dict,
+    ) -> None:
+        machine_id = connection.execute(
+            INSERT_MACHINE, (vending_machine["name"], vending_machine["location"])
+        ).lastrowid
+        connection.executemany(
+            UPSERT_ITEM,
+            [
+                (machine_id, item_name, amount)
+                for item_name, amount in vending_machine["items"].items()
+            ],
+        )
+
+    def insert(self: "SQLiteMachineRepository", vending_machine: dict) -> dict:
+        with self._transaction() as connection:
+            self._insert(connection, vending_machine)
+        return {**vending_machine, "items": dict(vending_machine["items"])}
+
+    def insert_many(
+        self: "SQLiteMachineRepository", vending_machines: Iterable[dict]
+    ) -> None:
+        with self._transaction() as connection:
+            for vending_machine in vending_machines:
+                self._insert(connection, vending_machine)
+
+    def update_many(
+        self: "SQLiteMachineRepository",
+        vending_machine_names: Iterable[str],
+        transform: Callable[[dict], None],
+    ) -> list[dict]:
+        updated_machines = []
+        with self._transaction():
+            for vending_machine_name in vending_machine_names:
+                machine_id, machine = self._load(vending_machine_name)
+                old_machine = {**machine, "items": dict(machine["items"])}
+                transform(machine)
+                self._write_changes(machine_id, old_machine, machine)
+                updated_machines.append({**machine, "items": dict(machine["items"])})
+        return updated_machines
+
+    def _write_changes(
+        self: "SQLiteMachineRepository",
+        machine_id: int,
+        old_machine: dict,
+        machine: dict,
+    ) -> None:
+        if (
+            machine["name"] != old_machine["name"]
+            or machine["location"] != old_machine["location"]
+        ):
+            self._connection.execute(
+                UPDATE_MACHINE, (machine["name"], machine["location"], machine_id)
+            )
+        old_items = old_machine["items"]
+        new_items = machine["items"]
+        self._connection.executemany(
+            UPSERT_ITEM,
+            [
+                (machine_id, item_name, amount)
+                for item_name, amount in new_items.items()
+                if old_items.get(item_name) != amount
+            ],
+        )
+        self._connection.executemany(
+            DELETE_ITEM,
+            [
+                (machine_id, item_name)
+                for item_name in old_items
+                if item_name not in new_items
+            ],
+        )
+
+    def delete(self: "SQLiteMachineRepository", vending_machine_name: str) -> None:
+        with self._transaction() as connection:
+            connection.execute(DELETE_MACHINE, (vending_machine_name,))
+
+    def truncate(self: "SQLiteMachineRepository") -> None:
+        with self._transaction() as connection:
+            connection.execute("DELETE FROM items")
+            connection.execute("DELETE FROM machines")
+
+    def close(self: "SQLiteMachineRepository") -> None:
+        with self._lock:
+            self._connection.close()
@@ -1,18 +1,199 @@
-import os
-
-from dotenv import load_dotenv
-from flask import Blueprint, Response, jsonify, request
-
-from database.db_manager import get_db
-from services.vending_machine_service import VendingMachineService
+import hashlib
+import time
+from typing import Callable, Hashable, Iterator
+
+from flask import (
+    Blueprint,
+    Response,
+    current_app,
+    g,
+    jsonify,
+    request,
+    stream_with_context,
+)
+from werkzeug.local import LocalProxy
+
+from database import fast_json
+from routes.app_state import get_app_state
+from services.idempotency import (
+    IdempotencyKeyInProgressError,
+    IdempotencyKeyReusedError,
+    IdempotencyStore,
+    IdempotencyStoreFullError,
+)
+from services.metrics import MetricsRegistry
+from services.response_cache import ResponseCache
+from services.vending_machine_service import (
+    DEFAULT_PAGE_SIZE,
+    MACHINE_FIELDS,
+    MAX_PAGE_SIZE,
+    VendingMachineService,
+    VersionConflictError,
+)
 
 vending_machine_controller = Blueprint(
     "vending_machine_controller", __name__, url_prefix="/api"
 )
 
-load_dotenv()
-db = get_db(os.getenv("DB_PATH"))
-machine_service = VendingMachineService(db)
+# The services of the app handling the request, see routes.app_state. The database is opened on first use.
+machine_service: VendingMachineService = LocalProxy(
+    lambda: get_app_state().machine_service
+)
+metrics: MetricsRegistry = LocalProxy(lambda: get_app_state().metrics)
+response_cache: ResponseCache = LocalProxy(lambda: get_app_state().response_cache)
+idempotency_store: IdempotencyStore = LocalProxy(
+    lambda: get_app_state().idempotency_store
+)
+# Seconds without change after which the change stream sends a comment, so proxies keep it open.
+CHANGE_STREAM_KEEPALIVE = 15.0
+# Response headers replayed along the body for a retried request.
+IDEMPOTENT_RESPONSE_HEADERS = ("Content-Type", "ETag")
+
+
+@vending_machine_controller.before_request
+def start_request_timing() -> None:
+    g.request_start = time.perf_counter()
+    g.request_timing_token = metrics.start_request_timing()
+
+
+@vending_machine_controller.before_request
+def sync_with_other_processes() -> None:
+    # Other workers sharing the database may have changed it since the last request.
+    machine_service.sync_changes()
+
+
+@vending_machine_controller.after_request
+def record_request_timing(response: Response) -> Response:
+    # Streamed responses are timed until their headers are sent.
+    storage_seconds, storage_calls = metrics.stop_request_timing(g.request_timing_token)
+    seconds = time.perf_counter() - g.request_start
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    metrics.observe_request(request.method, route, response.status_code, seconds)
+    if current_app.config["SERVER_TIMING"]:
+        response.headers["Server-Timing"] = (
+            f'storage;dur={storage_seconds * 1000:.3f};desc="{storage_calls} calls", '
+            f"total;dur={seconds * 1000:.3f}"
+        )
+    return response
+
+
+@vending_machine_controller.before_request
+def replay_idempotent_request() -> Response | tuple[Response, int] | None:
+    # A POST sent with an Idempotency-Key runs once, its retries get the stored response.
+    key = request.headers.get("Idempotency-Key")
+    if key is None or request.method != "POST":
+        return None
+    fingerprint = hashlib.sha256(
+        request.path.encode("utf-8") + b"\n" + request.get_data()
+    ).hexdigest()
+    try:
+        stored_response = idempotency_store.begin(key, fingerprint)
+    except IdempotencyKeyReusedError as e:
+        return jsonify(success=False, message=str(e)), 422
+    except IdempotencyKeyInProgressError as e:
+        return jsonify(success=False, message=str(e)), 409
+    except IdempotencyStoreFullError as e:
+        response = jsonify(success=False, message=str(e))
+        response.headers["Retry-After"] = "1"
+        return response, 503
+    if stored_response is None:
+        g.idempotency_key = key
+        return None
+    status, body, headers = stored_response
+    response = Response(body, status=status, headers=headers)
+    response.headers["Idempotent-Replayed"] = "true"
+    return response
+
+
+@vending_machine_controller.after_request
+def store_idempotent_response(response: Response) -> Response:
+    key = g.pop("idempotency_key", None)
+    if key is not None:
+        if response.status_code >= 500:
+            # Failures are not remembered, the retry runs the request again.
+            idempotency_store.abandon(key)
+        else:
+            idempotency_store.complete(
+                key,
+                (
+                    response.status_code,
+                    response.get_data(),
+                    [
+                        (name, value)
+                        for name, value in response.headers
+                        if name in IDEMPOTENT_RESPONSE_HEADERS
+                    ],
+                ),
+            )
+    return response
+
+
+@vending_machine_controller.teardown_request
+def release_idempotency_key(error: BaseException | None) -> None:
+    # Only left when the request raised before a response was made.
+    key = g.pop("idempotency_key", None)
+    if key is not None:
+        idempotency_store.abandon(key)
+
+
+def cached_json_response(
+    key: Hashable,
+    version: int | str,
+    render: Callable[[], tuple[Response, int | str | None]],
+) -> Response:
+    """
+    Answer a read from the response cache, or with 304 Not Modified when the client already holds it.
+    The ETag is built from the version of the data the response shows, so it is known without reading
+    the storage, and render is only called on a cache miss. render returns the response and the version
+    of the data it rendered, which a write made meanwhile may have moved past version: the response is then
+    cached and tagged under the rendered version, or neither cached nor tagged when that version is None.
+    """
+    etag = f"{machine_service.epoch}-{version}"
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        body = response_cache.get(key, etag)
+        if body is None:
+            response, rendered_version = render()
+            if rendered_version is None:
+                return response
+            etag = f"{machine_service.epoch}-{rendered_version}"
+            response_cache.put(key, etag, response.get_data())
+        else:
+            response = Response(body, mimetype="application/json")
+    response.set_etag(etag)
+    return response
+
+
+def get_expected_version() -> int | None:
+    """
+    The vending machine version a write is conditioned on by the If-Match header, None without one.
+
+    Raises:
+        VersionConflictError: If no ETag of If-Match is a version of this server, e.g. one of a previous process.
+    """
+    if not request.if_match or request.if_match.star_tag:
+        return None
+    for etag in request.if_match.as_set():
+        epoch, _, version = etag.partition("-")
+        version = version.split("-", 1)[0]
+        if epoch == machine_service.epoch and version.isdigit():
+            return int(version)
+    raise VersionConflictError("If-Match does not hold a current vending machine ETag.")
+
+
+def machine_response(vending_machine: dict) -> Response:
+    """JSON response of a vending machine, with its version as ETag when the document carries one."""
+    response = jsonify(success=True, message=vending_machine)
+    version = getattr(vending_machine, "version", None)
+    if version is not None:
+        response.set_etag(f"{machine_service.epoch}-{version}")
+    return response
+
+
+@vending_machine_controller.route("/metrics", methods=["GET"])
+def get_metrics_api() -> Response:
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
 
 
 @vending_machine_controller.route("/purge-database", methods=["GET"])
@@ -53,7 +234,7 @@ def create_vending_machine_api() -> tuple[Response, int]:
         vending_machine = machine_service.create_new_vending_machine(
             vending_machine_name, location
         )
-        return jsonify(success=True, message=vending_machine), 200
+        return machine_response(vending_machine), 200
     except ValueError as ve:
         return jsonify(success=False, message=str(ve)), 400
     except Exception as e:
@@ -67,7 +248,7 @@ def get_vending_machine_info_api() -> tuple[Response, int]:
     if "name" not in request_json_data:
         return jsonify(success=False, message="Missing 'name' in the request data"), 400
 
-    if len(request_json_data) > 1:
+    if len(request_json_data.keys() - {"name", "fields"}) > 0:
         return (
             jsonify(
                 success=False,
@@ -77,21 +258,146 @@ def get_vending_machine_info_api() -> tuple[Response, int]:
         )
 
     vending_machine_name = request_json_data["name"]
+    fields = request_json_data.get("fields")
+    fields_key = (
+        ",".join(fields)
+        if isinstance(fields, list) and all(isinstance(field, str) for field in fields)
+        else None
+    )
+
+    def tagged(version: int) -> str:
+        # Versions are unique across machines, the name is only needed in the cache key.
+        return str(version) if fields_key is None else f"{version}-{fields_key}"
+
+    def render() -> tuple[Response, str]:
+        # The document carries the version of the record it was read from, a write made since
+        # the ETag was computed gives the response the newer version instead of caching it under the older one.
+        vending_machine = machine_service.get_vending_machine_info(
+            vending_machine_name, fields
+        )
+        return jsonify(success=True, message=vending_machine), tagged(
+            vending_machine.version
+        )
 
     try:
-        vending_machine = machine_service.get_vending_machine_info(vending_machine_name)
-        return jsonify(success=True, message=vending_machine), 200
+        if fields is not None and not (
+            isinstance(fields, list)
+            and fields
+            and all(field in MACHINE_FIELDS for field in fields)
+        ):
+            return render()[0], 200
+        return cached_json_response(
+            ("machine", vending_machine_name, fields_key),
+            tagged(machine_service.get_machine_version(vending_machine_name)),
+            render,
+        )
     except ValueError as ve:
         return jsonify(success=False, message=str(ve)), 400
     except Exception as e:
         return jsonify(success=False, message=str(e)), 500
 
 
+def get_int_query_arg(key: str, default: int | None = None) -> int | None:
+    if key not in request.args:
+        return default
+    value = request.args.get(key, type=int)
+    if value is None:
+        raise ValueError(f"'{key}' must be an int value")
+    return value
+
+
+def get_machine_query_args() -> dict:
+    fields = request.args.get("fields")
+    return {
+        "location": request.args.get("location"),
+        "item_name": request.args.get("item"),
+        "below": get_int_query_arg("below"),
+        "fields": fields.split(",") if fields is not None else None,
+    }
+
+
 @vending_machine_controller.route("/machine/get-all-machine", methods=["GET"])
 def get_all_vending_machine_info_api() -> tuple[Response, int]:
     try:
-        all_vending_machine = machine_service.get_all_vending_machine_info()
-        return jsonify(success=True, message=all_vending_machine), 200
+        query_args = get_machine_query_args()
+
+        if request.args.get("format") == "ndjson":
+            return stream_all_vending_machine_info(query_args), 200
+
+        # Any write may change a listing, they are cached under the version of the whole fleet.
+        fleet_version = machine_service.get_fleet_version()
+
+        def render() -> tuple[Response, int | None]:
+            if not {"cursor", "offset", "limit"} & request.args.keys():
+                all_vending_machine = machine_service.get_all_vending_machine_info(
+                    **query_args
+                )
+                response = jsonify(success=True, message=all_vending_machine)
+            else:
+                page = machine_service.get_vending_machine_page(
+                    get_int_query_arg("cursor"),
+                    get_int_query_arg("offset", 0),
+                    get_int_query_arg("limit", DEFAULT_PAGE_SIZE),
+                    **query_args,
+                )
+                response = jsonify(
+                    success=True,
+                    message=page["machines"],
+                    next_cursor=page["next_cursor"],
+                )
+            # A listing rendered while the fleet changed may mix versions, it is neither cached nor tagged.
+            if machine_service.get_fleet_version() != fleet_version:
+                return response, None
+            return response, fleet_version
+
+        return cached_json_response(
+            ("listing", request.query_string), fleet_version, render
+        )
+    except ValueError as ve:
+        return jsonify(success=False, message=str(ve)), 400
+    except Exception as e:
+        return jsonify(success=False, message=str(e)), 500
+
+
+def stream_all_vending_machine_info(query_args: dict) -> Response:
+    vending_machines = machine_service.iter_all_vending_machine_info(**query_args)
+
+    def generate() -> Iterator[bytes]:
+        for vending_machine in vending_machines:
+            yield fast_json.dumps(vending_machine) + b"\n"
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+
+@vending_machine_controller.route("/location/get-machines", methods=["POST"])
+def get_vending_machines_by_location_api() -> tuple[Response, int]:
+    request_json_data = request.get_json()
+
+    if "location" not in request_json_data:
+        return (
+            jsonify(success=False, message="Missing 'location' in the request data"),
+            400,
+        )
+
+    if len(request_json_data.keys() - {"location", "fields"}) > 0:
+        return (
+            jsonify(
+                success=False,
+                message="Too many keys in the request data, require only 'location'",
+            ),
+            400,
+        )
+
+    location = request_json_data["location"]
+    fields = request_json_data.get("fields")
+
+    try:
+        vending_machines = machine_service.get_vending_machines_by_location(
+            location, fields
+        )
+        return jsonify(success=True, message=vending_machines), 200
+    except ValueError as ve:
+        return jsonify(success=False, message=str(ve)), 400
     except Exception as e:
         return jsonify(success=False, message=str(e)), 500
 
@@ -137,9 +443,11 @@ def change_vending_machine_name_api() -> tuple[Response, int]:
 
     try:
         vending_machine = machine_service.change_vending_machine_name(
-            old_name, new_name
+            old_name, new_name, expected_version=get_expected_version()
         )
-        return jsonify(success=True, message=vending_machine), 200
+        return machine_response(vending_machine), 200
+    except VersionConflictError as vce:
+        return jsonify(success=False, message=str(vce)), 412
     except ValueError as ve:
         return jsonify(success=False, message=str(ve)), 400
     except Exception as e:
@@ -173,9 +481,13 @@ def change_vending_machine_location_api() -> tuple[Response, int]:
 
     try:
         vending_machine = machine_service.change_vending_machine_location(
-            vending_machine_name, vending_machine_location
+            vending_machine_name,
+            vending_machine_location,
+            expected_version=get_expected_version(),
         )
-        return jsonify(success=True, message=vending_machine), 200
+        return machine_response(vending_machine), 200
+    except VersionConflictError as vce:
+        return jsonify(success=False, message=str(vce)), 412
     except ValueError as ve:
         return jsonify(success=False, message=str(ve)), 400
     except Exception as e:
@@ -221,9 +533,14 @@ def add_vending_machine_item_api() -> tuple[Response, int]:
 
     try:
         vending_machine = machine_service.add_vending_machine_item(
-            vending_machine_name, item_name, item_amount
+            vending_machine_name,
+            item_name,
+            item_amount,
+            expected_version=get_expected_version(),
         )
-        return jsonify(success=True, message=vending_machine), 200
+        return machine_response(vending_machine), 200
+    except VersionConflictError as vce:
+        return jsonify(success=False, message=str(vce)), 412
     except ValueError as ve:
         return jsonify(success=False, message=str(ve)), 400
     except Exception as e:
@@ -269,9 +586,132 @@ def edit_vending_machine_item_amount_api() -> tuple[Response, int]:
 
     try:
         vending_machine = machine_service.edit_vending_machine_item_amount(
-            vending_machine_name, item_name, item_amount
+            vending_machine_name,
+            item_name,
+            item_amount,
+            expected_version=get_expected_version(),
         )
-        return jsonify(success=True, message=vending_machine), 200
+        return machine_response(vending_machine), 200
+    except VersionConflictError as vce:
+        return jsonify(success=False, message=str(vce)), 412
+    except ValueError as ve:
+        return jsonify(success=False, message=str(ve)), 400
+    except Exception as e:
+        return jsonify(success=False, message=str(e)), 500
+
+
+@vending_machine_controller.route("/changes", methods=["GET"])
+def get_changes_api() -> tuple[Response, int]:
+    try:
+        changes = machine_service.get_changes(
+            get_int_query_arg("since", 0),
+            get_int_query_arg("limit", DEFAULT_PAGE_SIZE),
+            request.args.get("epoch"),
+        )
+        return (
+            jsonify(
+                success=True,
+                message=changes["changes"],
+                epoch=changes["epoch"],
+                last_sequence=changes["last_sequence"],
+                missed=changes["missed"],
+            ),
+            200,
+        )
+    except ValueError as ve:
+        return jsonify(success=False, message=str(ve)), 400
+    except Exception as e:
+        return jsonify(success=False, message=str(e)), 500
+
+
+@vending_machine_controller.route("/changes/stream", methods=["GET"])
+def stream_changes_api() -> tuple[Response, int]:
+    try:
+        since = get_int_query_arg("since")
+        epoch = request.args.get("epoch")
+        if since is None:
+            # Event ids are '<epoch>-<sequence>', plain sequence numbers are accepted as well.
+            last_event_id = request.headers.get("Last-Event-ID", "0")
+            if "-" in last_event_id:
+                epoch, _, last_event_id = last_event_id.partition("-")
+            if not last_event_id.isdigit():
+                raise ValueError(
+                    "'Last-Event-ID' must be an event id or a non-negative int value"
+                )
+            since = int(last_event_id)
+        changes = machine_service.get_changes(since, MAX_PAGE_SIZE, epoch)
+        return stream_changes(changes), 200
+    except ValueError as ve:
+        return jsonify(success=False, message=str(ve)), 400
+    except Exception as e:
+        return jsonify(success=False, message=str(e)), 500
+
+
+def stream_changes(changes: dict) -> Response:
+    """
+    Server-Sent Events stream of the changes, starting with the given ones and never ending.
+    Event ids carry the epoch with the sequence number, so a client reconnecting to another process
+    is told it missed changes instead of resuming from an unrelated sequence number.
+    """
+    epoch = changes["epoch"]
+
+    def generate() -> Iterator[str]:
+        nonlocal changes
+        while True:
+            if changes["missed"]:
+                yield f"id: {epoch}-{changes['last_sequence']}\nevent: missed\ndata: {changes['last_sequence']}\n\n"
+            for change in changes["changes"]:
+                yield f"id: {epoch}-{change['sequence']}\nevent: change\ndata: {fast_json.dumps(change).decode()}\n\n"
+            if not changes["changes"] and not machine_service.wait_for_changes(
+                changes["last_sequence"], CHANGE_STREAM_KEEPALIVE
+            ):
+                yield ": keep-alive\n\n"
+            changes = machine_service.get_changes(
+                changes["last_sequence"], MAX_PAGE_SIZE
+            )
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
+
+
+@vending_machine_controller.route("/item/low-stock", methods=["GET"])
+def get_low_stock_items_api() -> tuple[Response, int]:
+    try:
+        low_stock_items = machine_service.get_low_stock_items(
+            request.args.get("item"),
+            get_int_query_arg("below"),
+            get_int_query_arg("count"),
+        )
+        return jsonify(success=True, message=low_stock_items), 200
+    except ValueError as ve:
+        return jsonify(success=False, message=str(ve)), 400
+    except Exception as e:
+        return jsonify(success=False, message=str(e)), 500
+
+
+@vending_machine_controller.route("/item/aggregates", methods=["GET"])
+def get_inventory_aggregates_api() -> tuple[Response, int]:
+    try:
+        inventory_aggregates = machine_service.get_inventory_aggregates(
+            request.args.get("location"), request.args.get("item")
+        )
+        return jsonify(success=True, message=inventory_aggregates), 200
+    except ValueError as ve:
+        return jsonify(success=False, message=str(ve)), 400
+    except Exception as e:
+        return jsonify(success=False, message=str(e)), 500
+
+
+@vending_machine_controller.route("/item/aggregates/check", methods=["GET"])
+def check_inventory_aggregates_api() -> tuple[Response, int]:
+    try:
+        check_result = machine_service.check_inventory_aggregates(
+            request.args.get("repair", "false").lower() == "true"
+        )
+        return jsonify(success=True, message=check_result), 200
     except ValueError as ve:
         return jsonify(success=False, message=str(ve)), 400
     except Exception as e:
@@ -305,9 +745,50 @@ def remove_vending_machine_item_api() -> tuple[Response, int]:
 
     try:
         vending_machine = machine_service.remove_vending_machine_item(
-            vending_machine_name, item_name
+            vending_machine_name, item_name, expected_version=get_expected_version()
         )
-        return jsonify(success=True, message=vending_machine), 200
+        return machine_response(vending_machine), 200
+    except VersionConflictError as vce:
+        return jsonify(success=False, message=str(vce)), 412
+    except ValueError as ve:
+        return jsonify(success=False, message=str(ve)), 400
+    except Exception as e:
+        return jsonify(success=False, message=str(e)), 500
+
+
+@vending_machine_controller.route("/item/bulk-update", methods=["POST"])
+def bulk_update_vending_machine_items_api() -> tuple[Response, int]:
+    request_json_data = request.get_json()
+
+    if "operations" not in request_json_data:
+        return (
+            jsonify(success=False, message="Missing 'operations' in the request data"),
+            400,
+        )
+
+    if len(request_json_data) > 1:
+        return (
+            jsonify(
+                success=False,
+                message="Too many keys in the request data, require only 'operations'",
+            ),
+            400,
+        )
+
+    operations = request_json_data["operations"]
+
+    if type(operations) is not list:
+        return (
+            jsonify(
+                success=False,
+                message="'operations' argument must be a list of item operations",
+            ),
+            400,
+        )
+
+    try:
+        results = machine_service.bulk_update_vending_machine_items(operations)
+        return jsonify(success=True, message=results), 200
     except ValueError as ve:
         return jsonify(success=False, message=str(ve)), 400
     except Exception as e:
@@ -328,9 +809,11 @@ def delete_vending_machine_by_name_api() -> tuple[Response, int]:
 
     try:
         ret_message = machine_service.delete_vending_machine_by_name(
-            vending_machine_name
+            vending_machine_name, expected_version=get_expected_version()
         )
         return jsonify(success=True, message=ret_message), 200
+    except VersionConflictError as vce:
+        return jsonify(success=False, message=str(vce)), 412
     except ValueError as ve:
         return jsonify(success=False, message=str(ve)), 400
     except Exception as e:
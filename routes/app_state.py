@@ -0,0 +1,199 @@
+import logging
+import os
+import threading
+import time
+from typing import Callable, Mapping
+
+from flask import Flask, current_app
+
+from database.machine_repository import MachineRepository
+from services.change_feed import DEFAULT_MAX_EVENTS
+from services.idempotency import (
+    DEFAULT_WINDOW,
+    IdempotencyStore,
+    SQLiteIdempotencyStore,
+)
+from services.metrics import MetricsRegistry
+from services.response_cache import DEFAULT_MAX_ENTRIES, ResponseCache
+from services.vending_machine_service import VendingMachineService
+
+EXTENSION_NAME = "vending_machine"
+WarmUpHook = Callable[[VendingMachineService], None]
+
+logger = logging.getLogger(__name__)
+
+
+def settings_from_env() -> dict:
+    """
+    Read the settings of the API from the environment, the defaults of create_app's config.
+
+    Returns:
+        dict: DB_PATH and TEST_DB_PATH, the directories of the database and of the test database used when
+        TESTING is set, COALESCE_WRITES, CHANGE_FEED_SIZE, SERVER_TIMING, RESPONSE_CACHE_SIZE, IDEMPOTENCY_WINDOW,
+        IDEMPOTENCY_STORE, 'memory' or 'sqlite' to share the idempotency keys between processes and restarts,
+        the default with DB_MULTIPROCESS, and PRELOAD_DATABASE, which opens the database when the app is created
+        instead of on the first request.
+    """
+    multiprocess = os.getenv("DB_MULTIPROCESS", "false").lower() == "true"
+    return {
+        "DB_PATH": os.getenv("DB_PATH"),
+        "TEST_DB_PATH": os.getenv("TEST_DB_PATH"),
+        "COALESCE_WRITES": os.getenv("COALESCE_WRITES", "false").lower() == "true",
+        "CHANGE_FEED_SIZE": int(os.getenv("CHANGE_FEED_SIZE", DEFAULT_MAX_EVENTS)),
+        "SERVER_TIMING": os.getenv("SERVER_TIMING", "false").lower() == "true",
+        "RESPONSE_CACHE_SIZE": int(
+            os.getenv("RESPONSE_CACHE_SIZE", DEFAULT_MAX_ENTRIES)
+        ),
+        "IDEMPOTENCY_WINDOW": float(os.getenv("IDEMPOTENCY_WINDOW", DEFAULT_WINDOW)),
+        "IDEMPOTENCY_STORE": os.getenv("IDEMPOTENCY_STORE")
+        or ("sqlite" if multiprocess else "memory"),
+        "PRELOAD_DATABASE": os.getenv("PRELOAD_DATABASE", "false").lower() == "true",
+    }
+
+
+class AppState:
+    """
+    The services behind the API routes of one app. The vending machine service, which opens the database
+    and indexes every machine, is only created on first use, so creating the app costs no storage access.
+
+    The store is the database of the app's settings, or MACHINE_REPOSITORY, or an already built
+    MACHINE_SERVICE. Warm-up hooks run once the service is created, before it serves any request.
+    """
+
+    def __init__(self: "AppState", config: Mapping) -> None:
+        self.config = config
+        self.metrics = MetricsRegistry()
+        self.response_cache = ResponseCache(config["RESPONSE_CACHE_SIZE"])
+        self._idempotency_store: IdempotencyStore | None = None
+        self.warm_up_hooks: list[WarmUpHook] = list(config.get("WARM_UP_HOOKS", []))
+        self._machine_service: VendingMachineService | None = config.get(
+            "MACHINE_SERVICE"
+        )
+        self._owns_repository = False
+        self._lock = threading.Lock()
+        self._idempotency_lock = threading.Lock()
+
+    @property
+    def loaded(self: "AppState") -> bool:
+        """Whether the vending machine service was created."""
+        return self._machine_service is not None
+
+    @property
+    def machine_service(self: "AppState") -> VendingMachineService:
+        """The vending machine service, created by the first access."""
+        machine_service = self._machine_service
+        if machine_service is None:
+            machine_service = self.load()
+        return machine_service
+
+    @property
+    def idempotency_store(self: "AppState") -> IdempotencyStore:
+        """
+        The store of the idempotency keys, created by the first access. Keys held in memory are only seen by
+        this process, the 'sqlite' store shares them with the other workers and keeps them across restarts.
+        """
+        with self._idempotency_lock:
+            if self._idempotency_store is None:
+                window = self.config["IDEMPOTENCY_WINDOW"]
+                if self.config["IDEMPOTENCY_STORE"] == "sqlite":
+                    self._idempotency_store = SQLiteIdempotencyStore(
+                        self._database_path("idempotency.sqlite3"), window
+                    )
+                elif self.config["IDEMPOTENCY_STORE"] == "memory":
+                    self._idempotency_store = IdempotencyStore(window)
+                else:
+                    raise ValueError(
+                        f"Unknown idempotency store '{self.config['IDEMPOTENCY_STORE']}'"
+                    )
+            return self._idempotency_store
+
+    def warm_up(self: "AppState", hook: WarmUpHook) -> WarmUpHook:
+        """
+        Register a function called with the vending machine service once it is created, e.g. to prime caches.
+        Usable as a decorator.
+
+        Parameters:
+            hook (WarmUpHook): The function.
+
+        Returns:
+            WarmUpHook: The function.
+        """
+        self.warm_up_hooks.append(hook)
+        return hook
+
+    def load(self: "AppState") -> VendingMachineService:
+        """
+        Create the vending machine service and run the warm-up hooks, unless already done.
+        Concurrent first requests wait for the same service. The time taken is logged and exported as metrics.
+
+        Returns:
+            VendingMachineService: The vending machine service.
+        """
+        with self._lock:
+            if self._machine_service is not None:
+                return self._machine_service
+            start = time.perf_counter()
+            repository = self.config.get("MACHINE_REPOSITORY")
+            if repository is None:
+                repository = self._open_repository()
+                self._owns_repository = True
+            machine_service = VendingMachineService(
+                repository,
+                self.metrics,
+                coalesce_writes=self.config["COALESCE_WRITES"],
+                change_feed_size=self.config["CHANGE_FEED_SIZE"],
+            )
+            opened = time.perf_counter()
+            for hook in self.warm_up_hooks:
+                hook(machine_service)
+            warmed_up = time.perf_counter()
+            self.metrics.observe_startup("open_database", opened - start)
+            self.metrics.observe_startup("warm_up", warmed_up - opened)
+            logger.info(
+                "Opened the database in %.3fs, warm-up took %.3fs",
+                opened - start,
+                warmed_up - opened,
+            )
+            self._machine_service = machine_service
+            return machine_service
+
+    def _open_repository(self: "AppState") -> MachineRepository:
+        # Imported on first use, so creating the app does not load the storage backends.
+        from database.db_manager import get_machine_repository
+
+        if self.config.get("TESTING"):
+            return get_machine_repository(self.config["TEST_DB_PATH"], test=True)
+        return get_machine_repository(self.config["DB_PATH"])
+
+    def _database_path(self: "AppState", file_name: str) -> str:
+        if self.config.get("TESTING"):
+            return self.config["TEST_DB_PATH"] + "test_" + file_name
+        return self.config["DB_PATH"] + file_name
+
+    def close(self: "AppState") -> None:
+        """
+        Close the database if this app opened it, and the idempotency store.
+        They are created again on next use.
+        """
+        with self._idempotency_lock:
+            if self._idempotency_store is not None:
+                self._idempotency_store.close()
+                self._idempotency_store = None
+        with self._lock:
+            if self._machine_service is not None and self._owns_repository:
+                self._machine_service.repository.close()
+                self._machine_service = None
+                self._owns_repository = False
+
+
+def get_app_state(app: Flask | None = None) -> AppState:
+    """
+    Retrieves the services of an app created by create_app.
+
+    Parameters:
+        app (Flask | None): The app, the current app by default.
+
+    Returns:
+        AppState: The services of the app.
+    """
+    return (app or current_app).extensions[EXTENSION_NAME]
@@ -0,0 +1,31 @@
+from flask import Response
+from flask.json.provider import DefaultJSONProvider
+
+from database import fast_json
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """
+    Flask JSON provider encoding and decoding with database.fast_json, orjson when it is installed.
+    Responses keep the defaults of Flask, sorted keys and compact output outside of debug mode;
+    formatted output and calls with json.dumps arguments are left to the default provider.
+    """
+
+    def dumps(self: "FastJSONProvider", obj: object, **kwargs: dict) -> str:
+        if kwargs:
+            return super().dumps(obj, **kwargs)
+        return fast_json.dumps(obj, self.sort_keys, self.default).decode("utf-8")
+
+    def loads(self: "FastJSONProvider", s: str | bytes, **kwargs: dict) -> object:
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return fast_json.loads(s)
+
+    def response(self: "FastJSONProvider", *args: tuple, **kwargs: dict) -> Response:
+        if (self.compact is None and self._app.debug) or self.compact is False:
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            fast_json.dumps(obj, self.sort_keys, self.default) + b"\n",
+            mimetype=self.mimetype,
+        )
@@ -0,0 +1,184 @@
+import itertools
+import threading
+from collections import deque
+
+DEFAULT_MAX_EVENTS = 10000
+
+
+class ChangeFeed:
+    """
+    Bounded in-memory feed of vending machine changes, one event per changed field or item.
+    Each event is a dictionary with a monotonic 'sequence' number, the 'machine' name, the changed 'field'
+    ('machine' when it was created or deleted, 'name', 'location' or 'items'), the 'item' name for item
+    changes, and the 'old' and 'new' values, None when absent. The oldest events are dropped once
+    max_events are held, consumers that fall that far behind are told they missed some.
+    """
+
+    def __init__(self: "ChangeFeed", max_events: int = DEFAULT_MAX_EVENTS) -> None:
+        self._events: deque[dict] = deque(maxlen=max(max_events, 1))
+        self._last_sequence = 0
+        self._published = threading.Condition()
+
+    @property
+    def last_sequence(self: "ChangeFeed") -> int:
+        """The sequence number of the latest event, 0 before the first one."""
+        return self._last_sequence
+
+    @property
+    def max_events(self: "ChangeFeed") -> int:
+        """The number of events the feed holds before dropping the oldest."""
+        return self._events.maxlen
+
+    def publish_machine_change(
+        self: "ChangeFeed",
+        old_vending_machine: dict | None,
+        new_vending_machine: dict | None,
+    ) -> None:
+        """
+        Publish the events describing the change of a vending machine.
+
+        Parameters:
+            old_vending_machine (dict | None): The vending machine before the change, None if it was created.
+            new_vending_machine (dict | None): The vending machine after the change, None if it was deleted.
+
+        Returns:
+            None
+        """
+        events = []
+        if old_vending_machine is None or new_vending_machine is None:
+            vending_machine = old_vending_machine or new_vending_machine
+            events.append(
+                (
+                    vending_machine["name"],
+                    "machine",
+                    None,
+                    self._copy(old_vending_machine),
+                    self._copy(new_vending_machine),
+                )
+            )
+        else:
+            name = new_vending_machine["name"]
+            for field in ("name", "location"):
+                if old_vending_machine[field] != new_vending_machine[field]:
+                    events.append(
+                        (
+                            name,
+                            field,
+                            None,
+                            old_vending_machine[field],
+                            new_vending_machine[field],
+                        )
+                    )
+            old_items = old_vending_machine["items"]
+            new_items = new_vending_machine["items"]
+            for item_name in [*old_items, *new_items.keys() - old_items.keys()]:
+                if old_items.get(item_name) != new_items.get(item_name):
+                    events.append(
+                        (
+                            name,
+                            "items",
+                            item_name,
+                            old_items.get(item_name),
+                            new_items.get(item_name),
+                        )
+                    )
+        if not events:
+            return
+
+        with self._published:
+            for machine, field, item_name, old, new in events:
+                self._last_sequence += 1
+                self._events.append(
+                    {
+                        "sequence": self._last_sequence,
+                        "machine": machine,
+                        "field": field,
+                        "item": item_name,
+                        "old": old,
+                        "new": new,
+                    }
+                )
+            self._published.notify_all()
+
+    def publish_machines_created(
+        self: "ChangeFeed", vending_machines: list[dict], count: int | None = None
+    ) -> None:
+        """
+        Publish the creation of many vending machines at once, e.g. when loading the fleet. Every creation
+        takes a sequence number, but only the events the feed can hold are built.
+
+        Parameters:
+            vending_machines (list[dict]): The created vending machines, or only the last max_events of them.
+            count (int | None): The number of created vending machines, len(vending_machines) by default.
+
+        Returns:
+            None
+        """
+        if count is None:
+            count = len(vending_machines)
+        if not count:
+            return
+        with self._published:
+            kept = vending_machines[-self._events.maxlen :]
+            first_sequence = self._last_sequence + count - len(kept)
+            for sequence, vending_machine in enumerate(kept, start=first_sequence + 1):
+                self._events.append(
+                    {
+                        "sequence": sequence,
+                        "machine": vending_machine["name"],
+                        "field": "machine",
+                        "item": None,
+                        "old": None,
+                        "new": self._copy(vending_machine),
+                    }
+                )
+            self._last_sequence += count
+            self._published.notify_all()
+
+    @staticmethod
+    def _copy(vending_machine: dict | None) -> dict | None:
+        if vending_machine is None:
+            return None
+        return {**vending_machine, "items": dict(vending_machine["items"])}
+
+    def since(
+        self: "ChangeFeed", sequence: int, limit: int | None = None
+    ) -> tuple[list[dict], bool]:
+        """
+        Retrieves the events published after a sequence number, oldest first.
+
+        Parameters:
+            sequence (int): The sequence number of the last event already received, 0 for every event.
+            limit (int | None): The maximum number of events to return, None for all.
+
+        Returns:
+            tuple[list[dict], bool]: The events, and whether events after the sequence number were already
+            dropped from the feed, in which case the consumer should reload the full state. A sequence number
+            beyond the latest event, given by a consumer of a previous process, also counts as missed events.
+        """
+        with self._published:
+            if sequence > self._last_sequence:
+                return [], True
+            if sequence == self._last_sequence:
+                return [], False
+            first_sequence = self._events[0]["sequence"]
+            missed = sequence < first_sequence - 1
+            start = max(sequence - first_sequence + 1, 0)
+            stop = len(self._events) if limit is None else start + limit
+            return list(itertools.islice(self._events, start, stop)), missed
+
+    def wait(self: "ChangeFeed", sequence: int, timeout: float) -> bool:
+        """
+        Wait until an event is published after a sequence number.
+
+        Parameters:
+            sequence (int): The sequence number of the last event already received.
+            timeout (float): The maximum number of seconds to wait.
+
+        Returns:
+            bool: Whether events after the sequence number are available.
+        """
+        with self._published:
+            return self._published.wait_for(
+                lambda: self._last_sequence > sequence, timeout
+            )
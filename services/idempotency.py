@@ -0,0 +1,261 @@
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from database import fast_json
+
+DEFAULT_WINDOW = 600.0
+DEFAULT_MAX_KEYS = 100000
+# Seconds after which a key claimed by a request that never completed, e.g. in a crashed process, is released.
+DEFAULT_CLAIM_TIMEOUT = 60.0
+DEFAULT_POLL_INTERVAL = 0.05
+# Seconds a retry waits for the request holding its key before giving up.
+DEFAULT_WAIT_TIMEOUT = 30.0
+
+IDEMPOTENCY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    key TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    expires REAL NOT NULL,
+    status INTEGER,
+    body BLOB,
+    headers TEXT
+);
+CREATE INDEX IF NOT EXISTS idempotency_keys_expires ON idempotency_keys (expires);
+"""
+# A claimed key expires after the claim timeout, its response is kept for the window once completed.
+DELETE_EXPIRED_KEYS = "DELETE FROM idempotency_keys WHERE expires <= ?"
+SELECT_KEY = (
+    "SELECT fingerprint, status, body, headers FROM idempotency_keys WHERE key = ?"
+)
+INSERT_KEY = "INSERT INTO idempotency_keys (key, fingerprint, expires) VALUES (?, ?, ?)"
+COMPLETE_KEY = (
+    "UPDATE idempotency_keys SET status = ?, body = ?, headers = ?, expires = ? "
+    "WHERE key = ? AND status IS NULL"
+)
+ABANDON_KEY = "DELETE FROM idempotency_keys WHERE key = ? AND status IS NULL"
+
+StoredResponse = tuple[int, bytes, list[tuple[str, str]]]
+
+
+class IdempotencyKeyReusedError(ValueError):
+    """Raised when an idempotency key is sent again with a different request."""
+
+
+class IdempotencyKeyInProgressError(Exception):
+    """Raised when a retry gave up waiting for the request holding its idempotency key."""
+
+
+class IdempotencyStoreFullError(Exception):
+    """Raised when a key cannot be claimed because every remembered key belongs to a running request."""
+
+
+class IdempotencyStore:
+    """
+    Remembers the response of each request sent with an idempotency key for ``window`` seconds,
+    so a client retrying a request after a timeout gets the original response instead of applying it twice.
+    A retry arriving while the original request is still running waits up to ``wait_timeout`` seconds
+    for its response. At most ``max_keys`` keys are remembered, the oldest completed ones are forgotten first;
+    keys of running requests are never forgotten, so their retries cannot run them a second time.
+    """
+
+    def __init__(
+        self: "IdempotencyStore",
+        window: float = DEFAULT_WINDOW,
+        max_keys: int = DEFAULT_MAX_KEYS,
+        wait_timeout: float = DEFAULT_WAIT_TIMEOUT,
+    ) -> None:
+        self.window = window
+        self.max_keys = max_keys
+        self.wait_timeout = wait_timeout
+        # key -> (fingerprint, expiry time, stored response or None while running)
+        self._entries: OrderedDict[str, tuple[str, float, StoredResponse | None]] = (
+            OrderedDict()
+        )
+        self._completed = threading.Condition()
+
+    def begin(
+        self: "IdempotencyStore", key: str, fingerprint: str
+    ) -> StoredResponse | None:
+        """
+        Claim an idempotency key for a request, or retrieve the response of the request that claimed it.
+
+        Parameters:
+            key (str): The idempotency key sent by the client.
+            fingerprint (str): Identifies the request, a key may only be reused for the same request.
+
+        Raises:
+            IdempotencyKeyReusedError: If the key was claimed by a different request.
+            IdempotencyKeyInProgressError: If the request holding the key did not complete within wait_timeout.
+            IdempotencyStoreFullError: If max_keys keys are held by running requests.
+
+        Returns:
+            StoredResponse | None: The (status, body, headers) of the original request, None if the caller
+            claimed the key and must either complete or abandon it.
+        """
+        deadline = time.monotonic() + self.wait_timeout
+        with self._completed:
+            while True:
+                now = time.monotonic()
+                self._expire(now)
+                entry = self._entries.get(key)
+                if entry is None:
+                    if len(self._entries) >= self.max_keys:
+                        self._evict(len(self._entries) - self.max_keys + 1)
+                        if len(self._entries) >= self.max_keys:
+                            raise IdempotencyStoreFullError(
+                                "Too many requests with an idempotency key are running, retry later."
+                            )
+                    self._entries[key] = (fingerprint, now + self.window, None)
+                    return None
+                if entry[0] != fingerprint:
+                    raise IdempotencyKeyReusedError(
+                        f"Idempotency key '{key}' was already used for a different request."
+                    )
+                if entry[2] is not None:
+                    return entry[2]
+                if now >= deadline:
+                    raise IdempotencyKeyInProgressError(
+                        f"The request with idempotency key '{key}' is still running, retry later."
+                    )
+                self._completed.wait(deadline - now)
+
+    def complete(self: "IdempotencyStore", key: str, response: StoredResponse) -> None:
+        """
+        Store the response of a request that claimed a key and wake the retries waiting for it.
+
+        Parameters:
+            key (str): The idempotency key.
+            response (StoredResponse): The (status, body, headers) of the response.
+
+        Returns:
+            None
+        """
+        with self._completed:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries[key] = (entry[0], entry[1], response)
+            self._completed.notify_all()
+
+    def abandon(self: "IdempotencyStore", key: str) -> None:
+        """Release a claimed key without a response, so a retry runs the request again."""
+        with self._completed:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] is None:
+                del self._entries[key]
+            self._completed.notify_all()
+
+    def close(self: "IdempotencyStore") -> None:
+        """Release the resources held by the store."""
+
+    def _expire(self: "IdempotencyStore", now: float) -> None:
+        # Keys are claimed in expiry order, so the expired ones are at the front.
+        # Keys of running requests are kept, whatever their age, but do not hold back the completed ones.
+        expired = []
+        for key, (_, expiry, response) in self._entries.items():
+            if expiry > now:
+                break
+            if response is not None:
+                expired.append(key)
+        for key in expired:
+            del self._entries[key]
+
+    def _evict(self: "IdempotencyStore", count: int) -> None:
+        # Forget the oldest completed keys, up to count of them.
+        evicted = []
+        for key, (_, _, response) in self._entries.items():
+            if len(evicted) == count:
+                break
+            if response is not None:
+                evicted.append(key)
+        for key in evicted:
+            del self._entries[key]
+
+
+class SQLiteIdempotencyStore(IdempotencyStore):
+    """
+    Idempotency store keeping the keys in a SQLite file, so they are shared by the worker processes of
+    a multi-process server and survive restarts. A retry arriving while the original request is running,
+    possibly in another process, polls for its response every ``poll_interval`` seconds. A key claimed by
+    a request that neither completed nor abandoned it within ``claim_timeout`` seconds, e.g. because its
+    process was killed, is released. Keys are only forgotten once expired, ``max_keys`` does not apply.
+    """
+
+    def __init__(
+        self: "SQLiteIdempotencyStore",
+        path: str,
+        window: float = DEFAULT_WINDOW,
+        claim_timeout: float = DEFAULT_CLAIM_TIMEOUT,
+        poll_interval: float = DEFAULT_POLL_INTERVAL,
+        wait_timeout: float = DEFAULT_WAIT_TIMEOUT,
+    ) -> None:
+        super().__init__(window, wait_timeout=wait_timeout)
+        self.claim_timeout = claim_timeout
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            path, timeout=30.0, isolation_level=None, check_same_thread=False
+        )
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(IDEMPOTENCY_SCHEMA)
+
+    def begin(
+        self: "SQLiteIdempotencyStore", key: str, fingerprint: str
+    ) -> StoredResponse | None:
+        deadline = time.monotonic() + self.wait_timeout
+        while True:
+            # The connection commits the transaction when the block succeeds, rolls it back otherwise.
+            with self._lock, self._connection:
+                # Wall clock time, comparable between processes.
+                now = time.time()
+                self._connection.execute("BEGIN IMMEDIATE")
+                self._connection.execute(DELETE_EXPIRED_KEYS, (now,))
+                row = self._connection.execute(SELECT_KEY, (key,)).fetchone()
+                if row is None:
+                    self._connection.execute(
+                        INSERT_KEY, (key, fingerprint, now + self.claim_timeout)
+                    )
+            if row is None:
+                return None
+            stored_fingerprint, status, body, headers = row
+            if stored_fingerprint != fingerprint:
+                raise IdempotencyKeyReusedError(
+                    f"Idempotency key '{key}' was already used for a different request."
+                )
+            if status is not None:
+                return (
+                    status,
+                    bytes(body),
+                    [tuple(header) for header in fast_json.loads(headers)],
+                )
+            if time.monotonic() >= deadline:
+                raise IdempotencyKeyInProgressError(
+                    f"The request with idempotency key '{key}' is still running, retry later."
+                )
+            time.sleep(self.poll_interval)
+
+    def complete(
+        self: "SQLiteIdempotencyStore", key: str, response: StoredResponse
+    ) -> None:
+        status, body, headers = response
+        with self._lock:
+            self._connection.execute(
+                COMPLETE_KEY,
+                (
+                    status,
+                    body,
+                    fast_json.dumps(headers).decode("utf-8"),
+                    time.time() + self.window,
+                    key,
+                ),
+            )
+
+    def abandon(self: "SQLiteIdempotencyStore", key: str) -> None:
+        with self._lock:
+            self._connection.execute(ABANDON_KEY, (key,))
+
+    def close(self: "SQLiteIdempotencyStore") -> None:
+        with self._lock:
+            self._connection.close()
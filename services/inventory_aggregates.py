@@ -0,0 +1,215 @@
+from typing import Iterable
+
+
+class InventoryAggregates:
+    """
+    Running inventory counters per item, fleet-wide and per location, holding the total amount of
+    the item and the number of vending machines holding it. They are updated from the diff of each
+    vending machine change, so reading them costs the number of items instead of the number of machines.
+    The counters are not thread-safe, callers serialize access to them.
+    """
+
+    def __init__(self: "InventoryAggregates") -> None:
+        self._totals: dict[str, list[int]] = {}
+        self._location_totals: dict[str, dict[str, list[int]]] = {}
+
+    @classmethod
+    def from_machines(
+        cls: type["InventoryAggregates"], vending_machines: Iterable[dict]
+    ) -> "InventoryAggregates":
+        """
+        Compute the counters from scratch.
+
+        Parameters:
+            vending_machines (Iterable[dict]): Every vending machine of the fleet.
+
+        Returns:
+            InventoryAggregates: The counters of the given vending machines.
+        """
+        aggregates = cls()
+        aggregates.add_machines(vending_machines)
+        return aggregates
+
+    def clear(self: "InventoryAggregates") -> None:
+        self._totals.clear()
+        self._location_totals.clear()
+
+    def _count(
+        self: "InventoryAggregates",
+        location: str,
+        item_name: str,
+        amount: int,
+        sign: int,
+    ) -> None:
+        if type(amount) != int:
+            return
+        location_totals = self._location_totals.setdefault(location, {})
+        for totals in (self._totals, location_totals):
+            counter = totals.setdefault(item_name, [0, 0])
+            counter[0] += sign * amount
+            counter[1] += sign
+            if counter[1] == 0:
+                del totals[item_name]
+        if not location_totals:
+            del self._location_totals[location]
+
+    def add_machines(
+        self: "InventoryAggregates", vending_machines: Iterable[dict]
+    ) -> None:
+        """
+        Count the items of many vending machines at once, e.g. when loading the fleet.
+
+        Parameters:
+            vending_machines (Iterable[dict]): The vending machines, none of them already counted.
+
+        Returns:
+            None
+        """
+        self.add_rows(
+            (
+                vending_machine["name"],
+                vending_machine["location"],
+                vending_machine["items"],
+                vending_machine["items"].values(),
+            )
+            for vending_machine in vending_machines
+        )
+
+    def add_rows(
+        self: "InventoryAggregates",
+        rows: Iterable[tuple[str, str, Iterable[str], Iterable]],
+    ) -> None:
+        """
+        Count the items of many vending machines given as rows, see add_machines.
+
+        Parameters:
+            rows (Iterable[tuple[str, str, Iterable[str], Iterable]]): The name, location, item names and
+                amounts of each vending machine, none of them already counted.
+
+        Returns:
+            None
+        """
+        # Counted per location first, the fleet-wide counters are then the sums of a few location counters.
+        added: dict[str, dict[str, list[int]]] = {}
+        for _, location, item_names, amounts in rows:
+            location_totals = added.setdefault(location, {})
+            for item_name, amount in zip(item_names, amounts):
+                if type(amount) != int:
+                    continue
+                counter = location_totals.get(item_name)
+                if counter is None:
+                    location_totals[item_name] = [amount, 1]
+                else:
+                    counter[0] += amount
+                    counter[1] += 1
+        for location, added_totals in added.items():
+            location_totals = self._location_totals.setdefault(location, {})
+            for item_name, (amount, machines) in added_totals.items():
+                for totals in (self._totals, location_totals):
+                    counter = totals.setdefault(item_name, [0, 0])
+                    counter[0] += amount
+                    counter[1] += machines
+            if not location_totals:
+                del self._location_totals[location]
+
+    def update_machine(
+        self: "InventoryAggregates",
+        old_vending_machine: dict | None,
+        new_vending_machine: dict | None,
+    ) -> None:
+        """
+        Apply the difference between two versions of a vending machine to the counters,
+        only touching the items that changed unless the machine moved to another location.
+
+        Parameters:
+            old_vending_machine (dict | None): The vending machine before the change, None if it was created.
+            new_vending_machine (dict | None): The vending machine after the change, None if it was deleted.
+
+        Returns:
+            None
+        """
+        old_location = old_vending_machine["location"] if old_vending_machine else None
+        new_location = new_vending_machine["location"] if new_vending_machine else None
+        old_items = old_vending_machine["items"] if old_vending_machine else {}
+        new_items = new_vending_machine["items"] if new_vending_machine else {}
+        moved = old_location != new_location
+
+        for item_name, amount in old_items.items():
+            if moved or new_items.get(item_name) != amount:
+                self._count(old_location, item_name, amount, -1)
+        for item_name, amount in new_items.items():
+            if moved or old_items.get(item_name) != amount:
+                self._count(new_location, item_name, amount, 1)
+
+    def totals(
+        self: "InventoryAggregates",
+        location: str | None = None,
+        item_name: str | None = None,
+    ) -> dict[str, dict]:
+        """
+        Read the counters of the fleet or of one location.
+
+        Parameters:
+            location (str | None): Only the vending machines at this location, None for the whole fleet.
+            item_name (str | None): Only this item, None for every item.
+
+        Returns:
+            dict[str, dict]: The 'amount' and number of 'machines' of each item, by item name.
+        """
+        totals = (
+            self._totals
+            if location is None
+            else self._location_totals.get(location, {})
+        )
+        if item_name is not None:
+            totals = {item_name: totals[item_name]} if item_name in totals else {}
+        return {
+            name: {"amount": amount, "machines": machines}
+            for name, (amount, machines) in totals.items()
+        }
+
+    def differences(
+        self: "InventoryAggregates", expected: "InventoryAggregates"
+    ) -> list[dict]:
+        """
+        Compare the counters with the expected ones.
+
+        Parameters:
+            expected (InventoryAggregates): The reference counters, usually computed from scratch.
+
+        Returns:
+            List[dict]: The 'location', 'item', 'expected' and 'actual' counters of every mismatch,
+            a location of None standing for the fleet-wide counters.
+        """
+        mismatches = []
+        pairs = [(None, expected._totals, self._totals)]
+        for location in sorted(
+            set(expected._location_totals) | set(self._location_totals)
+        ):
+            pairs.append(
+                (
+                    location,
+                    expected._location_totals.get(location, {}),
+                    self._location_totals.get(location, {}),
+                )
+            )
+        for location, expected_totals, actual_totals in pairs:
+            for item_name in sorted(set(expected_totals) | set(actual_totals)):
+                expected_counter = expected_totals.get(item_name, [0, 0])
+                actual_counter = actual_totals.get(item_name, [0, 0])
+                if expected_counter != actual_counter:
+                    mismatches.append(
+                        {
+                            "location": location,
+                            "item": item_name,
+                            "expected": {
+                                "amount": expected_counter[0],
+                                "machines": expected_counter[1],
+                            },
+                            "actual": {
+                                "amount": actual_counter[0],
+                                "machines": actual_counter[1],
+                            },
+                        }
+                    )
+        return mismatches
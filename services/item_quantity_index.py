@@ -0,0 +1,160 @@
+import bisect
+import heapq
+import itertools
+from typing import Iterable, Iterator
+
+
+class ItemQuantityIndex:
+    """
+    Inverted index from item name to the (amount, vending machine name) pairs holding that item,
+    each list kept sorted by amount so low stock queries are answered with range scans.
+    The index is not thread-safe, callers serialize access to it.
+    """
+
+    def __init__(self: "ItemQuantityIndex") -> None:
+        self._entries: dict[str, list[tuple[int, str]]] = {}
+
+    def clear(self: "ItemQuantityIndex") -> None:
+        self._entries.clear()
+
+    def add(
+        self: "ItemQuantityIndex",
+        item_name: str,
+        amount: int,
+        vending_machine_name: str,
+    ) -> None:
+        if type(amount) != int:
+            return
+        bisect.insort(
+            self._entries.setdefault(item_name, []), (amount, vending_machine_name)
+        )
+
+    def add_machines(
+        self: "ItemQuantityIndex", vending_machines: Iterable[dict]
+    ) -> None:
+        """
+        Add the entries of many vending machines at once, e.g. when loading the fleet. The entries are
+        appended and each list sorted once, instead of inserting them one by one.
+
+        Parameters:
+            vending_machines (Iterable[dict]): The vending machines, none of them already in the index.
+
+        Returns:
+            None
+        """
+        self.add_rows(
+            (
+                vending_machine["name"],
+                vending_machine["location"],
+                vending_machine["items"],
+                vending_machine["items"].values(),
+            )
+            for vending_machine in vending_machines
+        )
+
+    def add_rows(
+        self: "ItemQuantityIndex",
+        rows: Iterable[tuple[str, str, Iterable[str], Iterable]],
+    ) -> None:
+        """
+        Add the entries of many vending machines given as rows, see add_machines.
+
+        Parameters:
+            rows (Iterable[tuple[str, str, Iterable[str], Iterable]]): The name, location, item names and
+                amounts of each vending machine, none of them already in the index.
+
+        Returns:
+            None
+        """
+        for vending_machine_name, _, item_names, amounts in rows:
+            for item_name, amount in zip(item_names, amounts):
+                if type(amount) == int:
+                    self._entries.setdefault(item_name, []).append(
+                        (amount, vending_machine_name)
+                    )
+        for entries in self._entries.values():
+            entries.sort()
+
+    def remove(
+        self: "ItemQuantityIndex",
+        item_name: str,
+        amount: int,
+        vending_machine_name: str,
+    ) -> None:
+        entries = self._entries.get(item_name)
+        if entries is None or type(amount) != int:
+            return
+        position = bisect.bisect_left(entries, (amount, vending_machine_name))
+        if position < len(entries) and entries[position] == (
+            amount,
+            vending_machine_name,
+        ):
+            del entries[position]
+        if not entries:
+            del self._entries[item_name]
+
+    def update_machine(
+        self: "ItemQuantityIndex",
+        old_vending_machine: dict | None,
+        new_vending_machine: dict | None,
+    ) -> None:
+        """
+        Replace the entries of a vending machine after it changed, only touching the items that changed
+        unless the machine was renamed.
+
+        Parameters:
+            old_vending_machine (dict | None): The vending machine before the change, None if it was created.
+            new_vending_machine (dict | None): The vending machine after the change, None if it was deleted.
+
+        Returns:
+            None
+        """
+        old_name = old_vending_machine["name"] if old_vending_machine else None
+        new_name = new_vending_machine["name"] if new_vending_machine else None
+        old_items = old_vending_machine["items"] if old_vending_machine else {}
+        new_items = new_vending_machine["items"] if new_vending_machine else {}
+
+        for item_name, amount in old_items.items():
+            if old_name != new_name or new_items.get(item_name) != amount:
+                self.remove(item_name, amount, old_name)
+        for item_name, amount in new_items.items():
+            if old_name != new_name or old_items.get(item_name) != amount:
+                self.add(item_name, amount, new_name)
+
+    def lowest(
+        self: "ItemQuantityIndex",
+        item_name: str | None = None,
+        below: int | None = None,
+    ) -> Iterator[tuple[int, str, str]]:
+        """
+        Lazily yields (amount, item name, vending machine name) in ascending amount order.
+
+        Parameters:
+            item_name (str | None): Only this item, None for every item.
+            below (int | None): Only the amounts strictly below it, None for every amount.
+
+        Returns:
+            Iterator[tuple[int, str, str]]: The matching entries, lowest amount first.
+        """
+        if item_name is not None:
+            item_names = [item_name] if item_name in self._entries else []
+        else:
+            item_names = list(self._entries)
+
+        ranges = []
+        for name in item_names:
+            entries = self._entries[name]
+            end = (
+                len(entries)
+                if below is None
+                else bisect.bisect_left(entries, (below, ""))
+            )
+            ranges.append(self._iter_entries(name, entries, end))
+        return heapq.merge(*ranges)
+
+    @staticmethod
+    def _iter_entries(
+        item_name: str, entries: list[tuple[int, str]], end: int
+    ) -> Iterator[tuple[int, str, str]]:
+        for amount, vending_machine_name in itertools.islice(entries, end):
+            yield amount, item_name, vending_machine_name
@@ -0,0 +1,363 @@
+import bisect
+import contextvars
+import threading
+import time
+from typing import Callable, ContextManager, Iterable, Iterator
+
+from database.machine_repository import (
+    ApplyChange,
+    MachineRepository,
+    MachineRow,
+    Reload,
+    StorageIO,
+    measure_io,
+)
+
+DURATION_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+_request_timing: contextvars.ContextVar[list | None] = contextvars.ContextVar(
+    "request_timing", default=None
+)
+
+
+class Histogram:
+    """Cumulative Prometheus histogram of durations in seconds, not thread-safe."""
+
+    def __init__(self: "Histogram") -> None:
+        self.bucket_counts = [0] * len(DURATION_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self: "Histogram", seconds: float) -> None:
+        position = bisect.bisect_left(DURATION_BUCKETS, seconds)
+        if position < len(DURATION_BUCKETS):
+            self.bucket_counts[position] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def render(self: "Histogram", name: str, labels: str) -> list[str]:
+        lines = []
+        cumulative_count = 0
+        for bound, bucket_count in zip(DURATION_BUCKETS, self.bucket_counts):
+            cumulative_count += bucket_count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative_count}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum{{{labels}}} {self.sum}")
+        lines.append(f"{name}_count{{{labels}}} {self.count}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Thread-safe collection of the request and storage call metrics of the API,
+    rendered in the Prometheus text exposition format.
+
+    Storage calls made while a request is being timed are also summed per request,
+    so the route can report them in a Server-Timing header.
+    """
+
+    def __init__(self: "MetricsRegistry") -> None:
+        self._lock = threading.Lock()
+        self._request_durations: dict[tuple[str, str], Histogram] = {}
+        self._request_counts: dict[tuple[str, str, int], int] = {}
+        self._storage_durations: dict[str, Histogram] = {}
+        self._storage_documents: dict[str, int] = {}
+        self._storage_scanned: dict[str, int] = {}
+        self._storage_bytes_read: dict[str, int] = {}
+        self._storage_bytes_written: dict[str, int] = {}
+        self._startup_seconds: dict[str, float] = {}
+
+    def observe_request(
+        self: "MetricsRegistry", method: str, route: str, status: int, seconds: float
+    ) -> None:
+        with self._lock:
+            self._request_durations.setdefault((method, route), Histogram()).observe(
+                seconds
+            )
+            key = (method, route, status)
+            self._request_counts[key] = self._request_counts.get(key, 0) + 1
+
+    def observe_storage_call(
+        self: "MetricsRegistry",
+        operation: str,
+        seconds: float,
+        documents: int,
+        bytes_read: int = 0,
+        bytes_written: int = 0,
+        documents_scanned: int | None = None,
+    ) -> None:
+        """
+        Record one repository call.
+
+        Parameters:
+            operation (str): The repository method.
+            seconds (float): The time spent in the call.
+            documents (int): The number of vending machines returned or written by the call.
+            bytes_read (int): The bytes read from the storage by the call.
+            bytes_written (int): The bytes written to the storage by the call.
+            documents_scanned (int | None): The number of vending machines decoded or examined by the call,
+                documents when the backend does not report it.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self._storage_durations.setdefault(operation, Histogram()).observe(seconds)
+            for counters, value in (
+                (self._storage_documents, documents),
+                (
+                    self._storage_scanned,
+                    documents if documents_scanned is None else documents_scanned,
+                ),
+                (self._storage_bytes_read, bytes_read),
+                (self._storage_bytes_written, bytes_written),
+            ):
+                counters[operation] = counters.get(operation, 0) + value
+        request_timing = _request_timing.get()
+        if request_timing is not None:
+            request_timing[0] += seconds
+            request_timing[1] += 1
+
+    def observe_startup(self: "MetricsRegistry", phase: str, seconds: float) -> None:
+        """Record the time taken by a startup phase, e.g. opening the database."""
+        with self._lock:
+            self._startup_seconds[phase] = seconds
+
+    def start_request_timing(self: "MetricsRegistry") -> contextvars.Token:
+        """Start summing the storage calls of the current request, returns the token ending it."""
+        return _request_timing.set([0.0, 0])
+
+    def stop_request_timing(
+        self: "MetricsRegistry", token: contextvars.Token
+    ) -> tuple[float, int]:
+        """Stop summing the storage calls of the current request, returns their total seconds and count."""
+        storage_seconds, storage_calls = _request_timing.get()
+        _request_timing.reset(token)
+        return storage_seconds, storage_calls
+
+    def render(self: "MetricsRegistry") -> str:
+        """
+        Render every metric in the Prometheus text exposition format.
+
+        Returns:
+            str: The metrics, one sample per line.
+        """
+        with self._lock:
+            lines = [
+                "# HELP vending_http_requests_total Requests handled by the API.",
+                "# TYPE vending_http_requests_total counter",
+            ]
+            for (method, route, status), count in sorted(self._request_counts.items()):
+                lines.append(
+                    f'vending_http_requests_total{{method="{method}",route="{route}",status="{status}"}} {count}'
+                )
+            lines += [
+                "# HELP vending_http_request_duration_seconds Time spent handling a request.",
+                "# TYPE vending_http_request_duration_seconds histogram",
+            ]
+            for (method, route), histogram in sorted(self._request_durations.items()):
+                lines += histogram.render(
+                    "vending_http_request_duration_seconds",
+                    f'method="{method}",route="{route}"',
+                )
+            lines += [
+                "# HELP vending_storage_call_duration_seconds Time spent in a repository call.",
+                "# TYPE vending_storage_call_duration_seconds histogram",
+            ]
+            for operation, histogram in sorted(self._storage_durations.items()):
+                lines += histogram.render(
+                    "vending_storage_call_duration_seconds",
+                    f'operation="{operation}"',
+                )
+            for name, help_text, counters in (
+                (
+                    "vending_storage_documents_total",
+                    "Vending machines returned or written by repository calls.",
+                    self._storage_documents,
+                ),
+                (
+                    "vending_storage_scanned_documents_total",
+                    "Vending machines decoded or examined by repository calls, "
+                    "the ones returned or written where the backend does not report it.",
+                    self._storage_scanned,
+                ),
+                (
+                    "vending_storage_read_bytes_total",
+                    "Bytes read from the storage by repository calls, "
+                    "excluding background flushes and compactions.",
+                    self._storage_bytes_read,
+                ),
+                (
+                    "vending_storage_written_bytes_total",
+                    "Bytes written to the storage by repository calls, "
+                    "excluding background flushes and compactions.",
+                    self._storage_bytes_written,
+                ),
+            ):
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+                for operation, value in sorted(counters.items()):
+                    lines.append(f'{name}{{operation="{operation}"}} {value}')
+            lines += [
+                "# HELP vending_startup_seconds Time taken by each startup phase.",
+                "# TYPE vending_startup_seconds gauge",
+            ]
+            for phase, seconds in sorted(self._startup_seconds.items()):
+                lines.append(f'vending_startup_seconds{{phase="{phase}"}} {seconds}')
+        return "\n".join(lines) + "\n"
+
+
+class InstrumentedMachineRepository(MachineRepository):
+    """
+    Repository decorator recording the duration, the number of vending machines and the storage bytes
+    of every call to the wrapped repository in a MetricsRegistry.
+    Bytes and scanned machines are those the backend reports with database.machine_repository.record_io
+    in the calling thread, so concurrent calls do not count each other's work.
+    """
+
+    def __init__(
+        self: "InstrumentedMachineRepository",
+        repository: MachineRepository,
+        metrics: MetricsRegistry,
+    ) -> None:
+        self.repository = repository
+        self.metrics = metrics
+
+    def _call(
+        self: "InstrumentedMachineRepository",
+        operation: str,
+        call: Callable[[], object],
+        count_documents: Callable[[object], int],
+    ) -> object:
+        with measure_io() as storage_io:
+            start = time.perf_counter()
+            result = call()
+            seconds = time.perf_counter() - start
+        self._observe(operation, seconds, count_documents(result), storage_io)
+        return result
+
+    def _observe(
+        self: "InstrumentedMachineRepository",
+        operation: str,
+        seconds: float,
+        documents: int,
+        storage_io: StorageIO,
+    ) -> None:
+        self.metrics.observe_storage_call(
+            operation,
+            seconds,
+            documents,
+            storage_io.bytes_read,
+            storage_io.bytes_written,
+            storage_io.documents_scanned,
+        )
+
+    def exists(
+        self: "InstrumentedMachineRepository", vending_machine_name: str
+    ) -> bool:
+        return self._call(
+            "exists", lambda: self.repository.exists(vending_machine_name), int
+        )
+
+    def get(
+        self: "InstrumentedMachineRepository", vending_machine_name: str
+    ) -> dict | None:
+        return self._call(
+            "get",
+            lambda: self.repository.get(vending_machine_name),
+            lambda machine: int(machine is not None),
+        )
+
+    def get_many(
+        self: "InstrumentedMachineRepository", vending_machine_names: Iterable[str]
+    ) -> list[dict]:
+        return self._call(
+            "get_many", lambda: self.repository.get_many(vending_machine_names), len
+        )
+
+    def all(self: "InstrumentedMachineRepository") -> list[dict]:
+        return self._call("all", self.repository.all, len)
+
+    def rows(self: "InstrumentedMachineRepository") -> list[MachineRow]:
+        return self._call("rows", self.repository.rows, len)
+
+    def iterate(
+        self: "InstrumentedMachineRepository",
+        after: int | None = None,
+        location: str | None = None,
+        names: Iterable[str] | None = None,
+    ) -> Iterator[tuple[int, dict]]:
+        # Only the time spent producing machines is recorded, not the time the caller holds them.
+        start = time.perf_counter()
+        with measure_io() as storage_io:
+            machines = self.repository.iterate(after, location, names)
+        seconds = time.perf_counter() - start
+        documents = 0
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    with measure_io(storage_io):
+                        key_and_machine = next(machines)
+                except StopIteration:
+                    break
+                finally:
+                    seconds += time.perf_counter() - start
+                documents += 1
+                yield key_and_machine
+        finally:
+            self._observe("iterate", seconds, documents, storage_io)
+
+    def insert(self: "InstrumentedMachineRepository", vending_machine: dict) -> dict:
+        return self._call(
+            "insert", lambda: self.repository.insert(vending_machine), lambda _: 1
+        )
+
+    def insert_many(
+        self: "InstrumentedMachineRepository", vending_machines: Iterable[dict]
+    ) -> None:
+        vending_machines = list(vending_machines)
+        self._call(
+            "insert_many",
+            lambda: self.repository.insert_many(vending_machines),
+            lambda _: len(vending_machines),
+        )
+
+    def update_many(
+        self: "InstrumentedMachineRepository",
+        vending_machine_names: Iterable[str],
+        transform: Callable[[dict], None],
+    ) -> list[dict]:
+        return self._call(
+            "update_many",
+            lambda: self.repository.update_many(vending_machine_names, transform),
+            len,
+        )
+
+    def delete(
+        self: "InstrumentedMachineRepository", vending_machine_name: str
+    ) -> None:
+        self._call(
+            "delete", lambda: self.repository.delete(vending_machine_name), lambda _: 1
+        )
+
+    def truncate(self: "InstrumentedMachineRepository") -> None:
+        self._call("truncate", self.repository.truncate, lambda _: 0)
+
+    def io_bytes(self: "InstrumentedMachineRepository") -> tuple[int, int] | None:
+        return self.repository.io_bytes()
+
+    def watch(
+        self: "InstrumentedMachineRepository",
+        apply_change: ApplyChange,
+        reload: Reload,
+    ) -> str | None:
+        return self.repository.watch(apply_change, reload)
+
+    def sync(self: "InstrumentedMachineRepository") -> None:
+        self.repository.sync()
+
+    def write_lock(self: "InstrumentedMachineRepository") -> ContextManager[None]:
+        return self.repository.write_lock()
+
+    def close(self: "InstrumentedMachineRepository") -> None:
+        self.repository.close()
@@ -0,0 +1,68 @@
+import threading
+from collections import OrderedDict
+from typing import Hashable
+
+DEFAULT_MAX_ENTRIES = 10000
+
+
+class ResponseCache:
+    """
+    Bounded LRU cache of serialized responses, each stored with the ETag of the data it was rendered from.
+    An entry is only returned for the ETag it was stored with, so a write, which changes the version
+    the ETag is built from, invalidates exactly the responses showing the written data.
+    """
+
+    def __init__(self: "ResponseCache", max_entries: int = DEFAULT_MAX_ENTRIES) -> None:
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[Hashable, tuple[str, bytes]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self: "ResponseCache", key: Hashable, etag: str) -> bytes | None:
+        """
+        Retrieves the response stored under a key if it was rendered for the given ETag.
+
+        Parameters:
+            key (Hashable): The request the response answers.
+            etag (str): The ETag of the current data.
+
+        Returns:
+            bytes | None: The serialized response, None if missing or stale.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != etag:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self: "ResponseCache", key: Hashable, etag: str, body: bytes) -> None:
+        """
+        Store a serialized response, replacing the one stored under the same key and evicting
+        the least recently used response when the cache is full.
+
+        Parameters:
+            key (Hashable): The request the response answers.
+            etag (str): The ETag of the data the response was rendered from.
+            body (bytes): The serialized response.
+
+        Returns:
+            None
+        """
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (etag, body)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self: "ResponseCache") -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self: "ResponseCache") -> int:
+        return len(self._entries)
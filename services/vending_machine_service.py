@@ -1,11 +1,476 @@
-from tinydb import Query, TinyDB
+import itertools
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Callable, ContextManager, Iterable, Iterator
+
+from tinydb import TinyDB
+
+from database.machine_repository import MachineRepository, TinyDBMachineRepository
+from services.change_feed import DEFAULT_MAX_EVENTS, ChangeFeed
+from services.inventory_aggregates import InventoryAggregates
+from services.item_quantity_index import ItemQuantityIndex
+from services.machine_records import MachineDocument, MachineRecord, SkuTable
+from services.metrics import InstrumentedMachineRepository, MetricsRegistry
+from services.write_coalescer import WriteCoalescer
 
 ""
 
+MACHINE_LOCK_STRIPES = 64
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+MACHINE_FIELDS = ("name", "location", "items")
+SHARED_POLL_INTERVAL = 0.5
+
+
+class _NothingToWrite(Exception):
+    """Raised from a storage transform to abort a write that would not change anything."""
+
+
+class VersionConflictError(ValueError):
+    """Raised by a conditional write when the vending machine is no longer at the expected version."""
+
 
 class VendingMachineService:
-    def __init__(self: "VendingMachineService", db: TinyDB) -> None:
-        self.db = db
+    def __init__(
+        self: "VendingMachineService",
+        db: TinyDB | MachineRepository,
+        metrics: MetricsRegistry | None = None,
+        coalesce_writes: bool = False,
+        change_feed_size: int = DEFAULT_MAX_EVENTS,
+    ) -> None:
+        if isinstance(db, TinyDB):
+            db = TinyDBMachineRepository(db)
+        if metrics is not None:
+            db = InstrumentedMachineRepository(db, metrics)
+        self.repository = db
+        self._machine_locks = [threading.RLock() for _ in range(MACHINE_LOCK_STRIPES)]
+        self._index_lock = threading.Lock()
+        self._skus = SkuTable()
+        self._machines: dict[str, MachineRecord] = {}
+        # Bumped on every change, the version of each record is the sequence number of its last change.
+        self._change_sequence = 0
+        # Tells versions of this service apart from the ones of a previous process, which restarted at 0.
+        self.epoch = uuid.uuid4().hex[:8]
+        self._location_index: dict[str, set[str]] = {}
+        self._item_quantity_index = ItemQuantityIndex()
+        self._inventory_aggregates = InventoryAggregates()
+        self._change_feed = ChangeFeed(change_feed_size)
+        self._write_coalescer = (
+            WriteCoalescer(self._apply_machine_updates) if coalesce_writes else None
+        )
+        shared_epoch = self.repository.watch(
+            self._apply_external_change, self._reload_machines
+        )
+        # With a storage shared between processes, versions are sequence numbers shared by all of them.
+        self.shared = shared_epoch is not None
+        if self.shared:
+            self.epoch = shared_epoch
+        else:
+            self._build_indexes()
+
+    def _build_indexes(self: "VendingMachineService") -> None:
+        """
+        Build the compact machine records, the in-memory secondary indexes and inventory aggregates
+        from every vending machine stored in the repository. This is the only full scan, every mutating
+        method keeps them up to date afterward. The indexes are loaded in bulk from the repository's rows,
+        so no document is built per machine, except for the creation events the change feed keeps.
+        The rows still hold the items of every machine, which the records and indexes need, so a repository
+        decodes all of its machines here once, only in a cheaper form than documents. Each machine still gets its own version and creation event, as if it was indexed by
+        _index_machine_change.
+
+        Returns:
+            None
+        """
+        rows = self.repository.rows()
+        with self._index_lock:
+            self._change_sequence += 1
+            self._machines.clear()
+            self._location_index.clear()
+            self._item_quantity_index.clear()
+            self._inventory_aggregates.clear()
+            for name, location, item_names, amounts in rows:
+                self._change_sequence += 1
+                record = MachineRecord.from_row(
+                    name,
+                    location,
+                    item_names,
+                    amounts,
+                    self._skus,
+                    self._change_sequence,
+                )
+                self._machines[record.name] = record
+                self._location_index.setdefault(record.location, set()).add(record.name)
+            self._item_quantity_index.add_rows(rows)
+            self._inventory_aggregates.add_rows(rows)
+            kept = itertools.islice(
+                reversed(self._machines.values()), self._change_feed.max_events
+            )
+            self._change_feed.publish_machines_created(
+                [record.to_document(self._skus) for record in kept][::-1],
+                len(self._machines),
+            )
+
+    def _index_machine_change(
+        self: "VendingMachineService",
+        old_vending_machine: dict | None,
+        new_vending_machine: dict | None,
+    ) -> None:
+        """
+        Update the machine records, secondary indexes and inventory aggregates after a vending machine changed,
+        and publish the change to the change feed.
+
+        Parameters:
+            old_vending_machine (dict | None): The vending machine before the change, None if it was created.
+            new_vending_machine (dict | None): The vending machine after the change, None if it was deleted.
+
+        Returns:
+            None
+        """
+        with self._index_lock:
+            self._change_sequence += 1
+            if old_vending_machine is not None:
+                del self._machines[old_vending_machine["name"]]
+                machine_names = self._location_index[old_vending_machine["location"]]
+                machine_names.discard(old_vending_machine["name"])
+                if not machine_names:
+                    del self._location_index[old_vending_machine["location"]]
+            if new_vending_machine is not None:
+                self._machines[new_vending_machine["name"]] = (
+                    MachineRecord.from_document(
+                        new_vending_machine, self._skus, self._change_sequence
+                    )
+                )
+                self._location_index.setdefault(
+                    new_vending_machine["location"], set()
+                ).add(new_vending_machine["name"])
+            self._item_quantity_index.update_machine(
+                old_vending_machine, new_vending_machine
+            )
+            self._inventory_aggregates.update_machine(
+                old_vending_machine, new_vending_machine
+            )
+            self._change_feed.publish_machine_change(
+                old_vending_machine, new_vending_machine
+            )
+
+    def _apply_external_change(
+        self: "VendingMachineService",
+        sequence: int,
+        old_vending_machine_name: str | None,
+        new_vending_machine: dict | None,
+    ) -> None:
+        """
+        Apply a change made by another process sharing the storage to the machine records and indexes.
+
+        Parameters:
+            sequence (int): The shared sequence number of the change, the version of the changed machine.
+            old_vending_machine_name (str | None): The name of the vending machine before the change, None if it
+            was created.
+            new_vending_machine (dict | None): The vending machine after the change, None if it was deleted.
+
+        Returns:
+            None
+        """
+        old_vending_machine = None
+        if old_vending_machine_name in self._machines:
+            old_vending_machine = self._get_machine_document(old_vending_machine_name)
+        with self._index_lock:
+            self._change_sequence = sequence - 1
+        if old_vending_machine is None and new_vending_machine is None:
+            with self._index_lock:
+                self._change_sequence = sequence
+            return
+        self._index_machine_change(old_vending_machine, new_vending_machine)
+
+    def _reload_machines(
+        self: "VendingMachineService",
+        base_sequence: int,
+        versions: dict[str, int],
+        sequence: int,
+    ) -> None:
+        """
+        Bring the machine records and indexes up to date with a storage shared with other processes, when its
+        changes cannot be applied one by one. Only the machines that differ are re-indexed and published.
+
+        Parameters:
+            base_sequence (int): The version of the machines without a more recent one in versions.
+            versions (dict[str, int]): The version of the machines changed since base_sequence.
+            sequence (int): The latest shared sequence number, the fleet version.
+
+        Returns:
+            None
+        """
+        with self._index_lock:
+            old_vending_machines = {
+                name: vending_machine.to_document(self._skus)
+                for name, vending_machine in self._machines.items()
+            }
+        new_vending_machines = {
+            vending_machine["name"]: vending_machine
+            for vending_machine in self.repository.all()
+        }
+        for name, old_vending_machine in old_vending_machines.items():
+            if name not in new_vending_machines:
+                self._index_machine_change(old_vending_machine, None)
+        for name, new_vending_machine in new_vending_machines.items():
+            old_vending_machine = old_vending_machines.get(name)
+            if old_vending_machine != new_vending_machine:
+                self._index_machine_change(old_vending_machine, new_vending_machine)
+        with self._index_lock:
+            for name, vending_machine in self._machines.items():
+                self._machines[name] = vending_machine.with_version(
+                    versions.get(name, base_sequence)
+                )
+            self._change_sequence = sequence
+
+    def sync_changes(self: "VendingMachineService") -> None:
+        """
+        Apply the changes made by other processes sharing the storage since the last call, so reads answered
+        from the machine records see them. The API calls it before every request; writes always apply them first.
+
+        Returns:
+            None
+        """
+        self.repository.sync()
+
+    @contextmanager
+    def _lock_stripes(
+        self: "VendingMachineService", stripes: Iterable[int]
+    ) -> Iterator[None]:
+        """
+        Hold the given machine lock stripes, then the write lock of the repository.
+        Stripes are always acquired in index order to avoid deadlocks between multi-machine calls.
+
+        Parameters:
+            stripes (Iterable[int]): The indexes of the lock stripes to hold.
+
+        Returns:
+            Iterator[None]: Context manager holding the locks.
+        """
+        locks = [self._machine_locks[stripe] for stripe in sorted(set(stripes))]
+        for lock in locks:
+            lock.acquire()
+        try:
+            with self.repository.write_lock():
+                yield
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    def _lock_machines(
+        self: "VendingMachineService", vending_machine_names: Iterable[str]
+    ) -> ContextManager[None]:
+        """
+        Hold the striped locks of the given vending machine names.
+        Every check-then-write sequence on a machine runs under its lock, so concurrent callers
+        on the same machine are serialized while different machines proceed in parallel.
+
+        Parameters:
+            vending_machine_names (Iterable[str]): The names of the vending machines to lock.
+
+        Returns:
+            ContextManager[None]: Context manager holding the locks.
+        """
+        return self._lock_stripes(
+            hash(name) % MACHINE_LOCK_STRIPES for name in vending_machine_names
+        )
+
+    def _lock_all_machines(self: "VendingMachineService") -> ContextManager[None]:
+        """
+        Hold every machine lock stripe, for operations that touch the whole fleet.
+
+        Returns:
+            ContextManager[None]: Context manager holding the locks.
+        """
+        return self._lock_stripes(range(MACHINE_LOCK_STRIPES))
+
+    def _machine_exists(
+        self: "VendingMachineService", vending_machine_name: str
+    ) -> bool:
+        """Whether a vending machine with the given name exists, answered from the machine records."""
+        return vending_machine_name in self._machines
+
+    def _get_machine_document(
+        self: "VendingMachineService", vending_machine_name: str
+    ) -> dict:
+        """
+        Retrieves the vending machine with the given name from its compact record, without reading the storage.
+
+        Parameters:
+            vending_machine_name (str): The name of the vending machine.
+
+        Raises:
+            ValueError: If vending machine with the given name does not exist.
+
+        Returns:
+            dict: A new dictionary containing the information of the vending machine.
+        """
+        vending_machine = self._machines.get(vending_machine_name)
+        if vending_machine is None:
+            raise ValueError(
+                f"Vending machine with name '{vending_machine_name}' does not exists."
+            )
+        return vending_machine.to_document(self._skus)
+
+    def _check_version(
+        self: "VendingMachineService",
+        vending_machine_name: str,
+        expected_version: int | None,
+    ) -> None:
+        """
+        Check that a vending machine is at the version a conditional write expects, the caller holds its lock.
+
+        Parameters:
+            vending_machine_name (str): The name of the vending machine.
+            expected_version (int | None): The expected version, None for an unconditional write.
+
+        Raises:
+            VersionConflictError: If the vending machine exists at another version.
+
+        Returns:
+            None
+        """
+        vending_machine = self._machines.get(vending_machine_name)
+        if (
+            expected_version is not None
+            and vending_machine is not None
+            and vending_machine.version != expected_version
+        ):
+            raise VersionConflictError(
+                f"Vending machine with name '{vending_machine_name}' was modified, "
+                f"its version is no longer {expected_version}."
+            )
+
+    def _update_machine_document(
+        self: "VendingMachineService",
+        vending_machine_name: str,
+        transform: Callable[[dict], None],
+        expected_version: int | None = None,
+    ) -> dict:
+        """
+        Locate a vending machine, apply a transform to its stored document and return the result,
+        all within a single read and write of the storage. With write coalescing enabled, updates
+        submitted concurrently by other callers share that storage write.
+
+        Parameters:
+            vending_machine_name (str): The name of the vending machine.
+            transform (Callable[[dict], None]): Function that validates and mutates the stored document in place.
+            Any exception raised by it aborts the update before anything is written.
+            expected_version (int | None): Only apply the update if the vending machine is at this version.
+
+        Raises:
+            ValueError: If vending machine with the given name does not exist.
+            VersionConflictError: If the vending machine is not at the expected version.
+
+        Returns:
+            MachineDocument: A copy of the vending machine document after the transform was applied.
+        """
+        if expected_version is not None:
+            # Checked and applied under the machine lock: a coalesced batch could hold an older version.
+            with self._lock_machines([vending_machine_name]):
+                self._check_version(vending_machine_name, expected_version)
+                [result] = self._apply_machine_updates(
+                    [(vending_machine_name, transform)]
+                )
+        elif self._write_coalescer is not None:
+            return self._write_coalescer.submit(vending_machine_name, transform)
+        else:
+            [result] = self._apply_machine_updates([(vending_machine_name, transform)])
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def _apply_machine_updates(
+        self: "VendingMachineService",
+        updates: list[tuple[str, Callable[[dict], None]]],
+    ) -> list[dict | Exception]:
+        """
+        Apply transforms to vending machines with a single storage write, as if they ran one after another.
+        Each transform works on a copy of the machine, so one that raises leaves the machine as the previous
+        transforms left it and the others are still applied. Nothing is written when every transform fails,
+        and a machine all of whose transforms failed keeps its version and publishes no change.
+
+        Parameters:
+            updates (list[tuple[str, Callable[[dict], None]]]): The vending machine names and their transforms,
+            in application order. Only the last update of a machine may rename it.
+
+        Returns:
+            list[dict | Exception]: For each update, a copy of the vending machine right after its transform,
+            or the exception that aborted it. The last applied update of each machine returns a MachineDocument
+            carrying the version written.
+        """
+        results: list[dict | Exception | None] = [None] * len(updates)
+        updates_by_machine: dict[str, list[tuple[int, Callable[[dict], None]]]] = {}
+        with self._lock_machines(name for name, _ in updates):
+            for index, (vending_machine_name, transform) in enumerate(updates):
+                if vending_machine_name not in updates_by_machine:
+                    if not self._machine_exists(vending_machine_name):
+                        results[index] = ValueError(
+                            f"Vending machine with name '{vending_machine_name}' does not exists."
+                        )
+                        continue
+                    updates_by_machine[vending_machine_name] = []
+                updates_by_machine[vending_machine_name].append((index, transform))
+            if not updates_by_machine:
+                return results
+
+            old_vending_machines = []
+            last_applied: dict[str, int] = {}
+            applied_count = 0
+
+            def apply_transforms(document: dict) -> None:
+                nonlocal applied_count
+                vending_machine_name = document["name"]
+                old_vending_machines.append(
+                    {**document, "items": dict(document["items"])}
+                )
+                for index, transform in updates_by_machine[vending_machine_name]:
+                    vending_machine = {**document, "items": dict(document["items"])}
+                    try:
+                        transform(vending_machine)
+                    except Exception as e:
+                        results[index] = e
+                        continue
+                    document.update(vending_machine)
+                    results[index] = {
+                        **vending_machine,
+                        "items": dict(vending_machine["items"]),
+                    }
+                    last_applied[vending_machine_name] = index
+                    applied_count += 1
+                if (
+                    len(old_vending_machines) == len(updates_by_machine)
+                    and not applied_count
+                ):
+                    raise _NothingToWrite()
+
+            try:
+                vending_machines = self.repository.update_many(
+                    updates_by_machine, apply_transforms
+                )
+            except _NothingToWrite:
+                return results
+            old_by_name = {
+                vending_machine["name"]: vending_machine
+                for vending_machine in old_vending_machines
+            }
+            for vending_machine_name, vending_machine in zip(
+                updates_by_machine, vending_machines
+            ):
+                if vending_machine_name not in last_applied:
+                    # Every transform of the machine failed, it is stored unchanged.
+                    continue
+                self._index_machine_change(
+                    old_by_name[vending_machine_name], vending_machine
+                )
+                if vending_machine_name in last_applied:
+                    index = last_applied[vending_machine_name]
+                    results[index] = MachineDocument(
+                        results[index], self._machines[vending_machine["name"]].version
+                    )
+        return results
 
     def purge_database(self: "VendingMachineService") -> None:
         """
@@ -16,7 +481,16 @@ class VendingMachineService:
         Returns:
             None
         """
-        self.db.truncate()
+        with self._lock_all_machines():
+            with self._index_lock:
+                vending_machines = [
+                    vending_machine.to_document(self._skus)
+                    for vending_machine in self._machines.values()
+                ]
+            self.repository.truncate()
+            self._build_indexes()
+            for vending_machine in vending_machines:
+                self._change_feed.publish_machine_change(vending_machine, None)
 
     def create_new_vending_machine(
         self: "VendingMachineService", vending_machine_name: str, location: str
@@ -35,62 +509,495 @@ class VendingMachineService:
             dict: A dictionary containing the information of the newly created vending machine, including the
             name, location, and items.
         """
-        existing_machine = self.db.search(Query().name == vending_machine_name)
-        if existing_machine:
-            raise ValueError(
-                f"Vending machine with name '{vending_machine_name}' already exists."
-            )
-        self.db.insert(
-            {
+        with self._lock_machines([vending_machine_name]):
+            if self._machine_exists(vending_machine_name):
+                raise ValueError(
+                    f"Vending machine with name '{vending_machine_name}' already exists."
+                )
+            vending_machine = {
                 "name": vending_machine_name,
                 "location": location,
                 "items": {},
             }
-        )
-        return self.get_vending_machine_info(vending_machine_name)
+            vending_machine = self.repository.insert(vending_machine)
+            self._index_machine_change(None, vending_machine)
+            return MachineDocument(
+                vending_machine, self._machines[vending_machine_name].version
+            )
 
     def get_vending_machine_info(
-        self: "VendingMachineService", vending_machine_name: str
+        self: "VendingMachineService",
+        vending_machine_name: str,
+        fields: list[str] | None = None,
     ) -> dict:
         """
         Retrieves the information of a vending machine with the given name.
 
         Parameters:
             vending_machine_name (str): The name of the vending machine.
+            fields (list[str] | None): The fields to return among 'name', 'location' and 'items', None for all.
 
         Raises:
             ValueError: If vending machine with the given name does not exist.
+            ValueError: If fields contain an unknown field.
 
         Returns:
             dict: A dictionary containing the information of the vending machine, including the name, location, and items.
         """
-        existing_machine = self.db.search(Query().name == vending_machine_name)
-        if not existing_machine:
+        self._validate_fields(fields)
+        return self._project(self._get_machine_document(vending_machine_name), fields)
+
+    def get_machine_version(
+        self: "VendingMachineService", vending_machine_name: str
+    ) -> int:
+        """
+        Retrieves the version of a vending machine, which changes every time the machine is written.
+        Versions only grow and are never shared by two machines, so a version identifies one state of one machine.
+
+        Parameters:
+            vending_machine_name (str): The name of the vending machine.
+
+        Raises:
+            ValueError: If vending machine with the given name does not exist.
+
+        Returns:
+            int: The version of the vending machine.
+        """
+        vending_machine = self._machines.get(vending_machine_name)
+        if vending_machine is None:
             raise ValueError(
                 f"Vending machine with name '{vending_machine_name}' does not exists."
             )
-        return existing_machine[0]
+        return vending_machine.version
+
+    def get_fleet_version(self: "VendingMachineService") -> int:
+        """
+        Retrieves the version of the whole fleet, which changes every time any vending machine is written.
 
-    def get_all_vending_machine_info(self: "VendingMachineService") -> [dict]:
+        Returns:
+            int: The version of the fleet.
+        """
+        return self._change_sequence
+
+    def get_all_vending_machine_info(
+        self: "VendingMachineService",
+        location: str | None = None,
+        item_name: str | None = None,
+        below: int | None = None,
+        fields: list[str] | None = None,
+    ) -> [dict]:
         """
         Retrieves all of a vending machine information in the database.
+        Optional filters select the machines at a location, the machines holding an item, and the
+        machines with an item below a quantity threshold; they are combined with AND.
+        A location-only filter is answered from the location index and ordered by name.
 
         Parameters:
-            None
+            location (str | None): Only the machines at this location.
+            item_name (str | None): Only the machines holding this item.
+            below (int | None): Only the machines with an item, the given item_name if any, whose amount is below it.
+            fields (list[str] | None): The fields to return among 'name', 'location' and 'items', None for all.
 
         Raises:
-            ValueError: If vending machine with the given name does not exist.
+            ValueError: If a filter or fields is not a valid value.
 
         Returns:
             List[dict]: A List of dictionary containing the information of every vending machine in the database.
         """
-        all_machine = self.db.all()
-        return all_machine
+        if location is None and item_name is None and below is None:
+            self._validate_fields(fields)
+            return [
+                self._project(vending_machine, fields)
+                for vending_machine in self.repository.all()
+            ]
+        if location is not None and item_name is None and below is None:
+            return self.get_vending_machines_by_location(location, fields)
+        return list(
+            self.iter_all_vending_machine_info(location, item_name, below, fields)
+        )
+
+    def get_vending_machine_page(
+        self: "VendingMachineService",
+        cursor: int | None = None,
+        offset: int = 0,
+        limit: int = DEFAULT_PAGE_SIZE,
+        location: str | None = None,
+        item_name: str | None = None,
+        below: int | None = None,
+        fields: list[str] | None = None,
+    ) -> dict:
+        """
+        Retrieves one page of vending machine information, in storage order.
+        Pages are addressed either by the cursor returned with the previous page or by an offset,
+        the page size is capped to MAX_PAGE_SIZE. Filters and fields are the same as get_all_vending_machine_info.
+
+        Parameters:
+            cursor (int | None): The 'next_cursor' of the previous page, None to start from the beginning.
+            offset (int): The number of vending machines to skip after the cursor.
+            limit (int): The maximum number of vending machines in the page.
+            location (str | None): Only the machines at this location.
+            item_name (str | None): Only the machines holding this item.
+            below (int | None): Only the machines with an item, the given item_name if any, whose amount is below it.
+            fields (list[str] | None): The fields to return among 'name', 'location' and 'items', None for all.
+
+        Raises:
+            ValueError: If the cursor, offset, limit, a filter or fields is not a valid value.
+
+        Returns:
+            dict: A dictionary containing the 'machines' of the page and the 'next_cursor',
+            which is None on the last page.
+        """
+        if cursor is not None and (type(cursor) != int or cursor < 0):
+            raise ValueError("'cursor' must be a non-negative int value")
+        if type(offset) != int or offset < 0:
+            raise ValueError("'offset' must be a non-negative int value")
+        if type(limit) != int or limit < 1:
+            raise ValueError("'limit' must be a positive int value")
+        limit = min(limit, MAX_PAGE_SIZE)
+        self._validate_fields(fields)
+
+        machines = []
+        next_cursor = None
+        for index, (key, vending_machine) in enumerate(
+            self._query_machines(cursor, location, item_name, below)
+        ):
+            if index < offset:
+                continue
+            if len(machines) == limit:
+                break
+            machines.append(self._project(vending_machine, fields))
+            next_cursor = key
+        else:
+            next_cursor = None
+        return {"machines": machines, "next_cursor": next_cursor}
+
+    def iter_all_vending_machine_info(
+        self: "VendingMachineService",
+        location: str | None = None,
+        item_name: str | None = None,
+        below: int | None = None,
+        fields: list[str] | None = None,
+    ) -> Iterator[dict]:
+        """
+        Lazily yields every vending machine information in the database, in storage order,
+        so callers can start processing before the whole fleet has been read.
+        Filters and fields are the same as get_all_vending_machine_info.
+
+        Parameters:
+            location (str | None): Only the machines at this location.
+            item_name (str | None): Only the machines holding this item.
+            below (int | None): Only the machines with an item, the given item_name if any, whose amount is below it.
+            fields (list[str] | None): The fields to return among 'name', 'location' and 'items', None for all.
+
+        Raises:
+            ValueError: If a filter or fields is not a valid value.
+
+        Returns:
+            Iterator[dict]: The vending machines.
+        """
+        self._validate_fields(fields)
+        machines = self._query_machines(None, location, item_name, below)
+        return (
+            self._project(vending_machine, fields) for _, vending_machine in machines
+        )
+
+    def get_vending_machines_by_location(
+        self: "VendingMachineService",
+        location: str,
+        fields: list[str] | None = None,
+    ) -> list[dict]:
+        """
+        Retrieves the vending machines at a location through the location index and the machine records,
+        in time proportional to the number of machines at that location and without reading the storage.
+
+        Parameters:
+            location (str): The location of the vending machines.
+            fields (list[str] | None): The fields to return among 'name', 'location' and 'items', None for all.
+
+        Raises:
+            ValueError: If location is not a string or fields contain an unknown field.
+
+        Returns:
+            List[dict]: The vending machines at the location, ordered by name.
+        """
+        if type(location) != str:
+            raise ValueError("'location' must be a string")
+        self._validate_fields(fields)
+        with self._index_lock:
+            vending_machines = [
+                self._machines[vending_machine_name]
+                for vending_machine_name in sorted(
+                    self._location_index.get(location, ())
+                )
+            ]
+        return [
+            self._project(vending_machine.to_document(self._skus), fields)
+            for vending_machine in vending_machines
+        ]
+
+    def get_low_stock_items(
+        self: "VendingMachineService",
+        item_name: str | None = None,
+        below: int | None = None,
+        count: int | None = None,
+    ) -> list[dict]:
+        """
+        Retrieves (vending machine, item) pairs ordered by ascending amount from the item quantity index,
+        e.g. every pair below a threshold, or the top-N emptiest vending machines for an item.
+
+        Parameters:
+            item_name (str | None): Only this item, None for every item.
+            below (int | None): Only the amounts strictly below it.
+            count (int | None): The maximum number of pairs to return.
+
+        Raises:
+            ValueError: If neither below nor count is given, or a value is not valid.
+
+        Returns:
+            List[dict]: Dictionaries containing the vending machine 'name', the 'item' and its 'amount'.
+        """
+        if below is None and count is None:
+            raise ValueError("Either 'below' or 'count' must be given")
+        if item_name is not None and type(item_name) != str:
+            raise ValueError("'item' must be a string")
+        if below is not None and type(below) != int:
+            raise ValueError("'below' must be an int value")
+        if count is not None and (type(count) != int or count < 1):
+            raise ValueError("'count' must be a positive int value")
+
+        with self._index_lock:
+            entries = list(
+                itertools.islice(
+                    self._item_quantity_index.lowest(item_name, below), count
+                )
+            )
+        return [
+            {"name": vending_machine_name, "item": entry_item_name, "amount": amount}
+            for amount, entry_item_name, vending_machine_name in entries
+        ]
+
+    def get_inventory_aggregates(
+        self: "VendingMachineService",
+        location: str | None = None,
+        item_name: str | None = None,
+    ) -> dict[str, dict]:
+        """
+        Retrieves the total amount of each item and the number of vending machines holding it,
+        across the fleet or at one location, from the running counters instead of scanning every machine.
+
+        Parameters:
+            location (str | None): Only the vending machines at this location, None for the whole fleet.
+            item_name (str | None): Only this item, None for every item.
+
+        Raises:
+            ValueError: If location or item_name is not a string.
+
+        Returns:
+            dict[str, dict]: The 'amount' and number of 'machines' of each item, by item name.
+        """
+        if location is not None and type(location) != str:
+            raise ValueError("'location' must be a string")
+        if item_name is not None and type(item_name) != str:
+            raise ValueError("'item' must be a string")
+        with self._index_lock:
+            return self._inventory_aggregates.totals(location, item_name)
+
+    def check_inventory_aggregates(
+        self: "VendingMachineService", repair: bool = False
+    ) -> dict:
+        """
+        Recompute the inventory aggregates from every stored vending machine and compare them
+        with the running counters. Every machine is locked meanwhile, so the comparison sees no write in flight.
+
+        Parameters:
+            repair (bool): Replace the running counters with the recomputed ones when they differ.
+
+        Returns:
+            dict: A dictionary containing 'consistent' and the 'mismatches' found, see InventoryAggregates.differences.
+        """
+        with self._lock_all_machines():
+            expected = InventoryAggregates.from_machines(self.repository.all())
+            with self._index_lock:
+                mismatches = self._inventory_aggregates.differences(expected)
+                if mismatches and repair:
+                    self._inventory_aggregates = expected
+        return {"consistent": not mismatches, "mismatches": mismatches}
+
+    def get_changes(
+        self: "VendingMachineService",
+        since: int = 0,
+        limit: int = DEFAULT_PAGE_SIZE,
+        epoch: str | None = None,
+    ) -> dict:
+        """
+        Retrieves the changes made to the vending machines after a sequence number, oldest first,
+        so consumers can follow the fleet from deltas instead of reloading it. See ChangeFeed for the events.
+        Sequence numbers restart in every process, so they are only comparable under the same epoch.
+
+        Parameters:
+            since (int): The 'last_sequence' of the previous call, 0 for every change still held.
+            limit (int): The maximum number of changes to return, capped to MAX_PAGE_SIZE.
+            epoch (str | None): The 'epoch' of the previous call. When it is not the current one, since
+                counts from another process: the changes are returned from the first one held, as missed.
+
+        Raises:
+            ValueError: If since, limit or epoch is not a valid value.
+
+        Returns:
+            dict: A dictionary containing the 'changes', the 'epoch' and 'last_sequence' to pass to the next call
+            and 'missed', true when changes after since are no longer held and the full state should be reloaded.
+        """
+        if type(since) != int or since < 0:
+            raise ValueError("'since' must be a non-negative int value")
+        if type(limit) != int or limit < 1:
+            raise ValueError("'limit' must be a positive int value")
+        if epoch is not None and type(epoch) != str:
+            raise ValueError("'epoch' must be a string")
+        other_epoch = epoch is not None and epoch != self.epoch
+        if other_epoch:
+            since = 0
+        changes, missed = self._change_feed.since(since, min(limit, MAX_PAGE_SIZE))
+        if changes:
+            last_sequence = changes[-1]["sequence"]
+        else:
+            last_sequence = min(since, self._change_feed.last_sequence)
+        return {
+            "changes": changes,
+            "epoch": self.epoch,
+            "last_sequence": last_sequence,
+            "missed": missed or other_epoch,
+        }
+
+    def wait_for_changes(
+        self: "VendingMachineService", since: int, timeout: float
+    ) -> bool:
+        """
+        Wait until a change is made after a sequence number.
+        With a storage shared between processes, their changes are polled every SHARED_POLL_INTERVAL seconds.
+
+        Parameters:
+            since (int): The sequence number of the last change already received.
+            timeout (float): The maximum number of seconds to wait.
+
+        Returns:
+            bool: Whether changes after the sequence number are available.
+        """
+        if not self.shared:
+            return self._change_feed.wait(since, timeout)
+        deadline = time.monotonic() + timeout
+        while True:
+            self.sync_changes()
+            remaining = deadline - time.monotonic()
+            if self._change_feed.wait(since, min(remaining, SHARED_POLL_INTERVAL)):
+                return True
+            if remaining <= SHARED_POLL_INTERVAL:
+                return False
+
+    def _query_machines(
+        self: "VendingMachineService",
+        cursor: int | None,
+        location: str | None,
+        item_name: str | None,
+        below: int | None,
+    ) -> Iterator[tuple[int, dict]]:
+        """
+        Yields the (key, vending machine) pairs matching the filters, in storage order.
+        The location filter is pushed down to the repository. Item filters look up the matching names in
+        the item quantity index, so only those machines are read, and are checked again on each machine read.
+
+        Parameters:
+            cursor (int | None): Only the machines stored after this key.
+            location (str | None): Only the machines at this location.
+            item_name (str | None): Only the machines holding this item.
+            below (int | None): Only the machines with an item, the given item_name if any, whose amount is below it.
+
+        Raises:
+            ValueError: If a filter is not a valid value.
+
+        Returns:
+            Iterator[tuple[int, dict]]: The matching keys and vending machines.
+        """
+        if location is not None and type(location) != str:
+            raise ValueError("'location' must be a string")
+        if item_name is not None and type(item_name) != str:
+            raise ValueError("'item' must be a string")
+        if below is not None and type(below) != int:
+            raise ValueError("'below' must be an int value")
+
+        def matches(vending_machine: dict) -> bool:
+            item_list = vending_machine["items"]
+            if item_name is not None:
+                if item_name not in item_list:
+                    return False
+                return below is None or item_list[item_name] < below
+            return below is None or any(amount < below for amount in item_list.values())
+
+        names = None
+        if item_name is not None or below is not None:
+            with self._index_lock:
+                names = {
+                    name
+                    for _, _, name in self._item_quantity_index.lowest(item_name, below)
+                }
+            if not names:
+                return iter(())
+        return (
+            (key, vending_machine)
+            for key, vending_machine in self.repository.iterate(cursor, location, names)
+            if matches(vending_machine)
+        )
+
+    @staticmethod
+    def _validate_fields(fields: list[str] | None) -> None:
+        """
+        Check that the requested fields are known vending machine fields.
+
+        Parameters:
+            fields (list[str] | None): The requested fields, None for all.
+
+        Raises:
+            ValueError: If fields is empty or contains an unknown field.
+
+        Returns:
+            None
+        """
+        if fields is None:
+            return
+        if not isinstance(fields, list) or not fields:
+            raise ValueError("'fields' must be a non-empty list of field names")
+        unknown_fields = [field for field in fields if field not in MACHINE_FIELDS]
+        if unknown_fields:
+            raise ValueError(
+                f"Unknown field '{unknown_fields[0]}', fields must be among 'name', 'location' and 'items'"
+            )
+
+    @staticmethod
+    def _project(vending_machine: dict, fields: list[str] | None) -> dict:
+        """
+        Keep only the requested fields of a vending machine.
+
+        Parameters:
+            vending_machine (dict): The vending machine.
+            fields (list[str] | None): The fields to keep, None for all.
+
+        Returns:
+            dict: The vending machine itself when fields is None, otherwise a new dictionary,
+            a MachineDocument carrying the same version when the vending machine is one.
+        """
+        if fields is None:
+            return vending_machine
+        projection = {
+            field: vending_machine[field] for field in MACHINE_FIELDS if field in fields
+        }
+        if isinstance(vending_machine, MachineDocument):
+            return MachineDocument(projection, vending_machine.version)
+        return projection
 
     def change_vending_machine_name(
         self: "VendingMachineService",
         old_vending_machine_name: str,
         new_vending_machine_name: str,
+        expected_version: int | None = None,
     ) -> dict:
         """
         Update the name of a vending machine in the services.
@@ -98,37 +1005,50 @@ class VendingMachineService:
         Parameters:
             old_vending_machine_name (str): The current name of the vending machine.
             new_vending_machine_name (str): The new name of the vending machine.
+            expected_version (int | None): Only apply the change if the vending machine is at this version,
+            None to apply it whatever the version.
 
         Raises:
             ValueError: If the old and new vending machine names are the same.
             ValueError: If the vending machine with the old name does not exist in the services.
+            ValueError: If vending machine with the new name already exist in the services.
+            VersionConflictError: If the vending machine is not at the expected version.
 
         Returns:
             dict: A dictionary containing the information of the newly vending machine name, including the
             name, location, and items.
         """
-        existing_machine = self.db.search(Query().name == old_vending_machine_name)
+        with self._lock_machines([old_vending_machine_name, new_vending_machine_name]):
+            if not self._machine_exists(old_vending_machine_name):
+                raise ValueError(
+                    f"Vending machine with name '{old_vending_machine_name}' does not exists."
+                )
 
-        if not existing_machine:
-            raise ValueError(
-                f"Vending machine with name '{old_vending_machine_name}' does not exists."
-            )
+            if old_vending_machine_name == new_vending_machine_name:
+                raise ValueError(
+                    f"Old vending machine name: '{old_vending_machine_name}' and new vending machine name: '{new_vending_machine_name}' are the same"
+                )
 
-        if old_vending_machine_name == new_vending_machine_name:
-            raise ValueError(
-                f"Old vending machine name: '{old_vending_machine_name}' and new vending machine name: '{new_vending_machine_name}' are the same"
-            )
+            if self._machine_exists(new_vending_machine_name):
+                raise ValueError(
+                    f"Vending machine with name '{new_vending_machine_name}' already exists."
+                )
+            self._check_version(old_vending_machine_name, expected_version)
 
-        self.db.update(
-            {"name": new_vending_machine_name},
-            Query().name == old_vending_machine_name,
-        )
-        return self.get_vending_machine_info(new_vending_machine_name)
+            def change_name(document: dict) -> None:
+                document["name"] = new_vending_machine_name
+
+            # Applied directly: the machine locks are already held, a coalesced batch could not take them.
+            [vending_machine] = self._apply_machine_updates(
+                [(old_vending_machine_name, change_name)]
+            )
+            return vending_machine
 
     def change_vending_machine_location(
         self: "VendingMachineService",
         vending_machine_name: str,
         new_vending_machine_location: str,
+        expected_version: int | None = None,
     ) -> dict:
         """
         Change the location of a vending machine in the services.
@@ -136,38 +1056,37 @@ class VendingMachineService:
         Parameters:
             vending_machine_name (str): name of the vending machine to change location.
             new_vending_machine_location (str): new location for the vending machine.
+            expected_version (int | None): Only apply the change if the vending machine is at this version,
+            None to apply it whatever the version.
 
         Raises:
             ValueError: If vending machine with the given name does not exist in the services.
             ValueError: If old location and new location are the same.
+            VersionConflictError: If the vending machine is not at the expected version.
 
         Returns:
             dict: A dictionary containing the information of the newly vending machine location, including the
             name, location, and items.
         """
-        existing_machine = self.db.search(Query().name == vending_machine_name)
-        if not existing_machine:
-            raise ValueError(
-                f"Vending machine with name '{vending_machine_name}' does not exists."
-            )
 
-        old_location = existing_machine[0]["location"]
-        if old_location == new_vending_machine_location:
-            raise ValueError(
-                f"Old vending machine location: '{old_location}' and new vending machine location: '{new_vending_machine_location}' are the same"
-            )
+        def change_location(document: dict) -> None:
+            old_location = document["location"]
+            if old_location == new_vending_machine_location:
+                raise ValueError(
+                    f"Old vending machine location: '{old_location}' and new vending machine location: '{new_vending_machine_location}' are the same"
+                )
+            document["location"] = new_vending_machine_location
 
-        self.db.update(
-            {"location": new_vending_machine_location},
-            Query().name == vending_machine_name,
+        return self._update_machine_document(
+            vending_machine_name, change_location, expected_version
         )
-        return self.get_vending_machine_info(vending_machine_name)
 
     def add_vending_machine_item(
         self: "VendingMachineService",
         vending_machine_name: str,
         item_name: str,
         add_amount: int,
+        expected_version: int | None = None,
     ) -> dict:
         """
         Add a specific item to a vending machine. If item already exist in the vending machine,
@@ -178,39 +1097,35 @@ class VendingMachineService:
             vending_machine_name (str): The name of the vending machine to which the item will be added.
             item_name (str): The name of the item to be added to the vending machine.
             add_amount (int): The amount of the item to be added to the vending machine.
+            expected_version (int | None): Only apply the change if the vending machine is at this version,
+            None to apply it whatever the version.
 
         Raises:
             ValueError: If vending machine with the given name does not exist in the services.
+            ValueError: If the amount is not an int value.
+            VersionConflictError: If the vending machine is not at the expected version.
 
         Returns:
             dict: A dictionary containing the information of given vending machine, including the
             name, location, and items.
         """
-        existing_machine = self.db.search(Query().name == vending_machine_name)
-        if not existing_machine:
-            raise ValueError(
-                f"Vending machine with name '{vending_machine_name}' does not exists."
-            )
+        if type(add_amount) != int:
+            raise ValueError("Amount of an item must be int value")
 
-        item_list = existing_machine[0]["items"]
-        if item_name not in item_list:
-            self.db.update(
-                {"items": {item_name: add_amount}},
-                Query().name == vending_machine_name,
-            )
-        else:
-            old_item_amount = item_list[item_name]
-            self.db.update(
-                {"items": {item_name: old_item_amount + add_amount}},
-                Query().name == vending_machine_name,
-            )
-        return self.get_vending_machine_info(vending_machine_name)
+        def add_item(document: dict) -> None:
+            item_list = document["items"]
+            item_list[item_name] = item_list.get(item_name, 0) + add_amount
+
+        return self._update_machine_document(
+            vending_machine_name, add_item, expected_version
+        )
 
     def edit_vending_machine_item_amount(
         self: "VendingMachineService",
         vending_machine_name: str,
         item_name: str,
         amount: int,
+        expected_version: int | None = None,
     ) -> dict:
         """
         Edit a specific item in the vending machine.
@@ -219,10 +1134,13 @@ class VendingMachineService:
             vending_machine_name (str): The name of the vending machine to which the item will be edited.
             item_name (str): The name of the item to be edited.
             amount (int): The quantity of item that will be set.
+            expected_version (int | None): Only apply the change if the vending machine is at this version,
+            None to apply it whatever the version.
 
         Raises:
             ValueError: If vending machine with the given name does not exist in the services.
             ValueError: If item with the given name does not exist in the vending machine.
+            VersionConflictError: If the vending machine is not at the expected version.
 
         Returns:
             dict: A dictionary containing the information of given vending machine, including the
@@ -231,24 +1149,21 @@ class VendingMachineService:
         if type(amount) != int:
             raise ValueError("Amount of an item must be int value")
 
-        existing_machine = self.db.search(Query().name == vending_machine_name)
-        if not existing_machine:
-            raise ValueError(
-                f"Vending machine with name '{vending_machine_name}' does not exists."
-            )
-
-        item_list = existing_machine[0]["items"]
-        if item_name not in item_list:
-            raise ValueError(f"Item with name '{item_name}' does not exists.")
+        def edit_item_amount(document: dict) -> None:
+            item_list = document["items"]
+            if item_name not in item_list:
+                raise ValueError(f"Item with name '{item_name}' does not exists.")
+            item_list[item_name] = amount
 
-        self.db.update(
-            {"items": {item_name: amount}},
-            Query().name == vending_machine_name,
+        return self._update_machine_document(
+            vending_machine_name, edit_item_amount, expected_version
         )
-        return self.get_vending_machine_info(vending_machine_name)
 
     def remove_vending_machine_item(
-        self: "VendingMachineService", vending_machine_name: str, item_name: str
+        self: "VendingMachineService",
+        vending_machine_name: str,
+        item_name: str,
+        expected_version: int | None = None,
     ) -> dict:
         """
         Remove a specific item from a vending machine.
@@ -256,48 +1171,157 @@ class VendingMachineService:
         Parameters:
             vending_machine_name (str): The name of the vending machine to which the item will be removed.
             item_name (str): The name of the item to be removed.
+            expected_version (int | None): Only apply the change if the vending machine is at this version,
+            None to apply it whatever the version.
 
         Raises:
             ValueError: If vending machine with the given name does not exist in the services.
             ValueError: If item with the given name does not exist in the vending machine.
+            VersionConflictError: If the vending machine is not at the expected version.
 
         Returns:
             dict: A dictionary containing the information of given vending machine, including the
             name, location, and items.
         """
-        existing_machine = self.db.search(Query().name == vending_machine_name)
-        if not existing_machine:
-            raise ValueError(
-                f"Vending machine with name '{vending_machine_name}' does not exists."
-            )
 
-        item_list = existing_machine[0]["items"]
-        if item_name not in item_list:
-            raise ValueError(f"Item with name '{item_name}' does not exists.")
+        def remove_item(document: dict) -> None:
+            item_list = document["items"]
+            if item_name not in item_list:
+                raise ValueError(f"Item with name '{item_name}' does not exists.")
+            del item_list[item_name]
+
+        return self._update_machine_document(
+            vending_machine_name, remove_item, expected_version
+        )
+
+    def bulk_update_vending_machine_items(
+        self: "VendingMachineService", operations: list[dict]
+    ) -> list[dict]:
+        """
+        Apply many item operations across many vending machines with a single storage write.
+        Each operation is a dictionary with the vending machine 'name', the 'item' name and either
+        a 'delta' to add to the item (creating it when missing) or an 'amount' to set on an existing item.
+        Invalid operations are reported in their result and skipped, the others are still applied.
+        A vending machine none of whose operations applied is left as it is, at the same version.
+
+        Parameters:
+            operations (list[dict]): The item operations, applied in the given order.
+
+        Returns:
+            list[dict]: One result per operation, in the same order, containing 'success' and either the
+            new 'amount' of the item and the 'version' of the vending machine written, or an error 'message'.
+        """
+        results: list[dict | None] = [None] * len(operations)
+        updates = []
+        update_indexes = []
+        for index, operation in enumerate(operations):
+            try:
+                self._validate_bulk_operation(operation)
+            except ValueError as ve:
+                results[index] = {"success": False, "message": str(ve)}
+                continue
+            updates.append((operation["name"], self._item_operation(operation)))
+            update_indexes.append(index)
 
-        del item_list[item_name]
-        self.db.update({"items": item_list}, Query().name == vending_machine_name)
-        return self.get_vending_machine_info(vending_machine_name)
+        update_results = self._apply_machine_updates(updates)
+        # Every operation applied to a machine is part of the same write, the last one carries its version.
+        versions = {
+            result["name"]: result.version
+            for result in update_results
+            if isinstance(result, MachineDocument)
+        }
+        for index, result in zip(update_indexes, update_results):
+            if isinstance(result, Exception):
+                results[index] = {"success": False, "message": str(result)}
+                continue
+            item_name = operations[index]["item"]
+            results[index] = {
+                "success": True,
+                "name": result["name"],
+                "item": item_name,
+                "amount": result["items"][item_name],
+                "version": versions[result["name"]],
+            }
+        return results
+
+    @staticmethod
+    def _item_operation(operation: dict) -> Callable[[dict], None]:
+        """Returns the transform applying a validated bulk item operation to a vending machine."""
+        item_name = operation["item"]
+
+        def apply_operation(vending_machine: dict) -> None:
+            item_list = vending_machine["items"]
+            if "delta" in operation:
+                item_list[item_name] = item_list.get(item_name, 0) + operation["delta"]
+            elif item_name not in item_list:
+                raise ValueError(f"Item with name '{item_name}' does not exists.")
+            else:
+                item_list[item_name] = operation["amount"]
+
+        return apply_operation
+
+    def _validate_bulk_operation(
+        self: "VendingMachineService", operation: dict
+    ) -> None:
+        """
+        Check that a bulk item operation is well-formed and targets an existing vending machine.
+
+        Parameters:
+            operation (dict): The item operation to validate.
+
+        Raises:
+            ValueError: If the operation is malformed or the vending machine does not exist.
+
+        Returns:
+            None
+        """
+        if not isinstance(operation, dict):
+            raise ValueError("Each operation must be a JSON object")
+        if "name" not in operation or "item" not in operation:
+            raise ValueError("Both 'name' and 'item' must be present in the operation")
+        if ("delta" in operation) == ("amount" in operation):
+            raise ValueError(
+                "Exactly one of 'delta' or 'amount' must be present in the operation"
+            )
+        if len(operation) > 3:
+            raise ValueError(
+                "Too many keys in the operation, require only 'name', 'item' and 'delta' or 'amount'"
+            )
+        if not isinstance(operation["name"], str) or not isinstance(
+            operation["item"], str
+        ):
+            raise ValueError("Both 'name' and 'item' of the operation must be strings")
+        value = operation.get("delta", operation.get("amount"))
+        if type(value) != int:
+            raise ValueError("Amount of an item must be int value")
+        if not self._machine_exists(operation["name"]):
+            raise ValueError(
+                f"Vending machine with name '{operation['name']}' does not exists."
+            )
 
     def delete_vending_machine_by_name(
-        self: "VendingMachineService", vending_machine_name: str
+        self: "VendingMachineService",
+        vending_machine_name: str,
+        expected_version: int | None = None,
     ) -> str:
         """
         Delete an existing vending machine with the given name.
 
         Parameters:
             vending_machine_name (str): The name of the vending machine.
+            expected_version (int | None): Only apply the change if the vending machine is at this version,
+            None to apply it whatever the version.
 
         Raises:
             ValueError: If vending machine with the given name does not exist in the services.
+            VersionConflictError: If the vending machine is not at the expected version.
 
         Returns:
             str: indicate whether it success
         """
-        existing_machine = self.db.search(Query().name == vending_machine_name)
-        if not existing_machine:
-            raise ValueError(
-                f"Vending machine with name '{vending_machine_name}' does not exists."
-            )
-        self.db.remove(Query().name == vending_machine_name)
+        with self._lock_machines([vending_machine_name]):
+            vending_machine = self._get_machine_document(vending_machine_name)
+            self._check_version(vending_machine_name, expected_version)
+            self.repository.delete(vending_machine_name)
+            self._index_machine_change(vending_machine, None)
         return "Successfully, delete vending machine"
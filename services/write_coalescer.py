@@ -0,0 +1,70 @@
+import threading
+from concurrent.futures import Future
+from typing import Callable
+
+Update = tuple[str, Callable[[dict], None]]
+
+
+class WriteCoalescer:
+    """
+    Merge vending machine updates submitted concurrently into shared storage writes.
+
+    The first caller to find no write in progress becomes the leader: it takes every pending update,
+    applies them in one batch and wakes the callers waiting on them. Updates submitted while that batch
+    is being written wait for it to finish and form the next batch, so the number of storage writes
+    follows the storage speed instead of the request rate and a lone caller is never delayed.
+    """
+
+    def __init__(
+        self: "WriteCoalescer",
+        apply_batch: Callable[[list[Update]], list[dict | Exception]],
+    ) -> None:
+        self._apply_batch = apply_batch
+        self._condition = threading.Condition()
+        self._pending: list[tuple[Update, Future]] = []
+        self._writing = False
+
+    def submit(
+        self: "WriteCoalescer",
+        vending_machine_name: str,
+        transform: Callable[[dict], None],
+    ) -> dict:
+        """
+        Apply a transform to a vending machine as part of the next batch and wait for it.
+
+        Parameters:
+            vending_machine_name (str): The name of the vending machine.
+            transform (Callable[[dict], None]): Function that validates and mutates the machine in place.
+
+        Raises:
+            Exception: Whatever the transform or the batch raised for this update.
+
+        Returns:
+            dict: A copy of the vending machine right after the transform was applied.
+        """
+        future = Future()
+        with self._condition:
+            self._pending.append(((vending_machine_name, transform), future))
+            while not future.done() and self._writing:
+                self._condition.wait()
+            if future.done():
+                return future.result()
+            self._writing = True
+            batch, self._pending = self._pending, []
+
+        try:
+            try:
+                results = self._apply_batch([update for update, _ in batch])
+            except BaseException as e:
+                # Every caller of the batch gets the error, nobody is left waiting.
+                results = [e] * len(batch)
+            for (_, batch_future), result in zip(batch, results):
+                if isinstance(result, BaseException):
+                    batch_future.set_exception(result)
+                else:
+                    batch_future.set_result(result)
+        finally:
+            with self._condition:
+                self._writing = False
+                self._condition.notify_all()
+        return future.result()
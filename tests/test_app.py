@@ -0,0 +1,85 @@
+import pathlib
+
+from app import create_app
+from database.db_manager import get_machine_repository
+from routes.app_state import get_app_state
+from services.vending_machine_service import VendingMachineService
+
+
+def test_database_is_opened_on_first_request(tmp_path: pathlib.Path) -> None:
+    app = create_app({"TESTING": True, "TEST_DB_PATH": str(tmp_path) + "/"})
+    state = get_app_state(app)
+    warmed_up = []
+    state.warm_up(warmed_up.append)
+    assert not state.loaded
+    assert not (tmp_path / "test_db.json").exists()
+
+    with app.test_client() as client:
+        response = client.post(
+            "/api/machine/create-machine", json={"name": "ven1", "location": "A"}
+        )
+        assert response.status_code == 200
+        assert state.loaded
+        assert warmed_up == [state.machine_service]
+        metrics = client.get("/api/metrics").get_data(as_text=True)
+    for phase in ["create_app", "open_database", "warm_up"]:
+        assert f'vending_startup_seconds{{phase="{phase}"}}' in metrics
+
+    state.close()
+    assert not state.loaded
+    repository = get_machine_repository(str(tmp_path) + "/", test=True)
+    assert repository.get("ven1") == {"name": "ven1", "location": "A", "items": {}}
+    repository.close()
+
+
+def test_apps_serve_their_own_store(tmp_path: pathlib.Path) -> None:
+    repository = get_machine_repository(str(tmp_path) + "/", backend="sqlite")
+    repository.insert({"name": "ven1", "location": "A", "items": {"orio": 2}})
+    warmed_up = []
+    app = create_app(
+        {
+            "MACHINE_REPOSITORY": repository,
+            "PRELOAD_DATABASE": True,
+            "WARM_UP_HOOKS": [warmed_up.append],
+        }
+    )
+    assert get_app_state(app).loaded
+    assert len(warmed_up) == 1
+    machine_service = VendingMachineService(repository)
+    other_app = create_app({"MACHINE_SERVICE": machine_service})
+
+    for served_app in [app, other_app]:
+        with served_app.test_client() as client:
+            response = client.post("/api/machine/get-machine", json={"name": "ven1"})
+            assert response.get_json()["message"]["items"] == {"orio": 2}
+    assert get_app_state(other_app).machine_service is machine_service
+    # The app did not open the repository, so it leaves it open.
+    get_app_state(app).close()
+    assert repository.exists("ven1")
+    repository.close()
+
+
+def test_idempotency_keys_are_shared_between_apps(tmp_path: pathlib.Path) -> None:
+    config = {
+        "TESTING": True,
+        "TEST_DB_PATH": str(tmp_path) + "/",
+        "IDEMPOTENCY_STORE": "sqlite",
+    }
+    # Two apps on the same files, like the workers of a multi-process server.
+    apps = [create_app(config), create_app(config)]
+    responses = []
+    for app in apps:
+        with app.test_client() as client:
+            responses.append(
+                client.post(
+                    "/api/machine/create-machine",
+                    json={"name": "ven1", "location": "A"},
+                    headers={"Idempotency-Key": "create-ven1"},
+                )
+            )
+    assert [response.status_code for response in responses] == [200, 200]
+    assert responses[1].headers["Idempotent-Replayed"] == "true"
+    assert responses[1].get_data() == responses[0].get_data()
+    assert (tmp_path / "test_idempotency.sqlite3").exists()
+    for app in apps:
+        get_app_state(app).close()
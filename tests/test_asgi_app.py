@@ -0,0 +1,156 @@
+import asyncio
+import json
+import threading
+from typing import Callable
+
+from asgi_app import WSGIToASGI, create_asgi_app
+from routes.app_state import get_app_state
+
+app = create_asgi_app({"TESTING": True})
+flask_app = app.wsgi_app
+
+
+async def asgi_request(
+    method: str, path: str, data: dict | None = None, application: WSGIToASGI = app
+) -> tuple:
+    body = json.dumps(data).encode() if data is not None else b""
+    path, _, query = path.partition("?")
+    scope = {
+        "type": "http",
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "query_string": query.encode(),
+        "headers": [(b"content-type", b"application/json")],
+    }
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+    sent = []
+
+    async def receive() -> dict:
+        return messages.pop(0) if messages else {"type": "http.disconnect"}
+
+    async def send(message: dict) -> None:
+        sent.append(message)
+
+    await application(scope, receive, send)
+    assert sent[-1]["more_body"] is False
+    status = sent[0]["status"]
+    return status, b"".join(message.get("body", b"") for message in sent[1:])
+
+
+def test_asgi_routes_match_flask_routes() -> None:
+    async def run() -> None:
+        status, body = await asgi_request(
+            "POST", "/api/machine/create-machine", {"name": "asgi1", "location": "A"}
+        )
+        assert status == 200
+
+        # Concurrent item updates of the same machine are all applied.
+        responses = await asyncio.gather(
+            *(
+                asgi_request(
+                    "POST",
+                    "/api/item/add-item",
+                    {"name": "asgi1", "items": {"orio": 1}},
+                )
+                for _ in range(50)
+            )
+        )
+        assert {status for status, _ in responses} == {200}
+
+        status, body = await asgi_request(
+            "POST", "/api/machine/get-machine", {"name": "asgi1"}
+        )
+        assert status == 200
+        with flask_app.test_client() as client:
+            flask_response = client.post(
+                "/api/machine/get-machine", json={"name": "asgi1"}
+            )
+        assert (
+            json.loads(body)
+            == flask_response.get_json()
+            == {
+                "success": True,
+                "message": {"name": "asgi1", "location": "A", "items": {"orio": 50}},
+            }
+        )
+
+        status, body = await asgi_request(
+            "POST", "/api/item/add-item", {"name": "non-exist", "items": {"orio": 1}}
+        )
+        assert status == 400
+        assert json.loads(body) == {
+            "success": False,
+            "message": "Vending machine with name 'non-exist' does not exists.",
+        }
+
+        status, body = await asgi_request(
+            "GET", "/api/machine/get-all-machine?format=ndjson&location=A&fields=name"
+        )
+        assert status == 200
+        assert {"name": "asgi1"} in [json.loads(line) for line in body.splitlines()]
+
+        status, _ = await asgi_request(
+            "POST", "/api/machine/delete-machine", {"name": "asgi1"}
+        )
+        assert status == 200
+
+    asyncio.run(run())
+
+
+def test_streams_run_on_their_own_bounded_pool() -> None:
+    release = threading.Event()
+
+    def wsgi_app(environ: dict, start_response: Callable) -> list[bytes]:
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        if environ["PATH_INFO"] == "/stream":
+            release.wait(5)
+        return [threading.current_thread().name.encode()]
+
+    application = WSGIToASGI(
+        wsgi_app, max_workers=1, stream_paths=["/stream"], max_streams=1
+    )
+
+    async def run() -> None:
+        stream = asyncio.ensure_future(
+            asgi_request("GET", "/stream", None, application)
+        )
+        await asyncio.sleep(0.05)
+        # The stream holds its own thread, other requests still run.
+        status, body = await asgi_request("GET", "/other", None, application)
+        assert status == 200
+        assert body.startswith(b"wsgi_")
+        status, body = await asgi_request("GET", "/stream", None, application)
+        assert status == 503
+        assert json.loads(body)["success"] is False
+        release.set()
+        status, body = await stream
+        assert status == 200
+        assert body.startswith(b"wsgi-stream")
+
+    asyncio.run(run())
+
+
+def test_bodies_over_the_limit_are_rejected() -> None:
+    application = create_asgi_app({"TESTING": True})
+    application.max_body_size = 10
+
+    async def run() -> None:
+        status, body = await asgi_request(
+            "POST", "/api/machine/get-machine", {"name": "asgi-long-name"}, application
+        )
+        assert status == 413
+        assert json.loads(body) == {
+            "success": False,
+            "message": "Request body too large",
+        }
+
+    asyncio.run(run())
+
+
+def test_creating_the_asgi_app_opens_no_database() -> None:
+    application = create_asgi_app({"TESTING": True, "COALESCE_WRITES": False})
+    state = get_app_state(application.wsgi_app)
+    assert not state.loaded
+    assert application.wsgi_app.config["COALESCE_WRITES"] is False
@@ -0,0 +1,76 @@
+import json
+import pathlib
+
+from benchmarks.run_benchmarks import build_fleet, compare_results, main
+
+
+def test_benchmark_run_writes_results(tmp_path: pathlib.Path) -> None:
+    output = tmp_path / "results.json"
+    assert (
+        main(
+            [
+                "--sizes",
+                "30",
+                "--backend",
+                "log",
+                "--repeat",
+                "3",
+                "--output",
+                str(output),
+            ]
+        )
+        == 0
+    )
+
+    with open(output, encoding="utf-8") as handle:
+        results = json.load(handle)
+    assert results["backend"] == "log"
+    [result] = results["results"]
+    assert result["size"] == 30
+    operation_names = [operation["name"] for operation in result["operations"]]
+    assert "get_vending_machine_info" in operation_names
+    assert "POST /api/item/bulk-update" in operation_names
+    for operation in result["operations"]:
+        assert operation["runs"] == 3
+        assert operation["p50_ms"] <= operation["p99_ms"]
+
+    # Comparing a run with itself never reports a regression.
+    assert (
+        main(
+            [
+                "--sizes",
+                "30",
+                "--backend",
+                "log",
+                "--repeat",
+                "3",
+                "--no-api",
+                "--output",
+                str(tmp_path / "current.json"),
+                "--compare",
+                str(output),
+                "--threshold",
+                "1000",
+            ]
+        )
+        == 0
+    )
+
+
+def test_compare_results_flags_regressions() -> None:
+    def results(p50_ms: float) -> dict:
+        return {
+            "results": [{"size": 10, "operations": [{"name": "get", "p50_ms": p50_ms}]}]
+        }
+
+    [comparison] = compare_results(results(1.0), results(1.5), threshold=0.2)
+    assert comparison["ratio"] == 1.5
+    assert comparison["regression"] is True
+    assert compare_results(results(1.0), results(1.1))[0]["regression"] is False
+
+
+def test_build_fleet_is_deterministic() -> None:
+    fleet = build_fleet(50)
+    assert fleet == build_fleet(50)
+    assert len({machine["name"] for machine in fleet}) == 50
+    assert all(5 <= len(machine["items"]) <= 20 for machine in fleet)
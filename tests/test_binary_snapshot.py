@@ -0,0 +1,74 @@
+import pathlib
+from array import array
+
+import pytest
+
+from database.binary_snapshot import BinarySnapshot, is_snapshot, write_snapshot
+from database.db_manager import get_machine_repository
+from database.snapshot_tool import export_snapshot, import_snapshot
+
+
+def test_snapshot_round_trip(tmp_path: pathlib.Path) -> None:
+    vending_machines = [
+        (1, {"name": "ven1", "location": "A", "items": {"orio": 3, "lays": -1}}),
+        (4, {"name": "vén2", "location": "B", "items": {}}),
+        (5, {"name": "ven3", "location": "A", "items": {"orio": 2**70}}),
+        (7, {"name": "ven4", "location": "ü", "items": {"drink": "1", "orio": 0}}),
+    ]
+    path = str(tmp_path / "db.snapshot")
+    assert write_snapshot(path, vending_machines, sequence=12) > 0
+    assert is_snapshot(path)
+
+    snapshot = BinarySnapshot(path)
+    assert (snapshot.sequence, snapshot.next_id, len(snapshot)) == (12, 8, 4)
+    assert snapshot.read(2) == vending_machines[2]
+    assert snapshot.read_row(0) == (
+        1,
+        "ven1",
+        "A",
+        ["orio", "lays"],
+        array("q", [3, -1]),
+    )
+    assert snapshot.read_row(3)[3:] == (["drink", "orio"], ["1", 0])
+    assert list(snapshot.keys()) == [(1, "ven1"), (4, "vén2"), (5, "ven3"), (7, "ven4")]
+    assert list(snapshot) == vending_machines
+    snapshot.close()
+
+
+def test_other_files_are_rejected(tmp_path: pathlib.Path) -> None:
+    path = tmp_path / "db.json"
+    path.write_text('{"_default": {}}' + " " * 64, encoding="utf-8")
+    assert not is_snapshot(str(path))
+    with pytest.raises(ValueError):
+        BinarySnapshot(str(path))
+
+
+def test_export_and_import_keep_machines_and_keys(
+    tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setenv("DB_STORAGE", "json")
+    for directory in ["source", "target"]:
+        (tmp_path / directory).mkdir()
+    source_path = str(tmp_path / "source") + "/"
+    repository = get_machine_repository(source_path, backend="tinydb")
+    for index in range(5):
+        repository.insert(
+            {"name": f"ven{index}", "location": "A", "items": {"orio": index}}
+        )
+    repository.delete("ven1")
+    expected = list(repository.iterate())
+    repository.close()
+
+    snapshot_path = str(tmp_path / "machines.snapshot")
+    assert export_snapshot(source_path, snapshot_path, backend="tinydb") == 4
+    target_path = str(tmp_path / "target") + "/"
+    for backend in ["tinydb", "sqlite"]:
+        assert import_snapshot(target_path, snapshot_path, backend=backend) == 4
+        repository = get_machine_repository(target_path, backend=backend)
+        if backend == "tinydb":
+            assert list(repository.iterate()) == expected
+        else:
+            assert repository.all() == [machine for _, machine in expected]
+        repository.close()
+        with pytest.raises(ValueError):
+            import_snapshot(target_path, snapshot_path, backend=backend)
@@ -0,0 +1,100 @@
+import pathlib
+import threading
+from typing import Iterator
+
+import pytest
+
+from database.db_manager import get_machine_repository
+from services.vending_machine_service import VendingMachineService
+
+THREAD_COUNT = 8
+ADDS_PER_THREAD = 25
+MACHINE_NAMES = ["ven1", "ven2", "ven3", "ven4"]
+
+
+@pytest.fixture(
+    params=[
+        ("tinydb", "json"),
+        ("tinydb", "cached"),
+        ("tinydb", "group"),
+        ("sqlite", None),
+        ("log", None),
+        ("sharded", "json"),
+    ],
+    ids=["tinydb-json", "tinydb-cached", "tinydb-group", "sqlite", "log", "sharded"],
+)
+def machine_service(
+    request: pytest.FixtureRequest,
+    tmp_path: pathlib.Path,
+    monkeypatch: pytest.MonkeyPatch,
+) -> Iterator[VendingMachineService]:
+    backend, storage = request.param
+    if storage is not None:
+        monkeypatch.setenv("DB_STORAGE", storage)
+        monkeypatch.setenv("DB_FLUSH_INTERVAL", "0.001")
+    repository = get_machine_repository(str(tmp_path) + "/", backend=backend)
+    yield VendingMachineService(repository)
+    repository.close()
+
+
+def run_in_threads(target: callable) -> None:
+    barrier = threading.Barrier(THREAD_COUNT)
+    errors = []
+
+    def run(thread_index: int) -> None:
+        barrier.wait()
+        try:
+            target(thread_index)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [
+        threading.Thread(target=run, args=(index,)) for index in range(THREAD_COUNT)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+
+
+def test_concurrent_item_additions_are_not_lost(
+    machine_service: VendingMachineService,
+) -> None:
+    for name in MACHINE_NAMES:
+        machine_service.create_new_vending_machine(name, "A")
+
+    def add_items(thread_index: int) -> None:
+        for index in range(ADDS_PER_THREAD):
+            name = MACHINE_NAMES[(thread_index + index) % len(MACHINE_NAMES)]
+            machine_service.add_vending_machine_item(name, "orio", 1)
+            machine_service.add_vending_machine_item(name, f"item{thread_index}", 2)
+
+    run_in_threads(add_items)
+
+    all_machine = machine_service.get_all_vending_machine_info()
+    assert sum(machine["items"]["orio"] for machine in all_machine) == (
+        THREAD_COUNT * ADDS_PER_THREAD
+    )
+    for thread_index in range(THREAD_COUNT):
+        assert sum(
+            machine["items"].get(f"item{thread_index}", 0) for machine in all_machine
+        ) == (2 * ADDS_PER_THREAD)
+
+
+def test_concurrent_creation_of_same_machine(
+    machine_service: VendingMachineService,
+) -> None:
+    created = []
+
+    def create_machine(thread_index: int) -> None:
+        try:
+            machine_service.create_new_vending_machine("ven1", str(thread_index))
+            created.append(thread_index)
+        except ValueError:
+            pass
+
+    run_in_threads(create_machine)
+
+    assert len(created) == 1
+    assert len(machine_service.get_all_vending_machine_info()) == 1
@@ -0,0 +1,168 @@
+import json
+import os
+import pathlib
+import threading
+import time
+
+import pytest
+from tinydb import TinyDB
+
+from database.db_manager import (
+    AtomicJSONStorage,
+    GroupCommitMiddleware,
+    WriteBackCachingMiddleware,
+    get_db,
+    get_machine_repository,
+)
+
+
+def read_json_file(path: str) -> dict:
+    with open(path, encoding="utf-8") as handle:
+        return json.load(handle)
+
+
+def get_db_with_storage(path: str, middleware: WriteBackCachingMiddleware) -> TinyDB:
+    return TinyDB(path, storage=middleware)
+
+
+def test_get_db_storage_selection(
+    tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setenv("DB_STORAGE", "cached")
+    monkeypatch.setenv("DB_FLUSH_INTERVAL", "0")
+    db = get_db(str(tmp_path) + "/")
+    assert isinstance(db.storage, WriteBackCachingMiddleware)
+    db.close()
+
+    with pytest.raises(ValueError):
+        get_db(str(tmp_path) + "/", storage="unknown")
+
+
+def test_write_back_cache_flushes_on_threshold_and_close(
+    tmp_path: pathlib.Path,
+) -> None:
+    path = str(tmp_path / "db.json")
+    middleware = WriteBackCachingMiddleware(
+        AtomicJSONStorage, flush_interval=0, write_cache_size=3
+    )
+    db = get_db_with_storage(path, middleware)
+
+    db.insert({"name": "ven1"})
+    db.insert({"name": "ven2"})
+    assert os.path.getsize(path) == 0
+    assert middleware.dirty_writes == 2
+
+    db.insert({"name": "ven3"})
+    assert middleware.dirty_writes == 0
+    assert len(read_json_file(path)["_default"]) == 3
+
+    db.insert({"name": "ven4"})
+    db.close()
+    assert len(read_json_file(path)["_default"]) == 4
+
+
+def test_mutating_returned_machines_does_not_reach_the_cache(
+    tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setenv("DB_STORAGE", "cached")
+    monkeypatch.setenv("DB_FLUSH_INTERVAL", "0")
+    repository = get_machine_repository(str(tmp_path) + "/", backend="tinydb")
+    vending_machine = {"name": "ven1", "location": "A", "items": {"orio": 1}}
+    repository.insert(vending_machine)
+    vending_machine["items"]["orio"] = 2
+    repository.get("ven1")["items"]["orio"] = 3
+    repository.all()[0]["items"]["orio"] = 4
+    next(repository.iterate())[1]["items"]["orio"] = 5
+    repository.update("ven1", lambda machine: machine["items"].update(lays=1))["items"][
+        "orio"
+    ] = 6
+    assert repository.get("ven1")["items"] == {"orio": 1, "lays": 1}
+    repository.close()
+
+    assert read_json_file(str(tmp_path / "db.json"))["_default"]["1"]["items"] == {
+        "orio": 1,
+        "lays": 1,
+    }
+
+
+def test_write_back_cache_flushes_on_interval(tmp_path: pathlib.Path) -> None:
+    path = str(tmp_path / "db.json")
+    middleware = WriteBackCachingMiddleware(
+        AtomicJSONStorage, flush_interval=0.01, write_cache_size=1000
+    )
+    db = get_db_with_storage(path, middleware)
+    db.insert({"name": "ven1"})
+
+    time.sleep(0.2)
+    assert middleware.dirty_writes == 0
+    assert len(read_json_file(path)["_default"]) == 1
+    db.close()
+
+
+def test_failed_flush_keeps_previous_file_and_pending_writes(
+    tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    path = str(tmp_path / "db.json")
+    middleware = WriteBackCachingMiddleware(
+        AtomicJSONStorage, flush_interval=0, write_cache_size=1000
+    )
+    db = get_db_with_storage(path, middleware)
+    db.insert({"name": "ven1"})
+    middleware.flush()
+
+    def crash(*args: tuple) -> None:
+        raise OSError("simulated crash")
+
+    db.insert({"name": "ven2"})
+    monkeypatch.setattr(os, "replace", crash)
+    with pytest.raises(OSError):
+        middleware.flush()
+
+    # The database file still holds the last complete flush.
+    assert list(read_json_file(path)["_default"].values()) == [{"name": "ven1"}]
+    assert middleware.dirty_writes == 1
+
+    monkeypatch.undo()
+    db.close()
+    assert len(read_json_file(path)["_default"]) == 2
+
+
+def test_group_commit_acknowledges_durable_writes_in_batches(
+    tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setenv("DB_STORAGE", "group")
+    monkeypatch.setenv("DB_GROUP_COMMIT_INTERVAL", "0.01")
+    repository = get_machine_repository(str(tmp_path) + "/", backend="tinydb")
+    middleware = repository.db.storage
+    assert isinstance(middleware, GroupCommitMiddleware)
+    path = str(tmp_path / "db.json")
+
+    # A lone write is on disk as soon as it returns.
+    repository.insert({"name": "ven0", "location": "A", "items": {}})
+    assert len(read_json_file(path)["_default"]) == 1
+
+    flushes = []
+    flush = middleware.flush
+
+    def counting_flush() -> None:
+        flushes.append(middleware.write_generation)
+        flush()
+
+    monkeypatch.setattr(middleware, "flush", counting_flush)
+    barrier = threading.Barrier(8)
+
+    def insert(index: int) -> None:
+        barrier.wait()
+        repository.insert({"name": f"ven{index + 1}", "location": "A", "items": {}})
+        assert f"ven{index + 1}" in {
+            machine["name"] for machine in read_json_file(path)["_default"].values()
+        }
+
+    threads = [threading.Thread(target=insert, args=(index,)) for index in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(read_json_file(path)["_default"]) == 9
+    assert 0 < len(flushes) < 8
+    repository.close()
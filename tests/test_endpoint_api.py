@@ -1,9 +1,13 @@
 import json
 
+import pytest
 from flask import Response
 from flask.testing import FlaskClient
 
-from app import app
+from app import create_app
+from routes.app_state import get_app_state
+
+app = create_app({"TESTING": True})
 
 
 def client_post(client: FlaskClient, route: str, data: dict) -> Response:
@@ -113,6 +117,216 @@ def test_get_all_vending_machine_info_api() -> None:
         }
 
 
+def test_read_responses_are_cached_with_etags() -> None:
+    with app.test_client() as client:
+        client_post(
+            client, "/api/machine/create-machine", {"name": "etag1", "location": "A"}
+        )
+        data = {"name": "etag1"}
+        response = client_post(client, "/api/machine/get-machine", data)
+        etag = response.headers["ETag"]
+        assert json.loads(response.data)["message"]["items"] == {}
+
+        # An unchanged machine is not sent again.
+        response = client.post(
+            "/api/machine/get-machine", json=data, headers={"If-None-Match": etag}
+        )
+        assert response.status_code == 304
+        assert response.headers["ETag"] == etag
+        response = client_post(client, "/api/machine/get-machine", data)
+        assert response.headers["ETag"] == etag
+        data_with_fields = {"name": "etag1", "fields": ["name"]}
+        response = client_post(client, "/api/machine/get-machine", data_with_fields)
+        assert json.loads(response.data)["message"] == {"name": "etag1"}
+        assert response.headers["ETag"] != etag
+
+        listing = client_get(client, "/api/machine/get-all-machine?location=A")
+        response = client.get(
+            "/api/machine/get-all-machine?location=A",
+            headers={"If-None-Match": listing.headers["ETag"]},
+        )
+        assert response.status_code == 304
+
+        # A write invalidates the machine and every listing.
+        client_post(
+            client,
+            "/api/item/add-item",
+            {"name": "etag1", "items": {"orio": 2}},
+        )
+        response = client.post(
+            "/api/machine/get-machine", json=data, headers={"If-None-Match": etag}
+        )
+        assert response.status_code == 200
+        assert response.headers["ETag"] != etag
+        assert json.loads(response.data)["message"]["items"] == {"orio": 2}
+        response = client.get(
+            "/api/machine/get-all-machine?location=A",
+            headers={"If-None-Match": listing.headers["ETag"]},
+        )
+        assert response.status_code == 200
+        assert {"name": "etag1", "location": "A", "items": {"orio": 2}} in json.loads(
+            response.data
+        )["message"]
+
+        client_post(client, "/api/machine/delete-machine", data)
+        response = client.post(
+            "/api/machine/get-machine", json=data, headers={"If-None-Match": etag}
+        )
+        assert response.status_code == 400
+
+
+def test_a_write_during_a_read_is_not_tagged_with_the_older_etag(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    machine_service = get_app_state(app).machine_service
+    machine_service.create_new_vending_machine("etag2", "A")
+    old_version = machine_service.get_machine_version("etag2")
+    get_vending_machine_info = machine_service.get_vending_machine_info
+
+    def write_then_read(*args: tuple) -> dict:
+        # The write lands after the route read the version of the machine.
+        monkeypatch.undo()
+        machine_service.add_vending_machine_item("etag2", "orio", 1)
+        return get_vending_machine_info(*args)
+
+    monkeypatch.setattr(machine_service, "get_vending_machine_info", write_then_read)
+    data = {"name": "etag2", "fields": ["items"]}
+    with app.test_client() as client:
+        response = client_post(client, "/api/machine/get-machine", data)
+        new_version = machine_service.get_machine_version("etag2")
+        assert new_version != old_version
+        assert json.loads(response.data)["message"] == {"items": {"orio": 1}}
+        assert response.get_etag()[0] == f"{machine_service.epoch}-{new_version}-items"
+
+        response = client.post(
+            "/api/machine/get-machine",
+            json=data,
+            headers={"If-None-Match": f'"{machine_service.epoch}-{old_version}-items"'},
+        )
+        assert response.status_code == 200
+        assert json.loads(response.data)["message"] == {"items": {"orio": 1}}
+    machine_service.delete_vending_machine_by_name("etag2")
+
+
+def test_get_all_vending_machine_info_paginated_api() -> None:
+    route = "/api/machine/get-all-machine"
+    with app.test_client() as client:
+        for name in ["page1", "page2"]:
+            client_post(
+                client, "/api/machine/create-machine", {"name": name, "location": "P"}
+            )
+
+        response = client_get(client, route + "?limit=2")
+        assert response.status_code == 200
+        first_page = json.loads(response.data)
+        assert [machine["name"] for machine in first_page["message"]] == [
+            "ven1",
+            "page1",
+        ]
+        assert first_page["next_cursor"] is not None
+
+        response = client_get(client, f"{route}?cursor={first_page['next_cursor']}")
+        assert json.loads(response.data) == {
+            "success": True,
+            "message": [{"name": "page2", "location": "P", "items": {}}],
+            "next_cursor": None,
+        }
+
+        response = client_get(client, route + "?offset=1&limit=1")
+        assert [
+            machine["name"] for machine in json.loads(response.data)["message"]
+        ] == ["page1"]
+
+        # Test streaming every vending machine as NDJSON.
+        response = client_get(client, route + "?format=ndjson")
+        assert response.status_code == 200
+        assert response.mimetype == "application/x-ndjson"
+        lines = response.data.decode().splitlines()
+        assert [json.loads(line)["name"] for line in lines] == [
+            "ven1",
+            "page1",
+            "page2",
+        ]
+
+        # Test pagination with invalid arguments.
+        response = client_get(client, route + "?limit=abc")
+        assert response.status_code == 400
+        assert json.loads(response.data) == {
+            "success": False,
+            "message": "'limit' must be an int value",
+        }
+
+        response = client_get(client, route + "?limit=0")
+        assert response.status_code == 400
+        assert json.loads(response.data) == {
+            "success": False,
+            "message": "'limit' must be a positive int value",
+        }
+
+        for name in ["page1", "page2"]:
+            client_post(client, "/api/machine/delete-machine", {"name": name})
+
+
+def test_get_vending_machine_info_filtered_api() -> None:
+    route = "/api/machine/get-all-machine"
+    with app.test_client() as client:
+        client_post(
+            client, "/api/machine/create-machine", {"name": "filter1", "location": "B"}
+        )
+        client_post(
+            client, "/api/machine/create-machine", {"name": "filter2", "location": "B"}
+        )
+        client_post(
+            client, "/api/item/add-item", {"name": "filter1", "items": {"orio": 3}}
+        )
+        client_post(
+            client, "/api/item/add-item", {"name": "filter2", "items": {"orio": 10}}
+        )
+
+        response = client_get(client, route + "?location=B&below=5&fields=name")
+        assert response.status_code == 200
+        assert json.loads(response.data) == {
+            "success": True,
+            "message": [{"name": "filter1"}],
+        }
+
+        response = client_get(client, route + "?item=orio&fields=name,location")
+        assert json.loads(response.data)["message"] == [
+            {"name": "filter1", "location": "B"},
+            {"name": "filter2", "location": "B"},
+        ]
+
+        response = client_get(client, route + "?location=B&limit=1&fields=name")
+        assert json.loads(response.data)["message"] == [{"name": "filter1"}]
+
+        # Test get vending machine with selected fields.
+        data = {"name": "filter1", "fields": ["location"]}
+        response = client_post(client, "/api/machine/get-machine", data)
+        assert response.status_code == 200
+        assert json.loads(response.data) == {
+            "success": True,
+            "message": {"location": "B"},
+        }
+
+        # Test filters and fields with invalid values.
+        response = client_get(client, route + "?fields=name,unknown")
+        assert response.status_code == 400
+        assert json.loads(response.data) == {
+            "success": False,
+            "message": "Unknown field 'unknown', fields must be among 'name', 'location' and 'items'",
+        }
+
+        response = client_get(client, route + "?below=abc")
+        assert response.status_code == 400
+        assert json.loads(response.data) == {
+            "success": False,
+            "message": "'below' must be an int value",
+        }
+
+        for name in ["filter1", "filter2"]:
+            client_post(client, "/api/machine/delete-machine", {"name": name})
+
+
 def test_change_vending_machine_name_api() -> None:
     route = "/api/machine/change-name"
     with app.test_client() as client:
@@ -227,6 +441,41 @@ def test_change_vending_machine_location_api() -> None:
         }
 
 
+def test_get_vending_machines_by_location_api() -> None:
+    route = "/api/location/get-machines"
+    with app.test_client() as client:
+        data = {"location": "B"}
+        response = client_post(client, route, data)
+        assert response.status_code == 200
+        assert json.loads(response.data) == {
+            "success": True,
+            "message": [{"name": "ven2", "location": "B", "items": {}}],
+        }
+
+        # The previous location no longer lists the relocated machine.
+        data = {"location": "A", "fields": ["name"]}
+        response = client_post(client, route, data)
+        assert json.loads(response.data) == {"success": True, "message": []}
+
+        # Test get vending machines by location with missing argument.
+        data = {"name": "ven2"}
+        response = client_post(client, route, data)
+        assert response.status_code == 400
+        assert json.loads(response.data) == {
+            "success": False,
+            "message": "Missing 'location' in the request data",
+        }
+
+        # Test get vending machines by location with excessive argument.
+        data = {"location": "B", "name": "ven2"}
+        response = client_post(client, route, data)
+        assert response.status_code == 400
+        assert json.loads(response.data) == {
+            "success": False,
+            "message": "Too many keys in the request data, require only 'location'",
+        }
+
+
 def test_add_vending_machine_item_api() -> None:
     route = "/api/item/add-item"
     with app.test_client() as client:
@@ -350,6 +599,160 @@ def test_edit_vending_machine_item_api():
         }
 
 
+def test_get_low_stock_items_api() -> None:
+    route = "/api/item/low-stock"
+    with app.test_client() as client:
+        client_post(
+            client, "/api/item/add-item", {"name": "ven2", "items": {"drink": 3}}
+        )
+
+        response = client_get(client, route + "?below=10")
+        assert response.status_code == 200
+        assert json.loads(response.data) == {
+            "success": True,
+            "message": [{"name": "ven2", "item": "drink", "amount": 3}],
+        }
+
+        response = client_get(client, route + "?item=orio&count=1")
+        assert json.loads(response.data) == {
+            "success": True,
+            "message": [{"name": "ven2", "item": "orio", "amount": 5000}],
+        }
+
+        # Test low stock query without threshold or count.
+        response = client_get(client, route + "?item=orio")
+        assert response.status_code == 400
+        assert json.loads(response.data) == {
+            "success": False,
+            "message": "Either 'below' or 'count' must be given",
+        }
+
+        client_post(client, "/api/item/remove-item", {"name": "ven2", "items": "drink"})
+
+
+def test_get_inventory_aggregates_api() -> None:
+    route = "/api/item/aggregates"
+    with app.test_client() as client:
+        response = client_get(client, route + "?location=B&item=orio")
+        assert response.status_code == 200
+        assert json.loads(response.data) == {
+            "success": True,
+            "message": {"orio": {"amount": 5000, "machines": 1}},
+        }
+
+        response = client_get(client, route + "?location=non-exist")
+        assert json.loads(response.data) == {"success": True, "message": {}}
+
+        response = client_get(client, route + "/check")
+        assert response.status_code == 200
+        assert json.loads(response.data) == {
+            "success": True,
+            "message": {"consistent": True, "mismatches": []},
+        }
+
+
+def test_conditional_and_idempotent_writes_api() -> None:
+    with app.test_client() as client:
+        response = client_post(
+            client, "/api/machine/create-machine", {"name": "idem1", "location": "A"}
+        )
+        etag = response.headers["ETag"]
+
+        # A retried request with the same key is applied once.
+        data = {"name": "idem1", "items": {"orio": 5}}
+        headers = {"Idempotency-Key": "add-orio-1", "If-Match": etag}
+        first = client.post("/api/item/add-item", json=data, headers=headers)
+        retry = client.post("/api/item/add-item", json=data, headers=headers)
+        assert first.status_code == retry.status_code == 200
+        assert retry.headers["Idempotent-Replayed"] == "true"
+        assert retry.data == first.data
+        assert retry.headers["ETag"] == first.headers["ETag"] != etag
+        response = client_post(client, "/api/machine/get-machine", {"name": "idem1"})
+        assert json.loads(response.data)["message"]["items"] == {"orio": 5}
+
+        response = client.post(
+            "/api/item/add-item",
+            json={"name": "idem1", "items": {"orio": 6}},
+            headers={"Idempotency-Key": "add-orio-1"},
+        )
+        assert response.status_code == 422
+
+        # A write conditioned on a stale or foreign ETag is rejected.
+        for stale_etag in [etag, '"previous-process-1"']:
+            response = client.post(
+                "/api/item/edit-item-amount",
+                json={"name": "idem1", "items": {"orio": 1}},
+                headers={"If-Match": stale_etag},
+            )
+            assert response.status_code == 412
+            assert json.loads(response.data)["success"] is False
+        response = client.post(
+            "/api/machine/delete-machine",
+            json={"name": "idem1"},
+            headers={"If-Match": first.headers["ETag"]},
+        )
+        assert response.status_code == 200
+
+
+def test_change_feed_api() -> None:
+    with app.test_client() as client:
+        since = json.loads(client_get(client, "/api/changes").data)["last_sequence"]
+        client_post(
+            client, "/api/machine/create-machine", {"name": "feed1", "location": "A"}
+        )
+        client_post(
+            client, "/api/item/add-item", {"name": "feed1", "items": {"orio": 3}}
+        )
+
+        response = client_get(client, f"/api/changes?since={since}&limit=10")
+        assert response.status_code == 200
+        response_data = json.loads(response.data)
+        assert [change["field"] for change in response_data["message"]] == [
+            "machine",
+            "items",
+        ]
+        assert response_data["last_sequence"] == since + 2
+        assert response_data["missed"] is False
+        epoch = response_data["epoch"]
+
+        # A sequence number of another process is reported as missed.
+        response_data = json.loads(
+            client_get(client, f"/api/changes?since={since + 2}&epoch=other").data
+        )
+        assert response_data["missed"] is True
+        assert response_data["epoch"] == epoch
+
+        # The stream starts after the Last-Event-ID of a reconnecting consumer.
+        response = client.get(
+            "/api/changes/stream",
+            headers={"Last-Event-ID": f"{epoch}-{since + 1}"},
+            buffered=False,
+        )
+        assert response.status_code == 200
+        assert response.mimetype == "text/event-stream"
+        event = next(response.response)
+        response.close()
+        event = event.decode() if isinstance(event, bytes) else event
+        assert event.startswith(f"id: {epoch}-{since + 2}\nevent: change\ndata: ")
+        assert json.loads(event.split("data: ", 1)[1])["new"] == 3
+
+        response = client.get(
+            "/api/changes/stream",
+            headers={"Last-Event-ID": f"other-{since + 1}"},
+            buffered=False,
+        )
+        event = next(response.response)
+        response.close()
+        event = event.decode() if isinstance(event, bytes) else event
+        assert "\nevent: missed\n" in event
+
+        response = client_get(client, "/api/changes?since=-1")
+        assert response.status_code == 400
+        response = client.get("/api/changes/stream", headers={"Last-Event-ID": "abc"})
+        assert response.status_code == 400
+        client_post(client, "/api/machine/delete-machine", {"name": "feed1"})
+
+
 def test_remove_vending_machine_item_api() -> None:
     route = "/api/item/remove-item"
     with app.test_client() as client:
@@ -398,6 +801,74 @@ def test_remove_vending_machine_item_api() -> None:
         }
 
 
+def test_bulk_update_vending_machine_items_api() -> None:
+    route = "/api/item/bulk-update"
+    with app.test_client() as client:
+        data = {
+            "operations": [
+                {"name": "ven2", "item": "orio", "delta": 10},
+                {"name": "ven2", "item": "orio", "amount": 3},
+                {"name": "non-exist", "item": "orio", "delta": 1},
+            ]
+        }
+        response = client_post(client, route, data)
+        assert response.status_code == 200
+        version = json.loads(response.data)["message"][0]["version"]
+        assert json.loads(response.data) == {
+            "success": True,
+            "message": [
+                {
+                    "success": True,
+                    "name": "ven2",
+                    "item": "orio",
+                    "amount": 10,
+                    "version": version,
+                },
+                {
+                    "success": True,
+                    "name": "ven2",
+                    "item": "orio",
+                    "amount": 3,
+                    "version": version,
+                },
+                {
+                    "success": False,
+                    "message": "Vending machine with name 'non-exist' does not exists.",
+                },
+            ],
+        }
+
+        # Test bulk update with missing argument.
+        data = {"name": "ven2"}
+        response = client_post(client, route, data)
+        assert response.status_code == 400
+        assert json.loads(response.data) == {
+            "success": False,
+            "message": "Missing 'operations' in the request data",
+        }
+
+        # Test bulk update with excessive argument.
+        data = {"operations": [], "name": "ven2"}
+        response = client_post(client, route, data)
+        assert response.status_code == 400
+        assert json.loads(response.data) == {
+            "success": False,
+            "message": "Too many keys in the request data, require only 'operations'",
+        }
+
+        # Test bulk update with 'operations' argument not a list.
+        data = {"operations": {"name": "ven2"}}
+        response = client_post(client, route, data)
+        assert response.status_code == 400
+        assert json.loads(response.data) == {
+            "success": False,
+            "message": "'operations' argument must be a list of item operations",
+        }
+
+        # Clean up the item so the machine is back to its previous state.
+        client_post(client, "/api/item/remove-item", {"name": "ven2", "items": "orio"})
+
+
 def test_delete_vending_machine_by_name_api() -> None:
     route = "/api/machine/delete-machine"
     with app.test_client() as client:
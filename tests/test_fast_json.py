@@ -0,0 +1,68 @@
+import json
+import pathlib
+
+import pytest
+from flask import Flask
+
+from database import fast_json
+from database.db_manager import get_machine_repository
+from routes.json_provider import FastJSONProvider
+
+
+@pytest.fixture(params=fast_json.available_backends())
+def backend(request: pytest.FixtureRequest) -> str:
+    return request.param
+
+
+def test_round_trip_keeps_long_integers(backend: str) -> None:
+    document = {"b": [1, -(2**70), 2**64], "a": {"name": "vén", "amount": 10**18}}
+    encoded = fast_json.dumps(document, sort_keys=True, backend=backend)
+    assert encoded == json.dumps(
+        document, sort_keys=True, ensure_ascii=False, separators=(",", ":")
+    ).encode("utf-8")
+    assert fast_json.loads(encoded, backend=backend) == document
+    assert fast_json.loads(encoded.decode("utf-8"), backend=backend) == document
+    with pytest.raises(ValueError):
+        fast_json.loads(b'{"name": ', backend=backend)
+
+
+def test_unknown_backend_is_rejected() -> None:
+    with pytest.raises(ValueError):
+        fast_json.select_backend("yaml")
+
+
+def test_storage_files_are_read_back(
+    backend: str, tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(fast_json, "BACKEND", backend)
+    for storage in ["json", "cached"]:
+        monkeypatch.setenv("DB_STORAGE", storage)
+        (tmp_path / storage).mkdir()
+        path = str(tmp_path / storage) + "/"
+        for backend_name in ["tinydb", "log"]:
+            repository = get_machine_repository(path, backend=backend_name)
+            repository.insert(
+                {"name": "ven1", "location": "A", "items": {"big": 2**70}}
+            )
+            repository.close()
+            repository = get_machine_repository(path, backend=backend_name)
+            assert repository.get("ven1")["items"] == {"big": 2**70}
+            repository.close()
+
+
+def test_provider_matches_default_responses(
+    backend: str, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(fast_json, "BACKEND", backend)
+    app = Flask(__name__)
+    app.json = FastJSONProvider(app)
+    default_app = Flask(__name__)
+    with app.app_context():
+        response = app.json.response(success=True, message={"name": "ven1", "n": 1})
+    with default_app.app_context():
+        default_response = default_app.json.response(
+            success=True, message={"name": "ven1", "n": 1}
+        )
+    assert response.get_data() == default_response.get_data()
+    assert response.mimetype == "application/json"
+    assert app.json.loads('{"a": [1, 2]}') == {"a": [1, 2]}
@@ -0,0 +1,131 @@
+import pathlib
+import threading
+import time
+
+import pytest
+
+from services.idempotency import (
+    IdempotencyKeyInProgressError,
+    IdempotencyKeyReusedError,
+    IdempotencyStore,
+    IdempotencyStoreFullError,
+    SQLiteIdempotencyStore,
+)
+
+RESPONSE = (200, b'{"success": true}', [("Content-Type", "application/json")])
+
+
+def test_retry_waits_for_the_original_response() -> None:
+    store = IdempotencyStore()
+    assert store.begin("key1", "request") is None
+    results = []
+    retry = threading.Thread(
+        target=lambda: results.append(store.begin("key1", "request"))
+    )
+    retry.start()
+    time.sleep(0.01)
+    assert results == []
+
+    store.complete("key1", RESPONSE)
+    retry.join()
+    assert results == [RESPONSE]
+    with pytest.raises(IdempotencyKeyReusedError):
+        store.begin("key1", "other request")
+
+
+def test_abandoned_and_expired_keys_run_again() -> None:
+    store = IdempotencyStore(window=0.01)
+    assert store.begin("key1", "request") is None
+    store.abandon("key1")
+    assert store.begin("key1", "request") is None
+    store.complete("key1", RESPONSE)
+    assert store.begin("key1", "request") == RESPONSE
+
+    time.sleep(0.02)
+    assert store.begin("key1", "other request") is None
+
+
+def test_keys_of_running_requests_are_never_forgotten() -> None:
+    store = IdempotencyStore(max_keys=2, wait_timeout=0.01)
+    assert store.begin("key1", "request") is None
+    assert store.begin("key2", "request") is None
+    store.complete("key2", RESPONSE)
+    # The completed key is forgotten first, although it was claimed later.
+    assert store.begin("key3", "request") is None
+    with pytest.raises(IdempotencyStoreFullError):
+        store.begin("key4", "request")
+    # A retry gives up waiting for a request that does not complete.
+    with pytest.raises(IdempotencyKeyInProgressError):
+        store.begin("key1", "request")
+    store.complete("key1", RESPONSE)
+    assert store.begin("key1", "request") == RESPONSE
+    assert store.begin("key4", "request") is None
+    store.complete("key3", RESPONSE)
+    assert store.begin("key2", "other request") is None
+
+
+def test_running_requests_do_not_hold_back_expired_keys() -> None:
+    store = IdempotencyStore(window=0.01)
+    assert store.begin("key1", "request") is None
+    assert store.begin("key2", "request") is None
+    store.complete("key2", RESPONSE)
+    time.sleep(0.02)
+    assert store.begin("key2", "other request") is None
+    with pytest.raises(IdempotencyKeyReusedError):
+        store.begin("key1", "other request")
+
+
+def test_sqlite_store_is_shared_and_persistent(tmp_path: pathlib.Path) -> None:
+    path = str(tmp_path / "idempotency.sqlite3")
+    # Two stores on the same file, like two worker processes.
+    first, second = SQLiteIdempotencyStore(path), SQLiteIdempotencyStore(path)
+    assert first.begin("key1", "request") is None
+    results = []
+    retry = threading.Thread(
+        target=lambda: results.append(second.begin("key1", "request"))
+    )
+    retry.start()
+    time.sleep(0.1)
+    assert results == []
+
+    first.complete("key1", RESPONSE)
+    retry.join()
+    assert results == [RESPONSE]
+    with pytest.raises(IdempotencyKeyReusedError):
+        second.begin("key1", "other request")
+    first.close()
+    second.close()
+
+    reopened = SQLiteIdempotencyStore(path)
+    assert reopened.begin("key1", "request") == RESPONSE
+    assert reopened.begin("key2", "request") is None
+    reopened.abandon("key2")
+    assert reopened.begin("key2", "request") is None
+    reopened.close()
+
+
+def test_sqlite_store_releases_stale_claims(tmp_path: pathlib.Path) -> None:
+    store = SQLiteIdempotencyStore(
+        str(tmp_path / "idempotency.sqlite3"), window=0.05, claim_timeout=0.05
+    )
+    assert store.begin("key1", "request") is None
+    # The request claiming key1 never completes, e.g. its process was killed.
+    assert store.begin("key1", "request") is None
+    store.complete("key1", RESPONSE)
+    assert store.begin("key1", "request") == RESPONSE
+
+    time.sleep(0.06)
+    assert store.begin("key1", "other request") is None
+    store.close()
+
+
+def test_sqlite_store_retries_wait_with_a_deadline(tmp_path: pathlib.Path) -> None:
+    store = SQLiteIdempotencyStore(
+        str(tmp_path / "idempotency.sqlite3"), wait_timeout=0.05
+    )
+    assert store.begin("key1", "request") is None
+    with pytest.raises(IdempotencyKeyInProgressError):
+        store.begin("key1", "request")
+    store.complete("key1", RESPONSE)
+    assert store.begin("key1", "request") == RESPONSE
+    store.close()
@@ -0,0 +1,297 @@
+import json
+import os
+import pathlib
+import threading
+from typing import Iterable
+
+import pytest
+
+from database import log_repository
+from database.binary_snapshot import BinarySnapshot
+from database.log_repository import LogMachineRepository
+from services.vending_machine_service import VendingMachineService
+
+
+def open_repository(tmp_path: pathlib.Path, **kwargs: dict) -> LogMachineRepository:
+    return LogMachineRepository(str(tmp_path / "db"), **kwargs)
+
+
+def test_log_is_replayed_on_reopen(tmp_path: pathlib.Path) -> None:
+    repository = open_repository(tmp_path)
+    machine_service = VendingMachineService(repository)
+    machine_service.create_new_vending_machine("ven1", "A")
+    machine_service.create_new_vending_machine("ven2", "B")
+    machine_service.add_vending_machine_item("ven1", "orio", 10)
+    machine_service.edit_vending_machine_item_amount("ven1", "orio", 4)
+    machine_service.change_vending_machine_name("ven1", "ven3")
+    machine_service.delete_vending_machine_by_name("ven2")
+    repository.close()
+
+    with open(tmp_path / "db.log", encoding="utf-8") as handle:
+        records = [json.loads(line) for line in handle]
+    assert [record["seq"] for record in records] == list(range(1, len(records) + 1))
+    assert {"seq": 4, "op": "item", "name": "ven1", "item": "orio", "delta": -6} in (
+        records
+    )
+
+    repository = open_repository(tmp_path)
+    assert repository.all() == [{"name": "ven3", "location": "A", "items": {"orio": 4}}]
+    repository.close()
+
+
+def test_compaction_writes_snapshot_and_drops_log(tmp_path: pathlib.Path) -> None:
+    repository = open_repository(tmp_path, compact_size=1)
+    for index in range(3):
+        repository.insert({"name": f"ven{index}", "location": "A", "items": {}})
+    repository.compact()
+    repository.update("ven1", lambda machine: machine["items"].update(orio=2))
+    repository.close()
+
+    assert not os.path.exists(tmp_path / "db.log.compacting")
+    snapshot = BinarySnapshot(str(tmp_path / "db.snapshot"))
+    assert len(snapshot) == 3
+    snapshot.close()
+
+    repository = open_repository(tmp_path)
+    assert repository.get("ven1")["items"] == {"orio": 2}
+    assert [machine["name"] for machine in repository.all()] == [
+        "ven0",
+        "ven1",
+        "ven2",
+    ]
+    repository.close()
+
+
+def test_snapshot_machines_are_decoded_on_first_access(
+    tmp_path: pathlib.Path,
+) -> None:
+    repository = open_repository(tmp_path)
+    for index in range(3):
+        repository.insert(
+            {"name": f"ven{index}", "location": "A", "items": {"orio": index}}
+        )
+    repository.compact()
+    repository.close()
+
+    repository = open_repository(tmp_path)
+    assert repository.exists("ven2")
+    assert repository._undecoded == {1: 0, 2: 1, 3: 2}
+    assert repository.get("ven1") == {
+        "name": "ven1",
+        "location": "A",
+        "items": {"orio": 1},
+    }
+    repository.delete("ven2")
+    assert repository._undecoded == {1: 0}
+    assert [machine["name"] for machine in repository.all()] == ["ven0", "ven1"]
+    repository.close()
+
+
+def test_service_is_indexed_without_decoding_the_snapshot(
+    tmp_path: pathlib.Path,
+) -> None:
+    repository = open_repository(tmp_path)
+    for index in range(3):
+        repository.insert(
+            {"name": f"ven{index}", "location": "A", "items": {"orio": index}}
+        )
+    repository.compact()
+    repository.update(
+        "ven2", lambda vending_machine: vending_machine.update(location="B")
+    )
+    repository.close()
+
+    repository = open_repository(tmp_path)
+    assert repository._undecoded == {1: 0, 2: 1}
+    machine_service = VendingMachineService(repository)
+    assert repository._undecoded == {1: 0, 2: 1}
+    assert machine_service.get_vending_machines_by_location("A") == [
+        {"name": "ven0", "location": "A", "items": {"orio": 0}},
+        {"name": "ven1", "location": "A", "items": {"orio": 1}},
+    ]
+    assert machine_service.get_low_stock_items("orio", below=2) == [
+        {"name": "ven0", "item": "orio", "amount": 0},
+        {"name": "ven1", "item": "orio", "amount": 1},
+    ]
+    assert machine_service.get_inventory_aggregates() == {
+        "orio": {"amount": 3, "machines": 3}
+    }
+    assert repository._undecoded == {1: 0, 2: 1}
+    changes = machine_service.get_changes(0)["changes"]
+    assert [change["machine"] for change in changes] == ["ven0", "ven1", "ven2"]
+    assert changes[2]["new"] == {"name": "ven2", "location": "B", "items": {"orio": 2}}
+
+    machine_service = VendingMachineService(repository, change_feed_size=1)
+    changes = machine_service.get_changes(0)
+    assert (changes["missed"], changes["last_sequence"]) == (True, 3)
+    assert [change["machine"] for change in changes["changes"]] == ["ven2"]
+    repository.close()
+
+
+def test_compaction_serializes_the_machines_outside_the_lock(
+    tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    repository = open_repository(tmp_path)
+    for index in range(3):
+        repository.insert(
+            {"name": f"ven{index}", "location": "A", "items": {"orio": index}}
+        )
+    repository.compact()
+    repository.close()
+    repository = open_repository(tmp_path)
+    repository.update("ven0", lambda machine: machine["items"].update(orio=5))
+
+    write_snapshot = log_repository.write_snapshot
+
+    def write_snapshot_while_writing(
+        path: str, vending_machines: Iterable[tuple[int, dict]], **kwargs: dict
+    ) -> int:
+        # Another thread changes the machines while the snapshot is serialized.
+        writer = threading.Thread(
+            target=repository.update_many,
+            args=(["ven0", "ven1"], lambda machine: machine["items"].update(orio=9)),
+        )
+        writer.start()
+        writer.join(timeout=5)
+        assert not writer.is_alive()
+        return write_snapshot(path, vending_machines, **kwargs)
+
+    monkeypatch.setattr(log_repository, "write_snapshot", write_snapshot_while_writing)
+    repository.compact()
+
+    snapshot = BinarySnapshot(str(tmp_path / "db.snapshot"))
+    assert [machine["items"] for _, machine in snapshot] == [
+        {"orio": 5},
+        {"orio": 1},
+        {"orio": 2},
+    ]
+    snapshot.close()
+    # The machine never decoded is read from the new snapshot.
+    assert repository._undecoded == {3: 2}
+    assert [machine["items"] for machine in repository.all()] == [
+        {"orio": 9},
+        {"orio": 9},
+        {"orio": 2},
+    ]
+    repository.close()
+
+    repository = open_repository(tmp_path)
+    assert repository.get("ven1")["items"] == {"orio": 9}
+    repository.close()
+
+
+def test_json_snapshot_is_read_and_rewritten(tmp_path: pathlib.Path) -> None:
+    with open(tmp_path / "db.snapshot", "w", encoding="utf-8") as handle:
+        json.dump(
+            {
+                "sequence": 1,
+                "next_id": 2,
+                "machines": [[1, {"name": "ven1", "location": "A", "items": {}}]],
+            },
+            handle,
+        )
+    repository = open_repository(tmp_path)
+    repository.insert({"name": "ven2", "location": "B", "items": {"orio": 1}})
+    repository.compact()
+    repository.close()
+
+    repository = open_repository(tmp_path)
+    assert repository._snapshot is not None
+    assert [machine["name"] for machine in repository.all()] == ["ven1", "ven2"]
+    repository.close()
+
+
+def test_interrupted_compaction_does_not_apply_records_twice(
+    tmp_path: pathlib.Path,
+) -> None:
+    repository = open_repository(tmp_path)
+    repository.insert({"name": "ven1", "location": "A", "items": {"orio": 1}})
+    repository.update("ven1", lambda machine: machine["items"].update(orio=5))
+    repository.compact()
+    repository.close()
+
+    # Simulate a crash after the snapshot was written but before the old log was removed.
+    with open(tmp_path / "db.log.compacting", "w", encoding="utf-8") as handle:
+        handle.write('{"seq":2,"op":"item","name":"ven1","item":"orio","delta":4}\n')
+
+    repository = open_repository(tmp_path)
+    assert repository.get("ven1")["items"] == {"orio": 5}
+    assert not os.path.exists(tmp_path / "db.log.compacting")
+    repository.close()
+
+
+def test_torn_trailing_record_is_ignored(tmp_path: pathlib.Path) -> None:
+    repository = open_repository(tmp_path)
+    repository.insert({"name": "ven1", "location": "A", "items": {}})
+    repository.close()
+    with open(tmp_path / "db.log", "a", encoding="utf-8") as handle:
+        handle.write('{"seq":2,"op":"delete","na')
+
+    repository = open_repository(tmp_path)
+    assert repository.exists("ven1")
+    repository.close()
+
+
+def test_records_after_a_torn_record_survive_reopen(tmp_path: pathlib.Path) -> None:
+    repository = open_repository(tmp_path)
+    repository.insert({"name": "ven1", "location": "A", "items": {}})
+    repository.close()
+    with open(tmp_path / "db.log", "a", encoding="utf-8") as handle:
+        handle.write('{"seq":2,"op":"delete","na')
+
+    repository = open_repository(tmp_path)
+    repository.insert({"name": "ven2", "location": "B", "items": {"orio": 1}})
+    repository.close()
+
+    repository = open_repository(tmp_path)
+    assert repository.exists("ven1")
+    assert repository.get("ven2") == {
+        "name": "ven2",
+        "location": "B",
+        "items": {"orio": 1},
+    }
+    repository.close()
+
+
+def test_failed_transform_leaves_no_record(tmp_path: pathlib.Path) -> None:
+    repository = open_repository(tmp_path, fsync="never")
+    repository.insert({"name": "ven1", "location": "A", "items": {"orio": 1}})
+
+    def transform(vending_machine: dict) -> None:
+        vending_machine["items"]["orio"] = 2
+        raise ValueError("rejected")
+
+    with pytest.raises(ValueError):
+        repository.update("ven1", transform)
+    assert repository.get("ven1")["items"] == {"orio": 1}
+    repository.close()
+
+    with open(tmp_path / "db.log", encoding="utf-8") as handle:
+        assert len(handle.readlines()) == 1
+
+
+def test_unknown_fsync_policy(tmp_path: pathlib.Path) -> None:
+    with pytest.raises(ValueError):
+        open_repository(tmp_path, fsync="sometimes")
+
+
+def test_always_policy_syncs_before_returning(
+    tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    repository = open_repository(tmp_path, fsync="always")
+    synced = []
+    fsync = os.fsync
+
+    def counting_fsync(fileno: int) -> None:
+        synced.append(repository._sequence)
+        fsync(fileno)
+
+    monkeypatch.setattr(os, "fsync", counting_fsync)
+    repository.insert({"name": "ven1", "location": "A", "items": {}})
+    assert synced == [repository._sequence]
+    assert repository._synced_sequence == repository._sequence
+
+    # A mutation already covered by an earlier sync does not sync again.
+    repository._wait_durable(repository._sequence - 1)
+    assert len(synced) == 1
+    repository.close()
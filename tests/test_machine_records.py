@@ -0,0 +1,61 @@
+import pathlib
+
+import pytest
+
+from database.db_manager import get_machine_repository
+from services.machine_records import MachineRecord, SkuTable
+from services.vending_machine_service import VendingMachineService
+
+
+def test_record_round_trip_shares_sku_names() -> None:
+    skus = SkuTable()
+    vending_machines = [
+        {"name": "ven1", "location": "A", "items": {"orio": 3, "lays": 0}},
+        {"name": "ven2", "location": "A", "items": {"lays": -1, "orio": 2**70}},
+    ]
+    records = [
+        MachineRecord.from_document(vending_machine, skus)
+        for vending_machine in vending_machines
+    ]
+    assert len(skus) == 2
+    assert records[0].sku_ids.tolist() == [0, 1]
+    assert records[1].sku_ids.tolist() == [1, 0]
+    # Amounts beyond 64 bits are kept as they are.
+    assert [record.to_document(skus) for record in records] == vending_machines
+    assert records[0].location is records[1].location
+    assert records[0].with_version(1).version == 1
+    assert records[0].version == 0
+
+
+def test_reads_are_answered_from_records(
+    tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    repository = get_machine_repository(str(tmp_path) + "/", backend="tinydb")
+    machine_service = VendingMachineService(repository)
+    machine_service.create_new_vending_machine("ven1", "A")
+    machine_service.create_new_vending_machine("ven2", "A")
+    machine_service.add_vending_machine_item("ven1", "orio", 3)
+
+    def no_storage_read(*args: tuple) -> None:
+        raise AssertionError("the storage was read")
+
+    for method in ["get", "get_many", "exists", "all", "rows", "iterate"]:
+        monkeypatch.setattr(repository, method, no_storage_read)
+    assert machine_service.get_vending_machine_info("ven1") == {
+        "name": "ven1",
+        "location": "A",
+        "items": {"orio": 3},
+    }
+    assert machine_service.get_vending_machines_by_location("A", ["items"]) == [
+        {"items": {"orio": 3}},
+        {"items": {}},
+    ]
+    with pytest.raises(ValueError):
+        machine_service.create_new_vending_machine("ven1", "A")
+    monkeypatch.undo()
+
+    machine_service.change_vending_machine_name("ven1", "ven3")
+    machine_service.delete_vending_machine_by_name("ven2")
+    assert list(machine_service._machines) == ["ven3"]
+    assert repository.get("ven3") == machine_service.get_vending_machine_info("ven3")
+    repository.close()
@@ -0,0 +1,210 @@
+import pathlib
+from typing import Iterator
+
+import pytest
+
+from database.db_manager import get_machine_repository
+from database.machine_repository import MachineRepository
+from database.sqlite_repository import SQLiteMachineRepository
+from services.vending_machine_service import VendingMachineService
+
+
+@pytest.fixture(params=["tinydb", "sqlite", "log", "sharded"])
+def repository(
+    request: pytest.FixtureRequest, tmp_path: pathlib.Path
+) -> Iterator[MachineRepository]:
+    repository = get_machine_repository(str(tmp_path) + "/", backend=request.param)
+    yield repository
+    repository.close()
+
+
+def test_service_workflow(repository: MachineRepository) -> None:
+    machine_service = VendingMachineService(repository)
+    machine_service.create_new_vending_machine("ven1", "A")
+    machine_service.create_new_vending_machine("ven2", "B")
+
+    machine_service.add_vending_machine_item("ven1", "orio", 10)
+    machine_service.add_vending_machine_item("ven1", "drink", 5)
+    vending_machine = machine_service.edit_vending_machine_item_amount(
+        "ven1", "orio", 3
+    )
+    assert vending_machine == {
+        "name": "ven1",
+        "location": "A",
+        "items": {"orio": 3, "drink": 5},
+    }
+
+    vending_machine = machine_service.change_vending_machine_name("ven1", "ven3")
+    assert vending_machine["name"] == "ven3"
+    assert repository.get("ven1") is None
+
+    vending_machine = machine_service.change_vending_machine_location("ven3", "C")
+    assert vending_machine["location"] == "C"
+
+    vending_machine = machine_service.remove_vending_machine_item("ven3", "orio")
+    assert vending_machine["items"] == {"drink": 5}
+
+    with pytest.raises(ValueError):
+        machine_service.remove_vending_machine_item("ven3", "orio")
+    assert repository.get("ven3") == {
+        "name": "ven3",
+        "location": "C",
+        "items": {"drink": 5},
+    }
+
+    machine_service.delete_vending_machine_by_name("ven2")
+    assert machine_service.get_all_vending_machine_info() == [
+        {"name": "ven3", "location": "C", "items": {"drink": 5}}
+    ]
+
+    machine_service.purge_database()
+    assert machine_service.get_all_vending_machine_info() == []
+
+
+def test_iterate_resumes_after_key(repository: MachineRepository) -> None:
+    for index in range(5):
+        repository.insert(
+            {"name": f"ven{index}", "location": "A", "items": {"orio": index}}
+        )
+
+    keys_and_machines = list(repository.iterate())
+    assert [machine["items"]["orio"] for _, machine in keys_and_machines] == [
+        0,
+        1,
+        2,
+        3,
+        4,
+    ]
+    after = keys_and_machines[1][0]
+    assert [machine["name"] for _, machine in repository.iterate(after=after)] == [
+        "ven2",
+        "ven3",
+        "ven4",
+    ]
+
+
+def test_insert_many(repository: MachineRepository) -> None:
+    repository.insert({"name": "ven0", "location": "A", "items": {}})
+    repository.insert_many(
+        {"name": f"ven{index}", "location": "B", "items": {"orio": index}}
+        for index in range(1, 4)
+    )
+
+    assert [key for key, _ in repository.iterate()] == sorted(
+        key for key, _ in repository.iterate()
+    )
+    assert [machine["name"] for _, machine in repository.iterate()] == [
+        "ven0",
+        "ven1",
+        "ven2",
+        "ven3",
+    ]
+    assert repository.get("ven3") == {
+        "name": "ven3",
+        "location": "B",
+        "items": {"orio": 3},
+    }
+
+
+def test_iterate_by_location(repository: MachineRepository) -> None:
+    for index in range(6):
+        repository.insert(
+            {
+                "name": f"ven{index}",
+                "location": "AB"[index % 2],
+                "items": {"orio": index},
+            }
+        )
+
+    assert [
+        (machine["name"], machine["items"])
+        for _, machine in repository.iterate(location="B")
+    ] == [("ven1", {"orio": 1}), ("ven3", {"orio": 3}), ("ven5", {"orio": 5})]
+
+
+def test_iterate_by_names(repository: MachineRepository) -> None:
+    for index in range(6):
+        repository.insert(
+            {
+                "name": f"ven{index}",
+                "location": "AB"[index % 2],
+                "items": {"orio": index},
+            }
+        )
+
+    names = ["ven4", "ven1", "ven3", "missing"]
+    assert [machine["name"] for _, machine in repository.iterate(names=names)] == [
+        "ven1",
+        "ven3",
+        "ven4",
+    ]
+    assert [
+        (machine["name"], machine["items"])
+        for _, machine in repository.iterate(location="B", names=names)
+    ] == [("ven1", {"orio": 1}), ("ven3", {"orio": 3})]
+    after = next(repository.iterate(names=["ven1"]))[0]
+    assert [
+        machine["name"] for _, machine in repository.iterate(after, names=names)
+    ] == ["ven3", "ven4"]
+    assert list(repository.iterate(names=[])) == []
+
+
+def test_item_filters_read_only_matching_machines(
+    repository: MachineRepository,
+) -> None:
+    machine_service = VendingMachineService(repository)
+    for index in range(6):
+        machine_service.create_new_vending_machine(f"ven{index}", "A")
+        machine_service.add_vending_machine_item(f"ven{index}", "orio", index)
+    machine_service.add_vending_machine_item("ven5", "drink", 1)
+
+    requested = []
+    iterate = repository.iterate
+
+    def recording_iterate(*args, **kwargs):
+        requested.append(args)
+        return iterate(*args, **kwargs)
+
+    repository.iterate = recording_iterate
+    assert [
+        machine["name"]
+        for machine in machine_service.get_all_vending_machine_info(
+            item_name="orio", below=2
+        )
+    ] == ["ven0", "ven1"]
+    assert requested[-1][2] == {"ven0", "ven1"}
+    assert machine_service.get_all_vending_machine_info(below=0) == []
+    assert [
+        machine["name"]
+        for machine in machine_service.get_all_vending_machine_info(item_name="drink")
+    ] == ["ven5"]
+
+
+def test_repository_is_reopened_from_disk(tmp_path: pathlib.Path) -> None:
+    for backend in ["tinydb", "sqlite", "log"]:
+        repository = get_machine_repository(str(tmp_path) + "/", backend=backend)
+        repository.insert({"name": "ven1", "location": "A", "items": {"orio": 1}})
+        repository.close()
+
+        repository = get_machine_repository(str(tmp_path) + "/", backend=backend)
+        assert repository.exists("ven1")
+        assert repository.get("ven1")["items"] == {"orio": 1}
+        repository.close()
+
+
+def test_sqlite_item_update_touches_only_changed_rows(tmp_path: pathlib.Path) -> None:
+    repository = SQLiteMachineRepository(str(tmp_path / "db.sqlite3"))
+    repository.insert(
+        {"name": "ven1", "location": "A", "items": {f"item{i}": i for i in range(50)}}
+    )
+
+    changes_before = repository._connection.total_changes
+    VendingMachineService(repository).add_vending_machine_item("ven1", "item7", 1)
+    assert repository._connection.total_changes - changes_before == 1
+    assert repository._connection.execute("PRAGMA journal_mode").fetchone() == ("wal",)
+    repository.close()
+
+
+def test_unknown_backend(tmp_path: pathlib.Path) -> None:
+    with pytest.raises(ValueError):
+        get_machine_repository(str(tmp_path) + "/", backend="unknown")
@@ -0,0 +1,76 @@
+import pathlib
+import threading
+
+from app import create_app
+from database.db_manager import get_machine_repository
+from database.machine_repository import measure_io, record_io
+from services.metrics import InstrumentedMachineRepository, MetricsRegistry
+from services.vending_machine_service import VendingMachineService
+
+
+def test_storage_calls_are_recorded(tmp_path: pathlib.Path) -> None:
+    metrics = MetricsRegistry()
+    repository = get_machine_repository(str(tmp_path) + "/", backend="tinydb")
+    machine_service = VendingMachineService(repository, metrics)
+    assert isinstance(machine_service.repository, InstrumentedMachineRepository)
+
+    machine_service.create_new_vending_machine("ven1", "A")
+    machine_service.create_new_vending_machine("ven2", "A")
+    machine_service.add_vending_machine_item("ven1", "orio", 3)
+    assert len(list(machine_service.iter_all_vending_machine_info(below=5))) == 1
+    repository.close()
+
+    rendered = metrics.render()
+    assert 'vending_storage_call_duration_seconds_count{operation="insert"} 2' in (
+        rendered
+    )
+    # The item index narrows the read to the matching machine, but TinyDB decodes the whole file.
+    assert 'vending_storage_documents_total{operation="iterate"} 1' in rendered
+    assert 'vending_storage_scanned_documents_total{operation="iterate"} 2' in rendered
+    assert 'vending_storage_documents_total{operation="update_many"} 1' in rendered
+    bytes_written = {
+        line.split("{")[1].split("}")[0]: int(line.rsplit(" ", 1)[1])
+        for line in rendered.splitlines()
+        if line.startswith("vending_storage_written_bytes_total")
+    }
+    # TinyDB rewrites the whole file on every write.
+    assert bytes_written['operation="update_many"'] > 0
+    assert bytes_written['operation="iterate"'] == 0
+
+
+def test_storage_io_is_measured_per_thread() -> None:
+    with measure_io() as storage_io:
+        record_io(bytes_read=10, documents_scanned=2)
+        other_thread = threading.Thread(target=record_io, kwargs={"bytes_written": 5})
+        other_thread.start()
+        other_thread.join()
+    record_io(bytes_read=1)
+
+    assert storage_io.bytes_read == 10
+    assert storage_io.bytes_written == 0
+    assert storage_io.documents_scanned == 2
+
+
+def test_request_metrics_and_server_timing() -> None:
+    app = create_app({"TESTING": True, "SERVER_TIMING": True})
+    with app.test_client() as client:
+        response = client.get("/api/item/low-stock?below=1")
+        assert response.status_code == 200
+        server_timing = response.headers["Server-Timing"]
+        assert server_timing.startswith("storage;dur=")
+        assert "total;dur=" in server_timing
+
+        response = client.get("/api/metrics")
+        assert response.status_code == 200
+        assert response.mimetype == "text/plain"
+        assert (
+            'vending_http_requests_total{method="GET",route="/api/item/low-stock",status="200"}'
+            in response.get_data(as_text=True)
+        )
+
+
+def test_server_timing_is_disabled_by_default() -> None:
+    app = create_app({"TESTING": True})
+    with app.test_client() as client:
+        response = client.get("/api/item/low-stock?below=1")
+        assert "Server-Timing" not in response.headers
@@ -0,0 +1,28 @@
+from services.response_cache import ResponseCache
+
+
+def test_entries_are_returned_for_their_etag_only() -> None:
+    cache = ResponseCache(max_entries=2)
+    cache.put("ven1", "e1", b"1")
+    assert cache.get("ven1", "e1") == b"1"
+    assert cache.get("ven1", "e2") is None
+
+    cache.put("ven1", "e2", b"2")
+    assert cache.get("ven1", "e1") is None
+    assert cache.get("ven1", "e2") == b"2"
+    assert (cache.hits, cache.misses) == (2, 2)
+
+
+def test_least_recently_used_entry_is_evicted() -> None:
+    cache = ResponseCache(max_entries=2)
+    cache.put("ven1", "e", b"1")
+    cache.put("ven2", "e", b"2")
+    cache.get("ven1", "e")
+    cache.put("ven3", "e", b"3")
+    assert len(cache) == 2
+    assert cache.get("ven2", "e") is None
+    assert cache.get("ven1", "e") == b"1"
+
+    disabled_cache = ResponseCache(max_entries=0)
+    disabled_cache.put("ven1", "e", b"1")
+    assert disabled_cache.get("ven1", "e") is None
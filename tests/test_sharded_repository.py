@@ -0,0 +1,146 @@
+import pathlib
+
+import pytest
+from tinydb.table import Document
+
+from database.db_manager import get_machine_repository, get_sharded_repository
+from database.reshard import reshard
+from database.sharded_repository import ShardedMachineRepository
+from services.vending_machine_service import VendingMachineService
+
+
+def open_shards(
+    tmp_path: pathlib.Path, shard_count: int = 4, partition: str = "name"
+) -> ShardedMachineRepository:
+    directory = str(tmp_path) + "/shards/"
+    return get_sharded_repository(directory, shard_count, partition, storage="json")
+
+
+def test_machines_are_spread_over_shards(tmp_path: pathlib.Path) -> None:
+    repository = open_shards(tmp_path)
+    machine_service = VendingMachineService(repository)
+    for index in range(20):
+        machine_service.create_new_vending_machine(f"ven{index}", "A")
+
+    assert all(len(shard.all()) > 0 for shard in repository.shards)
+    # Keys are global, so the merged listing keeps the creation order.
+    assert [vending_machine["name"] for vending_machine in repository.all()] == [
+        f"ven{index}" for index in range(20)
+    ]
+    keys = [key for key, _ in repository.iterate()]
+    assert keys == sorted(keys)
+    assert [key for key, _ in repository.iterate(after=keys[9])] == keys[10:]
+    repository.close()
+
+
+def test_rename_and_relocation_move_machines_between_shards(
+    tmp_path: pathlib.Path,
+) -> None:
+    repository = open_shards(tmp_path, partition="location")
+    machine_service = VendingMachineService(repository)
+    machine_service.create_new_vending_machine("ven1", "A")
+    machine_service.add_vending_machine_item("ven1", "orio", 3)
+    key = next(repository.iterate())[0]
+    locations = [f"L{index}" for index in range(20)]
+    other_location = next(
+        location
+        for location in locations
+        if repository.shard_index({"location": location})
+        != repository.shard_index({"location": "A"})
+    )
+
+    machine_service.change_vending_machine_location("ven1", other_location)
+    machine_service.change_vending_machine_name("ven1", "ven2")
+
+    shard = repository.shards[repository.shard_index({"location": other_location})]
+    assert [vending_machine["name"] for vending_machine in shard.all()] == ["ven2"]
+    assert sum(len(shard.all()) for shard in repository.shards) == 1
+    assert list(repository.iterate(location=other_location)) == [
+        (key, {"name": "ven2", "location": other_location, "items": {"orio": 3}})
+    ]
+    assert repository.get("ven1") is None
+    repository.close()
+
+
+def test_update_across_shards_writes_nothing_when_a_transform_fails(
+    tmp_path: pathlib.Path,
+) -> None:
+    repository = open_shards(tmp_path)
+    names = [f"ven{index}" for index in range(8)]
+    repository.insert_many(
+        {"name": name, "location": "A", "items": {}} for name in names
+    )
+
+    def transform(vending_machine: dict) -> None:
+        if vending_machine["name"] == names[-1]:
+            raise ValueError("rejected")
+        vending_machine["items"]["orio"] = 1
+
+    with pytest.raises(ValueError):
+        repository.update_many(names, transform)
+    assert all(vending_machine["items"] == {} for vending_machine in repository.all())
+
+    updated = repository.update_many(
+        names, lambda vending_machine: vending_machine["items"].update(orio=1)
+    )
+    assert [vending_machine["name"] for vending_machine in updated] == names
+    assert all(vending_machine["items"] == {"orio": 1} for vending_machine in updated)
+    repository.close()
+
+
+def test_copy_left_by_interrupted_move_is_removed_on_open(
+    tmp_path: pathlib.Path,
+) -> None:
+    repository = open_shards(tmp_path)
+    vending_machine = repository.insert({"name": "ven1", "location": "A", "items": {}})
+    index = repository.shard_index(vending_machine)
+    stale_index = (index + 1) % len(repository.shards)
+    repository.shards[stale_index].insert(
+        Document({"name": "ven1", "location": "A", "items": {}}, 100)
+    )
+    repository.close()
+
+    repository = open_shards(tmp_path, shard_count=8, partition="location")
+    # The manifest keeps the layout the shards were created with.
+    assert len(repository.shards) == 4
+    assert repository.partition == "name"
+    assert repository.shards[stale_index].get("ven1") is None
+    assert repository.get("ven1") == {"name": "ven1", "location": "A", "items": {}}
+    assert (
+        repository.insert({"name": "ven2", "location": "A", "items": {}}).doc_id > 100
+    )
+    repository.close()
+
+
+def test_reshard_keeps_machines_and_keys(
+    tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setenv("DB_STORAGE", "json")
+    path = str(tmp_path) + "/"
+    repository = get_machine_repository(path, backend="tinydb")
+    machine_service = VendingMachineService(repository)
+    for index in range(10):
+        machine_service.create_new_vending_machine(f"ven{index}", f"L{index % 3}")
+        machine_service.add_vending_machine_item(f"ven{index}", "orio", index)
+    machine_service.delete_vending_machine_by_name("ven0")
+    expected = list(repository.iterate())
+    repository.close()
+
+    assert reshard(path, 3, "location", source_backend="tinydb") == 9
+    repository = get_machine_repository(path, backend="sharded")
+    assert len(repository.shards) == 3
+    assert list(repository.iterate()) == expected
+    repository.close()
+
+    assert reshard(path, 5) == 9
+    repository = get_machine_repository(path, backend="sharded")
+    assert (len(repository.shards), repository.partition) == (5, "name")
+    assert list(repository.iterate()) == expected
+    assert list(repository.iterate(location="L1")) == [
+        (key, vending_machine)
+        for key, vending_machine in expected
+        if vending_machine["location"] == "L1"
+    ]
+    repository.close()
+    assert not (tmp_path / "db_shards.old").exists()
+    assert not (tmp_path / "db_shards.resharding").exists()
@@ -0,0 +1,230 @@
+import multiprocessing
+import pathlib
+
+import pytest
+
+from database.db_manager import get_machine_repository
+from services.vending_machine_service import (
+    VendingMachineService,
+    VersionConflictError,
+)
+
+
+@pytest.fixture(params=["tinydb", "sqlite", "sharded"])
+def open_service(
+    request: pytest.FixtureRequest,
+    tmp_path: pathlib.Path,
+    monkeypatch: pytest.MonkeyPatch,
+) -> callable:
+    # Each service opens its own lock file, so they exclude each other like separate processes.
+    monkeypatch.setenv("DB_STORAGE", "json")
+    services = []
+
+    def open_service() -> VendingMachineService:
+        repository = get_machine_repository(
+            str(tmp_path) + "/", backend=request.param, shared=True
+        )
+        services.append(VendingMachineService(repository))
+        return services[-1]
+
+    yield open_service
+    for machine_service in services:
+        machine_service.repository.close()
+
+
+def test_changes_of_other_processes_are_applied(open_service: callable) -> None:
+    first = open_service()
+    second = open_service()
+    first.create_new_vending_machine("ven1", "A")
+    first.add_vending_machine_item("ven1", "orio", 3)
+    first.create_new_vending_machine("ven2", "B")
+
+    assert second.get_vending_machines_by_location("A") == []
+    second.sync_changes()
+    assert second.get_vending_machine_info("ven1") == {
+        "name": "ven1",
+        "location": "A",
+        "items": {"orio": 3},
+    }
+    assert second.get_vending_machines_by_location("B", ["name"]) == [{"name": "ven2"}]
+
+    # Writes catch up first, so checks see the machines created elsewhere.
+    second.change_vending_machine_name("ven2", "ven3")
+    with pytest.raises(ValueError):
+        first.create_new_vending_machine("ven3", "A")
+    first.delete_vending_machine_by_name("ven1")
+    second.sync_changes()
+    assert list(second._machines) == ["ven3"]
+    assert second.get_inventory_aggregates() == first.get_inventory_aggregates()
+    assert [change["field"] for change in second.get_changes()["changes"]][-2:] == [
+        "name",
+        "machine",
+    ]
+
+
+def test_changes_of_other_processes_are_applied_without_reopening(
+    open_service: callable,
+) -> None:
+    first = open_service()
+    second = open_service()
+    repository = second.repository
+    reopened = []
+    open_repository = repository._open_repository
+    repository._open_repository = lambda: reopened.append(True) or open_repository()
+
+    second.create_new_vending_machine("ven0", "C")
+    first.create_new_vending_machine("ven1", "A")
+    first.add_vending_machine_item("ven1", "orio", 1)
+    first.change_vending_machine_name("ven1", "ven2")
+    first.change_vending_machine_location("ven2", "B")
+    second.sync_changes()
+    # The indexes of the wrapped repository know the machines written by the other process.
+    second.add_vending_machine_item("ven2", "orio", 1)
+    second.create_new_vending_machine("ven3", "A")
+    first.sync_changes()
+
+    assert reopened == []
+    assert first.get_vending_machine_info("ven2") == {
+        "name": "ven2",
+        "location": "B",
+        "items": {"orio": 2},
+    }
+    first.repository.insert_many(
+        {"name": f"ven{index}", "location": "C", "items": {}} for index in (4, 5)
+    )
+    assert repository.get("ven5") == {"name": "ven5", "location": "C", "items": {}}
+    keys = [key for key, _ in repository.iterate()]
+    assert len(set(keys)) == len(keys) == 5
+
+
+def test_versions_are_shared_between_processes(open_service: callable) -> None:
+    first = open_service()
+    first.create_new_vending_machine("ven1", "A")
+    first.create_new_vending_machine("ven2", "A")
+    second = open_service()
+    first.add_vending_machine_item("ven1", "orio", 3)
+    second.sync_changes()
+
+    assert second.epoch == first.epoch
+    for name in ["ven1", "ven2"]:
+        assert second.get_machine_version(name) == first.get_machine_version(name)
+    assert second.get_fleet_version() == first.get_fleet_version()
+
+    version = second.get_machine_version("ven1")
+    first.add_vending_machine_item("ven1", "orio", 1, expected_version=version)
+    with pytest.raises(VersionConflictError):
+        second.add_vending_machine_item("ven1", "orio", 1, expected_version=version)
+    second.add_vending_machine_item(
+        "ven1", "orio", 1, expected_version=first.get_machine_version("ven1")
+    )
+    first.sync_changes()
+    assert first.get_vending_machine_info("ven1")["items"] == {"orio": 5}
+
+
+def test_purge_and_journal_restart_reload_other_processes(
+    tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setenv("DB_STORAGE", "json")
+    path = str(tmp_path) + "/"
+    repositories = [
+        get_machine_repository(path, backend="tinydb", shared=True) for _ in range(2)
+    ]
+    for repository in repositories:
+        repository.max_journal_bytes = 200
+    first, second = [VendingMachineService(repository) for repository in repositories]
+    first.create_new_vending_machine("ven1", "A")
+    first.purge_database()
+    first.create_new_vending_machine("ven2", "A")
+    second.sync_changes()
+    assert list(second._machines) == ["ven2"]
+
+    for amount in range(5):
+        first.add_vending_machine_item("ven2", "orio", amount)
+    second.create_new_vending_machine("ven3", "B")
+    first.sync_changes()
+    assert first.get_vending_machine_info("ven2") == second.get_vending_machine_info(
+        "ven2"
+    )
+    assert first.get_machine_version("ven3") == second.get_machine_version("ven3")
+    assert first.get_machine_version("ven2") == second.get_machine_version("ven2")
+    for repository in repositories:
+        repository.close()
+
+
+def test_journal_rotation_does_not_reload_other_processes(
+    tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setenv("DB_STORAGE", "json")
+    path = str(tmp_path) + "/"
+    repositories = [
+        get_machine_repository(path, backend="tinydb", shared=True) for _ in range(2)
+    ]
+    first, second = [VendingMachineService(repository) for repository in repositories]
+    first.create_new_vending_machine("ven1", "A")
+    first.create_new_vending_machine("ven2", "A")
+    second.sync_changes()
+    reloads = []
+    for repository in repositories:
+        repository.max_journal_bytes = 400
+        repository._reload = lambda *args: reloads.append(args)
+        repository._open_repository = lambda: reloads.append("reopen")
+
+    # The second process is still within the previous journal each time it is rotated.
+    while repositories[0]._generation == 0:
+        first.add_vending_machine_item("ven1", "orio", 1)
+    second.sync_changes()
+    while repositories[0]._generation == 1:
+        first.add_vending_machine_item("ven2", "orio", 1)
+    second.create_new_vending_machine("ven3", "B")
+    first.sync_changes()
+
+    assert repositories[0]._generation == 2
+    assert reloads == []
+    for name in ["ven1", "ven2", "ven3"]:
+        assert first.get_machine_version(name) == second.get_machine_version(name)
+        assert first.get_vending_machine_info(name) == second.get_vending_machine_info(
+            name
+        )
+    # A process starting now computes the versions of the ones running.
+    third = VendingMachineService(
+        get_machine_repository(path, backend="tinydb", shared=True)
+    )
+    for name in ["ven1", "ven2", "ven3"]:
+        assert third.get_machine_version(name) == first.get_machine_version(name)
+    for repository in repositories + [third.repository]:
+        repository.close()
+
+
+def test_log_backend_cannot_be_shared(tmp_path: pathlib.Path) -> None:
+    with pytest.raises(ValueError):
+        get_machine_repository(str(tmp_path) + "/", backend="log", shared=True)
+
+
+def add_items(machine_service: VendingMachineService, count: int) -> None:
+    for _ in range(count):
+        machine_service.add_vending_machine_item("ven1", "orio", 1)
+
+
+def test_concurrent_processes_do_not_lose_writes(tmp_path: pathlib.Path) -> None:
+    path = str(tmp_path) + "/"
+    repository = get_machine_repository(path, backend="sqlite", shared=True)
+    machine_service = VendingMachineService(repository)
+    machine_service.create_new_vending_machine("ven1", "A")
+
+    # Like the workers of a pre-fork server, each process inherits the service opened before forking.
+    processes = [
+        multiprocessing.get_context("fork").Process(
+            target=add_items, args=(machine_service, 25)
+        )
+        for _ in range(4)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert [process.exitcode for process in processes] == [0, 0, 0, 0]
+
+    machine_service.sync_changes()
+    assert machine_service.get_vending_machine_info("ven1")["items"] == {"orio": 100}
+    assert machine_service.get_fleet_version() == repository._sequence
+    repository.close()
@@ -1,6 +1,7 @@
 import os
 import types
 
+import pytest
 from dotenv import load_dotenv
 
 from database.db_manager import get_test_db
@@ -61,6 +62,12 @@ def test_add_vending_machine_item() -> None:
     )
     assert vending_machine["items"][item_name] == 50
 
+    # Adding another item keeps the existing ones.
+    vending_machine = machine_service.add_vending_machine_item(
+        vending_machine_name, "drink", 10
+    )
+    assert vending_machine["items"] == {item_name: 50, "drink": 10}
+
 
 def test_edit_vending_machine_item_amount() -> None:
     vending_machine_name = "ven2"
@@ -70,6 +77,12 @@ def test_edit_vending_machine_item_amount() -> None:
         vending_machine_name, item_name, amount
     )
     assert vending_machine["items"][item_name] == 500
+    assert vending_machine["items"]["drink"] == 10
+
+    with pytest.raises(ValueError):
+        machine_service.edit_vending_machine_item_amount(
+            vending_machine_name, "non-exist", amount
+        )
 
 
 def test_remove_vending_machine_item() -> None:
@@ -79,6 +92,9 @@ def test_remove_vending_machine_item() -> None:
         vending_machine_name, item_name
     )
     assert (item_name in vending_machine["items"]) is False
+    assert machine_service.get_vending_machine_info(vending_machine_name)["items"] == {
+        "drink": 10
+    }
 
 
 def test_delete_vending_machine_by_name() -> None:
@@ -87,5 +103,493 @@ def test_delete_vending_machine_by_name() -> None:
     assert message == "Successfully, delete vending machine"
 
 
+def test_bulk_update_vending_machine_items() -> None:
+    machine_service.create_new_vending_machine("bulk1", "a")
+    machine_service.create_new_vending_machine("bulk2", "b")
+    machine_service.add_vending_machine_item("bulk2", "drink", 5)
+    machine_service.create_new_vending_machine("bulk3", "c")
+    bulk3_version = machine_service.get_machine_version("bulk3")
+    changes = machine_service.get_changes(0)["last_sequence"]
+
+    results = machine_service.bulk_update_vending_machine_items(
+        [
+            {"name": "bulk3", "item": "orio", "amount": 1},
+            {"name": "bulk1", "item": "orio", "delta": 10},
+            {"name": "bulk2", "item": "drink", "amount": 20},
+            {"name": "bulk1", "item": "orio", "delta": 5},
+            {"name": "bulk2", "item": "non-exist", "amount": 1},
+            {"name": "non-exist", "item": "orio", "delta": 1},
+            {"name": "bulk1", "item": "orio", "delta": "1"},
+            {"name": "bulk1", "item": "orio", "delta": 1, "amount": 1},
+        ]
+    )
+    assert results[0] == {
+        "success": False,
+        "message": "Item with name 'orio' does not exists.",
+    }
+    bulk1_version = machine_service.get_machine_version("bulk1")
+    assert results[1] == {
+        "success": True,
+        "name": "bulk1",
+        "item": "orio",
+        "amount": 10,
+        "version": bulk1_version,
+    }
+    assert results[2] == {
+        "success": True,
+        "name": "bulk2",
+        "item": "drink",
+        "amount": 20,
+        "version": machine_service.get_machine_version("bulk2"),
+    }
+    assert (results[3]["amount"], results[3]["version"]) == (15, bulk1_version)
+    assert results[4] == {
+        "success": False,
+        "message": "Item with name 'non-exist' does not exists.",
+    }
+    assert results[5] == {
+        "success": False,
+        "message": "Vending machine with name 'non-exist' does not exists.",
+    }
+    assert results[6]["success"] is False
+    assert results[7]["success"] is False
+
+    assert machine_service.get_vending_machine_info("bulk1")["items"] == {"orio": 15}
+    assert machine_service.get_vending_machine_info("bulk2")["items"] == {"drink": 20}
+    # bulk3 had no operation applied, it is neither rewritten nor published.
+    assert machine_service.get_machine_version("bulk3") == bulk3_version
+    changed = machine_service.get_changes(changes)["changes"]
+    assert {change["machine"] for change in changed} == {"bulk1", "bulk2"}
+
+    machine_service.delete_vending_machine_by_name("bulk1")
+    machine_service.delete_vending_machine_by_name("bulk2")
+    machine_service.delete_vending_machine_by_name("bulk3")
+
+
+def test_get_vending_machine_page() -> None:
+    machine_service.purge_database()
+    for index in range(5):
+        machine_service.create_new_vending_machine(f"page{index}", "a")
+
+    page = machine_service.get_vending_machine_page(limit=2)
+    assert [machine["name"] for machine in page["machines"]] == ["page0", "page1"]
+
+    page = machine_service.get_vending_machine_page(cursor=page["next_cursor"], limit=2)
+    assert [machine["name"] for machine in page["machines"]] == ["page2", "page3"]
+
+    page = machine_service.get_vending_machine_page(cursor=page["next_cursor"], limit=2)
+    assert [machine["name"] for machine in page["machines"]] == ["page4"]
+    assert page["next_cursor"] is None
+
+    page = machine_service.get_vending_machine_page(offset=3, limit=10)
+    assert [machine["name"] for machine in page["machines"]] == ["page3", "page4"]
+
+    page = machine_service.get_vending_machine_page(limit=10**6)
+    assert len(page["machines"]) == 5
+
+    with pytest.raises(ValueError):
+        machine_service.get_vending_machine_page(limit=0)
+    with pytest.raises(ValueError):
+        machine_service.get_vending_machine_page(offset=-1)
+
+    assert [
+        machine["name"] for machine in machine_service.iter_all_vending_machine_info()
+    ] == [f"page{index}" for index in range(5)]
+    machine_service.purge_database()
+
+
+def test_filter_and_project_vending_machines() -> None:
+    machine_service.purge_database()
+    machine_service.create_new_vending_machine("ven1", "A")
+    machine_service.create_new_vending_machine("ven2", "B")
+    machine_service.create_new_vending_machine("ven3", "B")
+    machine_service.add_vending_machine_item("ven1", "orio", 1)
+    machine_service.add_vending_machine_item("ven2", "orio", 10)
+    machine_service.add_vending_machine_item("ven2", "drink", 2)
+    machine_service.add_vending_machine_item("ven3", "orio", 4)
+
+    def names(machines: list[dict]) -> list[str]:
+        return [machine["name"] for machine in machines]
+
+    assert names(machine_service.get_all_vending_machine_info(location="B")) == [
+        "ven2",
+        "ven3",
+    ]
+    assert names(machine_service.get_all_vending_machine_info(below=5)) == [
+        "ven1",
+        "ven2",
+        "ven3",
+    ]
+    assert names(
+        machine_service.get_all_vending_machine_info(item_name="orio", below=5)
+    ) == ["ven1", "ven3"]
+    assert names(
+        machine_service.get_all_vending_machine_info(location="B", item_name="drink")
+    ) == ["ven2"]
+
+    assert machine_service.get_all_vending_machine_info(
+        location="A", fields=["name", "location"]
+    ) == [{"name": "ven1", "location": "A"}]
+    assert machine_service.get_vending_machine_info("ven2", fields=["items"]) == {
+        "items": {"orio": 10, "drink": 2}
+    }
+
+    page = machine_service.get_vending_machine_page(
+        limit=1, location="B", fields=["name"]
+    )
+    assert page["machines"] == [{"name": "ven2"}]
+    page = machine_service.get_vending_machine_page(
+        cursor=page["next_cursor"], limit=1, location="B", fields=["name"]
+    )
+    assert page == {"machines": [{"name": "ven3"}], "next_cursor": None}
+
+    with pytest.raises(ValueError):
+        machine_service.get_all_vending_machine_info(fields=["unknown"])
+    with pytest.raises(ValueError):
+        machine_service.get_all_vending_machine_info(fields=[])
+    with pytest.raises(ValueError):
+        machine_service.get_all_vending_machine_info(below="5")
+    machine_service.purge_database()
+
+
+def test_location_index_consistency() -> None:
+    machine_service.purge_database()
+    machine_service.create_new_vending_machine("ven1", "A")
+    machine_service.create_new_vending_machine("ven2", "A")
+    machine_service.create_new_vending_machine("ven3", "B")
+
+    def names_at(location: str) -> list[str]:
+        return [
+            machine["name"]
+            for machine in machine_service.get_vending_machines_by_location(location)
+        ]
+
+    assert names_at("A") == ["ven1", "ven2"]
+    machine_service.change_vending_machine_location("ven2", "B")
+    assert names_at("A") == ["ven1"]
+    assert names_at("B") == ["ven2", "ven3"]
+
+    machine_service.change_vending_machine_name("ven3", "ven4")
+    assert names_at("B") == ["ven2", "ven4"]
+
+    machine_service.delete_vending_machine_by_name("ven1")
+    assert names_at("A") == []
+
+    # A fresh service rebuilds the location index from the stored machines.
+    rebuilt_service = vending_machine_service.VendingMachineService(db)
+    assert [
+        machine["name"]
+        for machine in rebuilt_service.get_vending_machines_by_location("B")
+    ] == ["ven2", "ven4"]
+
+    with pytest.raises(ValueError):
+        machine_service.get_vending_machines_by_location(1)
+    machine_service.purge_database()
+    assert names_at("B") == []
+
+
+def test_get_low_stock_items() -> None:
+    machine_service.purge_database()
+    machine_service.create_new_vending_machine("ven1", "A")
+    machine_service.create_new_vending_machine("ven2", "A")
+    machine_service.create_new_vending_machine("ven3", "B")
+    machine_service.add_vending_machine_item("ven1", "orio", 4)
+    machine_service.add_vending_machine_item("ven1", "drink", 1)
+    machine_service.add_vending_machine_item("ven2", "orio", 2)
+    machine_service.add_vending_machine_item("ven3", "orio", 9)
+
+    assert machine_service.get_low_stock_items(below=5) == [
+        {"name": "ven1", "item": "drink", "amount": 1},
+        {"name": "ven2", "item": "orio", "amount": 2},
+        {"name": "ven1", "item": "orio", "amount": 4},
+    ]
+    assert machine_service.get_low_stock_items(item_name="orio", count=2) == [
+        {"name": "ven2", "item": "orio", "amount": 2},
+        {"name": "ven1", "item": "orio", "amount": 4},
+    ]
+
+    # Every mutation keeps the index up to date.
+    machine_service.edit_vending_machine_item_amount("ven3", "orio", 0)
+    machine_service.remove_vending_machine_item("ven1", "drink")
+    machine_service.change_vending_machine_name("ven2", "ven4")
+    machine_service.bulk_update_vending_machine_items(
+        [{"name": "ven1", "item": "orio", "delta": 10}]
+    )
+    assert machine_service.get_low_stock_items(below=5) == [
+        {"name": "ven3", "item": "orio", "amount": 0},
+        {"name": "ven4", "item": "orio", "amount": 2},
+    ]
+    machine_service.delete_vending_machine_by_name("ven3")
+    assert machine_service.get_low_stock_items(item_name="orio", count=1) == [
+        {"name": "ven4", "item": "orio", "amount": 2}
+    ]
+    assert machine_service.get_low_stock_items(item_name="non-exist", below=5) == []
+
+    with pytest.raises(ValueError):
+        machine_service.get_low_stock_items(item_name="orio")
+    with pytest.raises(ValueError):
+        machine_service.get_low_stock_items(count=0)
+    with pytest.raises(ValueError):
+        machine_service.add_vending_machine_item("ven1", "orio", "1")
+    machine_service.purge_database()
+
+
+def test_inventory_aggregates() -> None:
+    machine_service.purge_database()
+    machine_service.create_new_vending_machine("ven1", "A")
+    machine_service.create_new_vending_machine("ven2", "A")
+    machine_service.create_new_vending_machine("ven3", "B")
+    machine_service.add_vending_machine_item("ven1", "orio", 4)
+    machine_service.add_vending_machine_item("ven1", "drink", 1)
+    machine_service.add_vending_machine_item("ven2", "orio", 2)
+    machine_service.add_vending_machine_item("ven3", "orio", 9)
+
+    assert machine_service.get_inventory_aggregates() == {
+        "orio": {"amount": 15, "machines": 3},
+        "drink": {"amount": 1, "machines": 1},
+    }
+    assert machine_service.get_inventory_aggregates("A", "orio") == {
+        "orio": {"amount": 6, "machines": 2}
+    }
+
+    # Every mutation keeps the counters up to date.
+    machine_service.edit_vending_machine_item_amount("ven3", "orio", 0)
+    machine_service.remove_vending_machine_item("ven1", "drink")
+    machine_service.change_vending_machine_location("ven2", "B")
+    machine_service.bulk_update_vending_machine_items(
+        [{"name": "ven1", "item": "orio", "delta": 10}]
+    )
+    assert machine_service.get_inventory_aggregates() == {
+        "orio": {"amount": 16, "machines": 3}
+    }
+    assert machine_service.get_inventory_aggregates("B") == {
+        "orio": {"amount": 2, "machines": 2}
+    }
+    machine_service.delete_vending_machine_by_name("ven1")
+    assert machine_service.get_inventory_aggregates("A") == {}
+    assert machine_service.check_inventory_aggregates() == {
+        "consistent": True,
+        "mismatches": [],
+    }
+
+    # A drifted counter is reported and repaired.
+    machine_service._inventory_aggregates.update_machine(
+        None, {"name": "ghost", "location": "B", "items": {"orio": 1}}
+    )
+    check_result = machine_service.check_inventory_aggregates(repair=True)
+    assert check_result["consistent"] is False
+    assert check_result["mismatches"][0] == {
+        "location": None,
+        "item": "orio",
+        "expected": {"amount": 2, "machines": 2},
+        "actual": {"amount": 3, "machines": 3},
+    }
+    assert machine_service.check_inventory_aggregates()["consistent"] is True
+
+    with pytest.raises(ValueError):
+        machine_service.get_inventory_aggregates(location=1)
+    machine_service.purge_database()
+
+
+def test_name_index_consistency() -> None:
+    machine_service.create_new_vending_machine("ven3", "a")
+    machine_service.create_new_vending_machine("ven4", "b")
+
+    # A fresh service rebuilds its index from the machines already stored.
+    rebuilt_service = vending_machine_service.VendingMachineService(db)
+    assert rebuilt_service.get_vending_machine_info("ven3")["location"] == "a"
+
+    machine_service.change_vending_machine_name("ven3", "ven5")
+    with pytest.raises(ValueError):
+        machine_service.get_vending_machine_info("ven3")
+    assert machine_service.get_vending_machine_info("ven5")["location"] == "a"
+
+    with pytest.raises(ValueError):
+        machine_service.change_vending_machine_name("ven5", "ven4")
+
+    machine_service.delete_vending_machine_by_name("ven5")
+    with pytest.raises(ValueError):
+        machine_service.get_vending_machine_info("ven5")
+
+    machine_service.purge_database()
+    with pytest.raises(ValueError):
+        machine_service.get_vending_machine_info("ven4")
+
+
+def test_conditional_writes() -> None:
+    vending_machine = machine_service.create_new_vending_machine("ven1", "a")
+    version = vending_machine.version
+    assert version == machine_service.get_machine_version("ven1")
+
+    vending_machine = machine_service.add_vending_machine_item(
+        "ven1", "orio", 1, expected_version=version
+    )
+    assert vending_machine.version > version
+    assert machine_service.get_vending_machine_info("ven1").version == (
+        vending_machine.version
+    )
+
+    # A writer holding the previous version is rejected instead of overwriting.
+    with pytest.raises(vending_machine_service.VersionConflictError):
+        machine_service.edit_vending_machine_item_amount(
+            "ven1", "orio", 10, expected_version=version
+        )
+    with pytest.raises(vending_machine_service.VersionConflictError):
+        machine_service.change_vending_machine_name(
+            "ven1", "ven2", expected_version=version
+        )
+    with pytest.raises(vending_machine_service.VersionConflictError):
+        machine_service.delete_vending_machine_by_name("ven1", expected_version=version)
+    assert machine_service.get_vending_machine_info("ven1")["items"] == {"orio": 1}
+
+    vending_machine = machine_service.change_vending_machine_location(
+        "ven1", "b", expected_version=vending_machine.version
+    )
+    machine_service.delete_vending_machine_by_name(
+        "ven1", expected_version=vending_machine.version
+    )
+    with pytest.raises(ValueError):
+        machine_service.add_vending_machine_item("ven1", "orio", 1, expected_version=1)
+
+
+def test_change_feed() -> None:
+    since = machine_service.get_changes()["last_sequence"]
+    machine_service.create_new_vending_machine("ven1", "a")
+    machine_service.add_vending_machine_item("ven1", "orio", 2)
+    machine_service.bulk_update_vending_machine_items(
+        [
+            {"name": "ven1", "item": "orio", "amount": 5},
+            {"name": "ven1", "item": "lays", "delta": 1},
+        ]
+    )
+    machine_service.change_vending_machine_name("ven1", "ven2")
+    machine_service.change_vending_machine_location("ven2", "b")
+    machine_service.remove_vending_machine_item("ven2", "lays")
+
+    changes = machine_service.get_changes(since)
+    assert changes["missed"] is False
+    assert [
+        (
+            change["machine"],
+            change["field"],
+            change["item"],
+            change["old"],
+            change["new"],
+        )
+        for change in changes["changes"]
+    ] == [
+        ("ven1", "machine", None, None, {"name": "ven1", "location": "a", "items": {}}),
+        ("ven1", "items", "orio", None, 2),
+        ("ven1", "items", "orio", 2, 5),
+        ("ven1", "items", "lays", None, 1),
+        ("ven2", "name", None, "ven1", "ven2"),
+        ("ven2", "location", None, "a", "b"),
+        ("ven2", "items", "lays", 1, None),
+    ]
+    sequences = [change["sequence"] for change in changes["changes"]]
+    assert sequences == list(range(since + 1, since + 8))
+    assert changes["last_sequence"] == sequences[-1]
+
+    page = machine_service.get_changes(since, limit=2)
+    assert page["changes"] == changes["changes"][:2]
+    assert page["last_sequence"] == since + 2
+    assert machine_service.get_changes(changes["last_sequence"]) == {
+        "changes": [],
+        "epoch": machine_service.epoch,
+        "last_sequence": changes["last_sequence"],
+        "missed": False,
+    }
+    assert machine_service.wait_for_changes(changes["last_sequence"], 0) is False
+
+    machine_service.purge_database()
+    [deleted] = machine_service.get_changes(changes["last_sequence"])["changes"]
+    assert (deleted["machine"], deleted["field"], deleted["new"]) == (
+        "ven2",
+        "machine",
+        None,
+    )
+
+    with pytest.raises(ValueError):
+        machine_service.get_changes(-1)
+    with pytest.raises(ValueError):
+        machine_service.get_changes(limit=0)
+
+
+def test_change_feed_reports_missed_changes() -> None:
+    small_feed_service = vending_machine_service.VendingMachineService(
+        db, change_feed_size=2
+    )
+    small_feed_service.create_new_vending_machine("ven1", "a")
+    for _ in range(3):
+        small_feed_service.add_vending_machine_item("ven1", "orio", 1)
+
+    changes = small_feed_service.get_changes(0)
+    assert changes["missed"] is True
+    assert [change["new"] for change in changes["changes"]] == [2, 3]
+    assert small_feed_service.get_changes(2)["missed"] is False
+    # A sequence number from before a restart is beyond the feed.
+    assert small_feed_service.get_changes(100) == {
+        "changes": [],
+        "epoch": small_feed_service.epoch,
+        "last_sequence": 4,
+        "missed": True,
+    }
+    # So is a sequence number given with the epoch of another process.
+    changes = small_feed_service.get_changes(3, epoch="previous")
+    assert changes["missed"] is True
+    assert [change["new"] for change in changes["changes"]] == [2, 3]
+    assert small_feed_service.get_changes(3, epoch=small_feed_service.epoch) == {
+        "changes": [small_feed_service.get_changes(0)["changes"][-1]],
+        "epoch": small_feed_service.epoch,
+        "last_sequence": 4,
+        "missed": False,
+    }
+    with pytest.raises(ValueError):
+        small_feed_service.get_changes(epoch=1)
+    small_feed_service.purge_database()
+    machine_service.purge_database()
+
+
+def test_indexes_are_loaded_from_the_repository() -> None:
+    machine_service.purge_database()
+    for index in range(4):
+        machine_service.create_new_vending_machine(f"ven{index}", f"L{index % 2}")
+        machine_service.add_vending_machine_item(f"ven{index}", "orio", 4 - index)
+        machine_service.add_vending_machine_item(f"ven{index}", "lays", index)
+
+    loaded_service = vending_machine_service.VendingMachineService(
+        db, change_feed_size=2
+    )
+    assert loaded_service.get_low_stock_items(
+        below=3
+    ) == machine_service.get_low_stock_items(below=3)
+    for location in [None, "L0", "L1"]:
+        assert loaded_service.get_inventory_aggregates(
+            location
+        ) == machine_service.get_inventory_aggregates(location)
+    assert loaded_service.check_inventory_aggregates()["consistent"] is True
+    assert loaded_service.get_vending_machines_by_location("L1", ["name"]) == [
+        {"name": "ven1"},
+        {"name": "ven3"},
+    ]
+    assert [
+        loaded_service.get_machine_version(f"ven{index}") for index in range(4)
+    ] == [
+        2,
+        3,
+        4,
+        5,
+    ]
+
+    # Only the creations the feed holds are kept, each with its own sequence number.
+    changes = loaded_service.get_changes(0)
+    assert changes["missed"] is True
+    assert [
+        (change["sequence"], change["machine"], change["new"]["items"])
+        for change in changes["changes"]
+    ] == [(3, "ven2", {"orio": 2, "lays": 2}), (4, "ven3", {"orio": 1, "lays": 3})]
+    machine_service.purge_database()
+
+
 def teardown_module(module: types.ModuleType) -> None:
     machine_service.purge_database()
@@ -0,0 +1,155 @@
+import pathlib
+import threading
+import time
+from typing import Callable, Iterable
+
+import pytest
+
+from database.db_manager import get_machine_repository
+from database.machine_repository import MachineRepository
+from services.vending_machine_service import VendingMachineService
+from services.write_coalescer import WriteCoalescer
+
+THREAD_COUNT = 8
+ADDS_PER_THREAD = 25
+
+
+class CountingRepository:
+    """Forwards every call to a repository, counting the update_many calls."""
+
+    def __init__(self: "CountingRepository", repository: MachineRepository) -> None:
+        self.repository = repository
+        self.update_many_calls = 0
+
+    def update_many(
+        self: "CountingRepository",
+        vending_machine_names: Iterable[str],
+        transform: Callable[[dict], None],
+    ) -> list[dict]:
+        self.update_many_calls += 1
+        return self.repository.update_many(vending_machine_names, transform)
+
+    def update(
+        self: "CountingRepository",
+        vending_machine_name: str,
+        transform: Callable[[dict], None],
+    ) -> dict:
+        return self.update_many([vending_machine_name], transform)[0]
+
+    def __getattr__(self: "CountingRepository", name: str) -> object:
+        return getattr(self.repository, name)
+
+
+@pytest.fixture
+def repository(tmp_path: pathlib.Path) -> Iterable[CountingRepository]:
+    repository = get_machine_repository(str(tmp_path) + "/", backend="tinydb")
+    yield CountingRepository(repository)
+    repository.close()
+
+
+def test_concurrent_updates_share_writes(repository: CountingRepository) -> None:
+    machine_service = VendingMachineService(repository, coalesce_writes=True)
+    for name in ["ven1", "ven2"]:
+        machine_service.create_new_vending_machine(name, "A")
+    barrier = threading.Barrier(THREAD_COUNT)
+
+    def add_items(thread_index: int) -> None:
+        barrier.wait()
+        for index in range(ADDS_PER_THREAD):
+            machine_service.add_vending_machine_item(
+                ["ven1", "ven2"][(thread_index + index) % 2], "orio", 1
+            )
+
+    threads = [
+        threading.Thread(target=add_items, args=(index,))
+        for index in range(THREAD_COUNT)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sum(
+        machine["items"]["orio"]
+        for machine in machine_service.get_all_vending_machine_info()
+    ) == (THREAD_COUNT * ADDS_PER_THREAD)
+    assert machine_service.get_inventory_aggregates() == {
+        "orio": {"amount": THREAD_COUNT * ADDS_PER_THREAD, "machines": 2}
+    }
+
+
+def test_failed_update_does_not_affect_its_batch(
+    repository: CountingRepository,
+) -> None:
+    machine_service = VendingMachineService(repository)
+    machine_service.create_new_vending_machine("ven1", "A")
+
+    def add_orio(document: dict) -> None:
+        document["items"]["orio"] = document["items"].get("orio", 0) + 1
+
+    def fail(document: dict) -> None:
+        document["items"]["orio"] = 100
+        raise ValueError("rejected")
+
+    results = machine_service._apply_machine_updates(
+        [("ven1", add_orio), ("ven1", fail), ("ven1", add_orio), ("ven2", add_orio)]
+    )
+    assert results[0]["items"] == {"orio": 1}
+    assert str(results[1]) == "rejected"
+    assert results[2]["items"] == {"orio": 2}
+    assert str(results[3]) == "Vending machine with name 'ven2' does not exists."
+    # Only the last update of a machine shows a state that was written on its own.
+    assert getattr(results[0], "version", None) is None
+    assert results[2].version == machine_service.get_machine_version("ven1")
+    assert repository.get("ven1")["items"] == {"orio": 2}
+    assert repository.update_many_calls == 1
+
+    # A batch where every update fails writes nothing.
+    [result] = machine_service._apply_machine_updates([("ven1", fail)])
+    assert isinstance(result, ValueError)
+    assert repository.get("ven1")["items"] == {"orio": 2}
+
+
+def test_updates_submitted_during_a_write_form_one_batch() -> None:
+    batches = []
+    first_batch_started = threading.Event()
+    release_first_batch = threading.Event()
+
+    def apply_batch(updates: list) -> list:
+        batches.append([name for name, _ in updates])
+        if len(batches) == 1:
+            first_batch_started.set()
+            release_first_batch.wait()
+        return [{"name": name} for name, _ in updates]
+
+    coalescer = WriteCoalescer(apply_batch)
+    results = {}
+
+    def submit(name: str) -> None:
+        results[name] = coalescer.submit(name, lambda document: None)
+
+    leader = threading.Thread(target=submit, args=("ven0",))
+    leader.start()
+    first_batch_started.wait()
+    followers = [
+        threading.Thread(target=submit, args=(f"ven{index}",)) for index in range(1, 6)
+    ]
+    for thread in followers:
+        thread.start()
+    while len(coalescer._pending) < len(followers):
+        time.sleep(0.001)
+    release_first_batch.set()
+    for thread in [leader, *followers]:
+        thread.join()
+
+    assert batches[0] == ["ven0"]
+    assert sorted(batches[1]) == [f"ven{index}" for index in range(1, 6)]
+    assert results == {f"ven{index}": {"name": f"ven{index}"} for index in range(6)}
+
+
+def test_batch_errors_reach_every_caller() -> None:
+    def apply_batch(updates: list) -> list:
+        raise OSError("disk full")
+
+    with pytest.raises(OSError):
+        WriteCoalescer(apply_batch).submit("ven1", lambda document: None)
@@ -0,0 +1,7 @@
+"""
+WSGI entry point of the API, for WSGI servers (``gunicorn wsgi:app``). Importing app.py creates no app.
+"""
+
+from app import create_app
+
+app = create_app()